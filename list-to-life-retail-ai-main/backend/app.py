@@ -4,48 +4,63 @@ import uuid
 import traceback
 import datetime
 import sys
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-import google.generativeai as genai
 
 # --- Add project root to Python path to import modules ---
 # This ensures that app.py can find your other Python files
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+# Load .env before the modules below: their tuning knobs (LLM_*, STOCK_*, RESERVATION_*, CONVERSATION_*, ...)
+# are read from the environment when they are imported.
+load_dotenv()
 
 # --- Import All Custom Business Logic Modules ---
 try:
-    from stock_engine import get_stock_status, find_smart_substitute, products_by_id, DEFAULT_STORE_ID
+    from stock_engine import (get_stock_status, get_stock_status_bulk, get_store_stock_report,
+                              find_smart_substitute, products_by_id, DEFAULT_STORE_ID, INVENTORY_SERVICE)
     print("✅ stock_engine.py loaded successfully.")
 except ImportError as e:
     print(f"❌ ERROR: Could not import from stock_engine.py. {e}")
     sys.exit(1)
 
 try:
-    from deal_optimizer import apply_deals_to_list
+    from deal_optimizer import apply_deals_to_list, find_nearly_qualifying_deals, CartPricingSession
     print("✅ deal_optimizer.py loaded successfully.")
 except ImportError as e:
     print(f"❌ ERROR: Could not import from deal_optimizer.py. {e}")
     sys.exit(1)
 
 try:
-    from store_navigator import optimize_shopping_path, STORE_ENTRY_POINT
+    from store_navigator import optimize_shopping_path, solve_shopping_route, optimize_shopping_paths_batch
     print("✅ store_navigator.py loaded successfully.")
 except ImportError as e:
     print(f"❌ ERROR: Could not import from store_navigator.py. {e}")
     sys.exit(1)
 
 try:
-    from recommendation_engine import get_fbt_recommendations, build_frequently_bought_together_rules, customer_purchases_data
+    from recommendation_engine import get_fbt_recommendations, get_recommendation_cache_stats, record_purchase, remove_purchase
     print("✅ recommendation_engine.py loaded successfully.")
 except ImportError as e:
     print(f"❌ ERROR: Could not import from recommendation_engine.py. {e}")
     sys.exit(1)
 
+try:
+    from product_retriever import retrieve_products_for_conversation, PRODUCT_RETRIEVER
+    print("✅ product_retriever.py loaded successfully.")
+except ImportError as e:
+    print(f"❌ ERROR: Could not import from product_retriever.py. {e}")
+    sys.exit(1)
+
+from cache_utils import LRUTTLCache
+from conversation_store import create_conversation_store
+from llm_cache import LLMResponseCache, conversation_fingerprint
+from llm_client import create_llm_client
+from stream_utils import ListItemStreamParser, sse_event
+
 
 # --- Initial Application Setup ---
-load_dotenv()
 app = Flask(__name__)
 # Enable CORS to allow requests from your React frontend and support credentials (for sessions)
 CORS(app, supports_credentials=True) 
@@ -53,28 +68,38 @@ CORS(app, supports_credentials=True)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'a_very_secret_key_for_your_hackathon')
 
 
-# --- Initialize Gemini API ---
-API_KEY = os.getenv("GOOGLE_API_KEY")
-GEMINI_MODEL = None
-if API_KEY:
-    try:
-        genai.configure(api_key=API_KEY)
-        GEMINI_MODEL = genai.GenerativeModel("gemini-1.5-flash")
-        print("✅ Gemini model initialized successfully.")
-    except Exception as e:
-        print(f"❌ Failed to initialize Gemini: {e}")
-else:
-    print("❌ GOOGLE_API_KEY not found. AI features will be disabled.")
+# --- Initialize the LLM client ---
+# LLM_BACKEND selects 'gemini' (the default, needs GOOGLE_API_KEY), 'http' (e.g. fake_llm_server.py) or 'local'.
+# Calls are bounded, time-limited and retried; when the model cannot answer, a local list generator does.
+LLM_CLIENT = None
+try:
+    LLM_CLIENT = create_llm_client(PRODUCT_RETRIEVER)
+    print(f"✅ LLM client initialized with the '{LLM_CLIENT.backend.name}' backend.")
+except Exception as e:
+    print(f"❌ Failed to initialize the LLM backend: {e}. AI features will be disabled.")
 
 
 # --- Pre-computation and Data Preparation ---
-FBT_RULES = build_frequently_bought_together_rules(customer_purchases_data)
+# FBT rules are loaded once by recommendation_engine (from its snapshot) and kept current there.
 
-# Prepare a string of all available products to ground the AI model.
-AVAILABLE_PRODUCTS_FOR_LLM = "Here is a list of Walmart products you can suggest, along with their internal IDs and Categories:\n"
-for p_id, p_info in products_by_id.items():
-    AVAILABLE_PRODUCTS_FOR_LLM += f"- {p_info['product_name']} (ID: {p_id}, Category: {p_info['category']})\n"
-AVAILABLE_PRODUCTS_FOR_LLM += "\n"
+# The prompt is grounded in the products relevant to each conversation (BM25 retrieval, see
+# product_retriever.py) rather than the whole catalog, so its size does not grow with the catalog.
+def format_products_for_llm(products):
+    """Catalog lines for the system prompt."""
+    lines = "Here are the Walmart products most relevant to this conversation, along with their internal IDs and Categories:\n"
+    for p_info in products:
+        lines += f"- {p_info['product_name']} (ID: {p_info['product_id']}, Category: {p_info['category']})\n"
+    return lines + "\n"
+
+# Incremental pricing sessions for carts that change often, keyed by cart_id. Idle carts expire.
+CART_SESSIONS = LRUTTLCache(max_entries=10000, ttl_seconds=1800)
+
+# Chat history, keyed by the session's chat_id; the cookie carries only the id. Set CONVERSATION_DB to a
+# SQLite file (e.g. conversations.db) to keep conversations across restarts.
+CONVERSATION_STORE = create_conversation_store()
+
+# Parsed model answers for list-generation requests ("taco night", "weekly groceries"), shared across users
+LLM_RESPONSE_CACHE = LLMResponseCache(PRODUCT_RETRIEVER.catalog_version)
 
 
 # --- Helper Functions ---
@@ -89,44 +114,24 @@ def build_gemini_conversation(history, system_prompt, user_message):
         last_role = "model"
         for turn in history:
             if turn.get('role') != last_role:
-                contents.append(turn)
+                contents.append({"role": turn.get('role'), "parts": [turn.get('text', '')]})
                 last_role = turn.get('role')
 
     contents.append({"role": "user", "parts": [user_message]})
     return contents
 
 
-# --- Core API Endpoints ---
-
-@app.route('/')
-def health_check():
-    """A simple health check endpoint to confirm the server is running."""
-    return jsonify({"status": "ok", "message": "Walmart AI Assistant backend is running."})
-
-@app.route('/clear_session', methods=['POST'])
-def clear_session():
-    """Clears all data from the current user's session."""
-    session.clear()
-    return jsonify({"status": "success", "message": "Session cleared."})
-
-@app.route('/send_message', methods=['POST'])
-def handle_send_message():
-    """The main chatbot endpoint. Takes a user message and orchestrates AI interaction."""
-    user_message = request.json.get('message')
-    if not user_message:
-        return jsonify({"error": "No message provided."}), 400
-    if not GEMINI_MODEL:
-        return jsonify({"error": "AI model is not initialized."}), 500
-
-    chat_history = session.get('chat_history', [])
-    
-    system_prompt = (
+def build_system_prompt(user_message, chat_history=None, history_summary=""):
+    """The assistant's instructions, grounded in the catalog products relevant to the conversation."""
+    relevant_products = format_products_for_llm(retrieve_products_for_conversation(user_message, chat_history))
+    earlier_conversation = f"\n\n--- EARLIER IN THIS CONVERSATION ---\n{history_summary}" if history_summary else ""
+    return (
             "You are 'Walmart Assistant 360', an intelligent, proactive, and friendly e-commerce and in-store shopping expert. "
             "Your ultimate goal is to provide the best possible shopping experience for the user, from planning to checkout. "
             "You have full knowledge of our product catalog, real-time inventory, current deals, and store layout. "
             "Always prioritize user convenience and savings. Be super helpful and enthusiastic!\n\n"
             
-            "Here is our complete product catalog for your reference (use product_id, product_name, category, brand, subcategory, price, attributes):\n" + AVAILABLE_PRODUCTS_FOR_LLM + "\n"
+            "Here are the products from our catalog that match this conversation (use product_id, product_name, category, brand, subcategory, price, attributes):\n" + relevant_products + "\n"
             
             "--- YOUR EXPERTISE & CAPABILITIES ---\n"
             "As Walmart Assistant 360, you can:\n"
@@ -136,7 +141,7 @@ def handle_send_message():
             "4.  Optimize Deals & Budget: Calculate total costs, apply relevant deals/coupons, and help users stay within their budget.\n"
             "5.  Guide In-Store Navigation: Provide optimized walking paths for shopping lists based on store layout.\n"
             "6.  Answer Product Questions: Provide details on products, categories, or brands.\n\n"
-
+            
             "--- IMPORTANT: YOUR RESPONSE FORMAT (JSON or Plain Text) ---\n"
             "You will respond in one of two ways based on user intent. Stick to these formats precisely:\n"
             "A. JSON ACTION COMMAND (ONLY for clear list creation/modification commands): "
@@ -149,10 +154,10 @@ def handle_send_message():
             "   \n"
             "   * For 'new_list' action: Generate a full, relevant list of items (WMK_P### IDs and quantities). The app will then get stock/deal info.\n"
             "   * For 'add_item', 'remove_item', 'replace_item' actions: Only include the necessary product_id(s) and quantity (for add). The app will then handle stock/deal info.\n\n"
-
+            
             "B. PLAIN TEXT CONVERSATIONAL RESPONSE (for everything else): "
             "If your response is NOT an explicit command for list creation or modification (e.g., answering a question, confirming understanding, acknowledging stock issues, providing navigation guidance, or giving deal advice), respond naturally and politely in plain text. Do NOT include JSON in these responses.\n\n"
-
+            
             "--- CONVERSATIONAL GUIDANCE ---\n"
             "1.  Strict Product IDs: When generating JSON, ALWAYS use the exact product_id (e.g., 'WMK_P008') from the 'Available Products' list. If a product isn't explicitly listed, politely state you don't carry it.\n"
             "2.  Proactive Stock & Deals: When you receive stock information from the system, proactively and clearly inform the user about out-of-stock/low-stock items. Suggest smart substitutes (if found) by name and ID. Also, highlight any applied deals or suggest items to qualify for deals (e.g., 'If you add one more chip bag, you'll get $1.50 off your snack bundle!').\n"
@@ -164,119 +169,500 @@ def handle_send_message():
             "    - For 'Taco night': WMK_P008 (ShinePro Dish Soap), WMK_P010 (DailyHarvest Eggs), WMK_P042 (FarmFresh Fresh Spinach).\n" 
             "    - For 'BBQ' (general): WMK_P001 (SweetDelight Potato Chips (Large)), WMK_P004 (FizzPop Cola (12-pack)), WMK_P006 (FreshHome Laundry Detergent).\n" 
             "    - For 'Breakfast': WMK_P010 (DailyHarvest Eggs), WMK_P036 (DailyHarvest Milk (Gallon)), WMK_P027 (FizzPop Coffee Beans)."
-
+            + earlier_conversation
     )
 
-    conversation_for_api = build_gemini_conversation(chat_history, system_prompt, user_message)
+def get_chat_id():
+    """The session's conversation id, moving any history still held in an older session cookie into the store."""
+    chat_id = session.setdefault('chat_id', str(uuid.uuid4()))
+    if 'chat_history' in session:
+        CONVERSATION_STORE.append(chat_id, session.pop('chat_history'))
+    return chat_id
+
+def build_conversation_for_api(window, user_message):
+    """The model conversation from a CONVERSATION_STORE.window: system prompt, the latest turns and a summary of the ones before them."""
+    system_prompt = build_system_prompt(user_message, window['turns'], window['summary'])
+    return build_gemini_conversation(window['turns'], system_prompt, user_message)
+
+def chat_history_fields(chat_id, first_new_turn, new_turns, history_mode):
+    """
+    History fields for a chat response. history_mode 'new' returns just this exchange, so the response size
+    does not grow with the conversation; 'full' (the default) returns every turn the store keeps.
+    """
+    if history_mode == "new":
+        return {"chat_history": new_turns, "history_since": first_new_turn, "turn_count": first_new_turn + len(new_turns)}
+    history = CONVERSATION_STORE.history(chat_id)
+    return {"chat_history": history['turns'], "history_since": history['since'], "turn_count": history['turn_count']}
+
+def enrich_list_item(item, stock_info=None):
+    """
+    Resolves one AI-suggested list item against live stock: keeps it, swaps in a smart substitute when it is
+    low or out of stock, or returns None when it is out of stock with nothing to offer instead.
+    Pass stock_info from get_stock_status_bulk to skip the per-item lookup.
+    """
+    original_pid = item["product_id"]
+    original_product_info = products_by_id[original_pid]
+    if stock_info is None:
+        stock_info = get_stock_status(original_pid, DEFAULT_STORE_ID)
+
+    final_pid, final_product_info, final_stock_info = original_pid, original_product_info, stock_info
+    reason = item.get("reason", "")
+    if stock_info["status"] in ["Out of Stock", "Low Stock"]:
+        substitute = find_smart_substitute(original_pid, DEFAULT_STORE_ID)
+        if substitute:
+            final_pid, final_product_info = substitute.product_id, substitute.product
+            final_stock_info = get_stock_status(final_pid, DEFAULT_STORE_ID)
+            reason = f"Substituted for {original_product_info['product_name']}"
+        elif stock_info["status"] == "Out of Stock":
+            return None
+
+    return {
+        "product_id": final_pid, "name": final_product_info["product_name"],
+        "quantity": item.get("quantity", 1), "price": final_product_info.get("price", 0),
+        "reason": reason, "stock": final_stock_info
+    }
+
+def describe_generated_list(parsed_json, enriched_list):
+    """The chat reply and generated_list for a parsed model response and its enriched items."""
+    if "list_items" not in parsed_json or not isinstance(parsed_json['list_items'], list):
+        return "The AI returned an unexpected format. Please try again.", None
+    if not enriched_list and not parsed_json['list_items']:
+        return "I couldn't find any relevant items in the catalog for your request.", None
+    return f"I've created a list with {len(enriched_list)} items for you.", enriched_list
+
+def get_item_stock_details(product_id, status_info=None):
+    """
+    Stock status for a product at the default store, plus a substitute when it is low or out of stock.
+    Pass status_info from get_stock_status_bulk to skip the per-item lookup.
+    """
+    if status_info is None:
+        status_info = get_stock_status(product_id, DEFAULT_STORE_ID)
+    substitute = None
+    if status_info['status'] in ["Out of Stock", "Low Stock"]:
+        match = find_smart_substitute(product_id, DEFAULT_STORE_ID)
+        substitute = match.as_dict() if match else None
+    return {"status": status_info['status'], "message": status_info['message'], "substitute": substitute}
+
+def is_product_available(product_id):
+    """Whether a product can be sold at the default store now (used to filter suggestions)."""
+    return get_stock_status(product_id, DEFAULT_STORE_ID)['status'] in ["In Stock", "Low Stock"]
+
+
+# --- Core API Endpoints ---
+
+@app.route('/')
+def health_check():
+    """A simple health check endpoint to confirm the server is running."""
+    return jsonify({"status": "ok", "message": "Walmart AI Assistant backend is running."})
+
+@app.route('/clear_session', methods=['POST'])
+def clear_session():
+    """Clears all data from the current user's session."""
+    if session.get('chat_id'):
+        CONVERSATION_STORE.clear(session['chat_id'])
+    session.clear()
+    return jsonify({"status": "success", "message": "Session cleared."})
+
+@app.route('/send_message', methods=['POST'])
+def handle_send_message():
+    """
+    The main chatbot endpoint. Takes a user message and orchestrates AI interaction.
+    Send "history": "new" to get only this exchange back in chat_history instead of the whole conversation.
+    """
+    user_message = request.json.get('message')
+    if not user_message:
+        return jsonify({"error": "No message provided."}), 400
+    if LLM_CLIENT is None:
+        return jsonify({"error": "AI model is not initialized."}), 500
+
+    chat_id = get_chat_id()
+    history_mode = request.json.get('history', 'full')
+    window = CONVERSATION_STORE.window(chat_id)
+
+    def generate_response():
+        conversation_for_api = build_conversation_for_api(window, user_message)
+        response_text, _ = LLM_CLIENT.generate(conversation_for_api)
+        return json.loads(response_text)
 
     bot_response_text = "Sorry, I couldn't process that request."
     generated_list_items = None
     
     try:
-        response = GEMINI_MODEL.generate_content(
-            conversation_for_api,
-            generation_config={"response_mime_type": "application/json"}
-        )
-        parsed_json = json.loads(response.text)
+        # Repeated list requests are answered from the cache; identical concurrent ones share one model call.
+        # The prompt is built from this conversation, so only requests made in the same state share an answer.
+        parsed_json, _ = LLM_RESPONSE_CACHE.get_or_generate(user_message, generate_response, conversation_fingerprint(window))
 
+        enriched_list = []
         if "list_items" in parsed_json and isinstance(parsed_json['list_items'], list):
-            enriched_list = []
-            for item in parsed_json["list_items"]:
-                original_pid = item.get("product_id")
-                original_product_info = products_by_id.get(original_pid)
-                if not original_product_info: continue
-
-                stock_info = get_stock_status(original_pid)
-                final_pid, final_product_info, is_substituted = original_pid, original_product_info, False
-                
-                if stock_info["status"] in ["Out of Stock", "Low Stock"]:
-                    substitute = find_smart_substitute(original_pid)
-                    if substitute:
-                        final_pid, final_product_info, is_substituted = substitute['product_id'], substitute, True
-                    elif stock_info["status"] == "Out of Stock":
-                        continue
-                
-                final_stock_info = get_stock_status(final_pid)
-                enriched_list.append({
-                    "product_id": final_pid, "name": final_product_info["product_name"],
-                    "quantity": item.get("quantity", 1), "price": final_product_info.get("price", 0),
-                    "reason": f"Substituted for {original_product_info['product_name']}" if is_substituted else item.get("reason", ""),
-                    "stock": final_stock_info
-                })
-            
-            if not enriched_list and not parsed_json['list_items']:
-                 bot_response_text = "I couldn't find any relevant items in the catalog for your request."
-            else:
-                generated_list_items = enriched_list
-                bot_response_text = f"I've created a list with {len(enriched_list)} items for you."
-        else:
-             bot_response_text = "The AI returned an unexpected format. Please try again."
+            list_items = [item for item in parsed_json["list_items"] if item.get("product_id") in products_by_id]
+            stock_by_pid = get_stock_status_bulk([item["product_id"] for item in list_items])
+            for item in list_items:
+                enriched_item = enrich_list_item(item, stock_by_pid[item["product_id"]])
+                if enriched_item:
+                    enriched_list.append(enriched_item)
+        bot_response_text, generated_list_items = describe_generated_list(parsed_json, enriched_list)
 
     except Exception:
-        print(f"❌ An error occurred during Gemini API call. Full traceback:")
+        print(f"❌ An error occurred during the LLM call. Full traceback:")
         print(traceback.format_exc())
         bot_response_text = "I'm having trouble connecting to my brain right now. Please try again."
 
-    chat_history.append({"role": "user", "text": user_message})
-    chat_history.append({"role": "model", "text": bot_response_text})
-    session['chat_history'] = chat_history
+    new_turns = [{"role": "user", "text": user_message}, {"role": "model", "text": bot_response_text}]
+    first_new_turn = CONVERSATION_STORE.append(chat_id, new_turns)
 
     return jsonify({
         "response": bot_response_text,
         "generated_list": generated_list_items, # Correct key for the frontend
-        "chat_history": session.get('chat_history', [])
+        **chat_history_fields(chat_id, first_new_turn, new_turns, history_mode)
     })
 
+@app.route('/chat_history', methods=['GET'])
+def get_chat_history():
+    """
+    The conversation so far. Pass ?since=N (the turn_count a client already has) to get only later turns.
+    """
+    if not session.get('chat_id'):
+        return jsonify({"chat_history": [], "history_since": 0, "turn_count": 0})
+    history = CONVERSATION_STORE.history(get_chat_id(), since=request.args.get('since', 0, type=int))
+    return jsonify({"chat_history": history['turns'], "history_since": history['since'], "turn_count": history['turn_count']})
+
+@app.route('/send_message/stream', methods=['POST'])
+def handle_send_message_stream():
+    """
+    Streaming variant of /send_message using server-sent events. The model response is read as it is
+    generated, and each list item is sent as a 'list_item' event as soon as it has been parsed and checked
+    against stock. A final 'done' event carries the same fields as the /send_message response.
+    Run under a cooperative worker (e.g. gunicorn -k gevent) so waiting on the model does not pin an OS thread.
+    Cached list generations are replayed immediately; streamed ones are not coalesced, but are cached when done.
+    Send "history": "new" to get only this exchange back in chat_history instead of the whole conversation.
+    """
+    user_message = request.json.get('message')
+    if not user_message:
+        return jsonify({"error": "No message provided."}), 400
+    if LLM_CLIENT is None:
+        return jsonify({"error": "AI model is not initialized."}), 500
+
+    # The cookie goes out with the first event; the finished exchange goes to the store under chat_id
+    chat_id = get_chat_id()
+    history_mode = request.json.get('history', 'full')
+
+    def generate_events():
+        bot_response_text = "Sorry, I couldn't process that request."
+        generated_list_items = None
+        parser = ListItemStreamParser()
+        enriched_list = []
+        try:
+            window = CONVERSATION_STORE.window(chat_id)
+            conversation = conversation_fingerprint(window)
+            parsed_json = LLM_RESPONSE_CACHE.get(user_message, conversation)
+            if parsed_json is not None:
+                item_batches = [parsed_json["list_items"]]
+            else:
+                conversation_for_api = build_conversation_for_api(window, user_message)
+                item_batches = (parser.feed(chunk) for chunk in LLM_CLIENT.stream(conversation_for_api))
+            for items in item_batches:
+                for item in items:
+                    if item.get("product_id") not in products_by_id:
+                        continue
+                    enriched_item = enrich_list_item(item)
+                    if enriched_item:
+                        enriched_list.append(enriched_item)
+                        yield sse_event("list_item", enriched_item)
+
+            if parsed_json is None:
+                parsed_json = json.loads(parser.text)
+                LLM_RESPONSE_CACHE.store(user_message, parsed_json, conversation)
+            bot_response_text, generated_list_items = describe_generated_list(parsed_json, enriched_list)
+        except Exception:
+            print(f"❌ An error occurred during the streaming LLM call. Full traceback:")
+            print(traceback.format_exc())
+            bot_response_text = "I'm having trouble connecting to my brain right now. Please try again."
+
+        new_turns = [{"role": "user", "text": user_message}, {"role": "model", "text": bot_response_text}]
+        first_new_turn = CONVERSATION_STORE.append(chat_id, new_turns)
+        yield sse_event("done", {
+            "response": bot_response_text,
+            "generated_list": generated_list_items,
+            **chat_history_fields(chat_id, first_new_turn, new_turns, history_mode)
+        })
+
+    return Response(stream_with_context(generate_events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # --- Endpoints for Other Features ---
 
 @app.route('/api/shopping-list-details', methods=['POST'])
 def get_shopping_list_details():
-    """Processes a given shopping list with stock, substitute, and deal info."""
+    """
+    Processes a given shopping list with stock, substitute, and deal info.
+    Optional 'deal_mode': 'stacked' (default) or 'exclusive' (each unit claimed by one deal, cheapest allocation).
+    """
     shopping_list = request.json.get('shopping_list', [])
     if not shopping_list:
         return jsonify({"error": "Shopping list not provided."}), 400
 
+    statuses = get_stock_status_bulk([item.get("product_id") for item in shopping_list], DEFAULT_STORE_ID)
     processed_list = []
     for item in shopping_list:
         product_id = item.get("product_id")
         if not product_id or product_id not in products_by_id:
             continue
         
-        status_info = get_stock_status(product_id, DEFAULT_STORE_ID)
+        stock_details = get_item_stock_details(product_id, statuses[product_id])
         item_details = {
             "product_id": product_id, "name": products_by_id[product_id]['product_name'],
-            "quantity": item.get('quantity', 1), "status": status_info['status'],
-            "message": status_info['message'], "product_details": products_by_id[product_id],
-            "substitute": None
+            "quantity": item.get('quantity', 1), "status": stock_details['status'],
+            "message": stock_details['message'], "product_details": products_by_id[product_id],
+            "substitute": stock_details['substitute']
         }
-
-        if status_info['status'] in ["Out of Stock", "Low Stock"]:
-            substitute = find_smart_substitute(product_id, DEFAULT_STORE_ID)
-            if substitute:
-                item_details["substitute"] = substitute
-        
         processed_list.append(item_details)
     
-    deal_results = apply_deals_to_list(processed_list)
+    try:
+        deal_results = apply_deals_to_list(processed_list, mode=request.json.get('deal_mode', 'stacked'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    deal_results['nearly_qualifying_deals'] = find_nearly_qualifying_deals(processed_list, is_available=is_product_available)
     return jsonify(deal_results)
 
+@app.route('/api/stock-report', methods=['GET'])
+def get_stock_report():
+    """
+    Store-wide stock classification over the full catalog: counts per status plus the
+    low-stock (fewest days left first) and out-of-stock product IDs. Optional ?store_id= and ?limit= (default 100).
+    """
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "limit must be a whole number."}), 400
+    if limit < 0:
+        return jsonify({"error": "limit must be 0 or more."}), 400
+    return jsonify(get_store_stock_report(request.args.get('store_id', DEFAULT_STORE_ID), limit=limit))
+
+@app.route('/api/deals/nearly-qualifying', methods=['POST'])
+def get_nearly_qualifying_deals():
+    """
+    Returns the BOGO/bundle deals a shopping list is a few units short of, with the cheapest items to add.
+    Optional 'max_units_short' (default 2) limits how far from triggering a deal may be.
+    """
+    shopping_list = request.json.get('shopping_list', [])
+    if not shopping_list:
+        return jsonify({"error": "Shopping list not provided."}), 400
+    shopping_list = [item for item in shopping_list if item.get('product_id') in products_by_id]
+    try:
+        max_units_short = int(request.json.get('max_units_short', 2))
+    except (TypeError, ValueError):
+        return jsonify({"error": "max_units_short must be a whole number."}), 400
+    if max_units_short < 1:
+        return jsonify({"error": "max_units_short must be at least 1."}), 400
+    return jsonify({"nearly_qualifying_deals": find_nearly_qualifying_deals(shopping_list, max_units_short=max_units_short,
+                                                                            is_available=is_product_available)})
+
+@app.route('/api/cart-sessions', methods=['POST'])
+def create_cart_session():
+    """
+    Starts an incremental pricing session for a shopping list and returns its cart_id with the priced cart.
+    Send later edits to /api/cart-sessions/<cart_id>/changes instead of re-posting the whole list.
+    """
+    shopping_list = [
+        {"product_id": item['product_id'], "quantity": item.get('quantity', 1)}
+        for item in request.json.get('shopping_list', []) if item.get('product_id') in products_by_id
+    ]
+    try:
+        cart_session = CartPricingSession(shopping_list)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    cart_id = str(uuid.uuid4())
+    CART_SESSIONS.set(cart_id, cart_session)
+
+    result = cart_session.snapshot()
+    result['cart_id'] = cart_id
+    result['stock'] = {line['product_id']: get_item_stock_details(line['product_id']) for line in result['processed_items']}
+    return jsonify(result)
+
+@app.route('/api/cart-sessions/<cart_id>', methods=['GET'])
+def get_cart_session(cart_id):
+    """Returns the full priced cart of a pricing session."""
+    cart_session = CART_SESSIONS.get(cart_id)
+    if cart_session is None:
+        return jsonify({"error": "Cart session not found or expired."}), 404
+    return jsonify(cart_session.snapshot())
+
+@app.route('/api/cart-sessions/<cart_id>/changes', methods=['POST'])
+def apply_cart_session_changes(cart_id):
+    """
+    Applies cart deltas ({'op': 'add' | 'remove' | 'set_quantity', 'product_id', 'quantity'}) and returns
+    only the line items that changed, the new totals and stock details for the products that were touched.
+    """
+    cart_session = CART_SESSIONS.get(cart_id)
+    if cart_session is None:
+        return jsonify({"error": "Cart session not found or expired."}), 404
+    changes = [change for change in request.json.get('changes', []) if change.get('product_id') in products_by_id]
+
+    try:
+        diff = cart_session.apply_changes(changes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    CART_SESSIONS.set(cart_id, cart_session) # keeps an active cart from expiring
+
+    changed_product_ids = {change['product_id'] for change in changes}
+    diff['stock'] = {item['product_id']: get_item_stock_details(item['product_id'])
+                     for item in diff['changed_items'] if item['product_id'] in changed_product_ids}
+    return jsonify(diff)
+
+@app.route('/api/reservations', methods=['POST'])
+def create_reservation():
+    """
+    Holds stock for a checkout. Every item in 'shopping_list' is reserved or none is (409 with the shortages).
+    Optional 'store_id' and 'ttl_seconds'; unconfirmed reservations are released when the TTL runs out.
+    """
+    store_id = request.json.get('store_id', DEFAULT_STORE_ID)
+    items = {}
+    try:
+        for item in request.json.get('shopping_list', []):
+            if item.get('product_id') in products_by_id:
+                items[item['product_id']] = items.get(item['product_id'], 0) + int(item.get('quantity', 1))
+        ttl_seconds = request.json.get('ttl_seconds')
+        if ttl_seconds is not None:
+            ttl_seconds = float(ttl_seconds)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Quantities must be whole numbers and ttl_seconds a number of seconds."}), 400
+    try:
+        reservation = INVENTORY_SERVICE.reserve(items, store_id, ttl_seconds=ttl_seconds)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(reservation), (200 if reservation['success'] else 409)
+
+@app.route('/api/reservations/<reservation_id>/commit', methods=['POST'])
+def commit_reservation(reservation_id):
+    """Completes a checkout: the reserved units are taken out of stock (409 if a stock count left too few)."""
+    result = INVENTORY_SERVICE.commit(reservation_id)
+    if result['success']:
+        return jsonify(result), 200
+    return jsonify(result), (409 if 'shortages' in result else 404)
+
+@app.route('/api/reservations/<reservation_id>', methods=['DELETE'])
+def release_reservation(reservation_id):
+    """Cancels a checkout and returns the reserved units to sale."""
+    if not INVENTORY_SERVICE.release(reservation_id):
+        return jsonify({"error": "Reservation not found or already completed."}), 404
+    return jsonify({"reservation_id": reservation_id, "released": True})
+
 @app.route('/api/optimize-path', methods=['POST'])
 def get_optimized_path():
-    """Takes a shopping list and returns the most efficient path through the store."""
+    """
+    Takes a shopping list and returns the most efficient path through the store.
+    Optional 'store_id' selects the store layout (defaults to the store in store_layout.json).
+    Optional 'solver' ('auto', 'greedy', 'exact', 'local_search'), 'end_at_checkout' and
+    'time_budget_ms' select the route solver and add total_distance/total_hops/solver_time_ms to the response.
+    """
     shopping_list = request.json.get('shopping_list', [])
     if not shopping_list:
         return jsonify({"error": "Shopping list is empty."}), 400
-    optimized_path = optimize_shopping_path(shopping_list, STORE_ENTRY_POINT)
+    store_id = request.json.get('store_id')
+
+    solver = request.json.get('solver')
+    try:
+        if solver:
+            route = solve_shopping_route(
+                shopping_list, solver=solver,
+                end_at_checkout=bool(request.json.get('end_at_checkout', False)),
+                time_budget_ms=float(request.json.get('time_budget_ms', 50)),
+                store_id=store_id
+            )
+            return jsonify(route)
+
+        optimized_path = optimize_shopping_path(shopping_list, store_id=store_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify({"optimized_path": optimized_path})
 
+@app.route('/api/optimize-path/batch', methods=['POST'])
+def get_optimized_paths_batch():
+    """
+    Takes many orders ({'order_id', 'shopping_list'}) and returns one optimized route per order.
+    Accepts the same 'store_id', 'solver', 'end_at_checkout' and 'time_budget_ms' options as
+    /api/optimize-path; 'merge_wave' also returns one combined pick route tagged per order.
+    """
+    orders = request.json.get('orders', [])
+    if not orders:
+        return jsonify({"error": "No orders provided."}), 400
+    for i, order in enumerate(orders):
+        if not isinstance(order, dict) or not order.get('shopping_list'):
+            return jsonify({"error": f"Order at position {i} has no shopping_list."}), 400
+        order.setdefault('order_id', i)
+
+    try:
+        results = optimize_shopping_paths_batch(
+            orders,
+            store_id=request.json.get('store_id'),
+            solver=request.json.get('solver', 'auto'),
+            end_at_checkout=bool(request.json.get('end_at_checkout', False)),
+            time_budget_ms=float(request.json.get('time_budget_ms', 50)),
+            merge_wave=bool(request.json.get('merge_wave', False))
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(results)
+
 @app.route('/api/recommendations', methods=['POST'])
 def get_recommendations_endpoint():
-    """Takes a list of product IDs and returns 'Frequently Bought Together' recommendations."""
+    """
+    Takes a list of product IDs and returns 'Frequently Bought Together' recommendations.
+    Optional 'scoring' ('count', 'confidence' or 'lift') selects how candidates are ranked.
+    """
     product_ids = request.json.get('product_ids', [])
     if not product_ids:
         return jsonify({"recommendations": []})
-    recommendations = get_fbt_recommendations(product_ids)
+    try:
+        recommendations = get_fbt_recommendations(product_ids, scoring=request.json.get('scoring', 'count'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify({"recommendations": recommendations})
 
+@app.route('/api/llm/cache-stats', methods=['GET'])
+def get_llm_cache_stats():
+    """Returns hit/miss, coalescing and upstream-call counters for the model response cache."""
+    return jsonify(LLM_RESPONSE_CACHE.stats())
+
+@app.route('/api/llm/client-stats', methods=['GET'])
+def get_llm_client_stats():
+    """Returns call, retry, fallback and circuit-breaker counters for the LLM client."""
+    if LLM_CLIENT is None:
+        return jsonify({"error": "AI model is not initialized."}), 500
+    return jsonify(LLM_CLIENT.stats())
+
+@app.route('/api/chat/store-stats', methods=['GET'])
+def get_conversation_store_stats():
+    """Returns conversation store size and hit counters."""
+    return jsonify(CONVERSATION_STORE.stats())
+
+@app.route('/api/recommendations/cache-stats', methods=['GET'])
+def get_recommendation_cache_stats_endpoint():
+    """Returns hit/miss counters for the recommendation result cache."""
+    return jsonify(get_recommendation_cache_stats())
+
+@app.route('/api/purchases', methods=['POST'])
+def record_purchase_endpoint():
+    """Folds a completed purchase ({'invoice_id', 'product_ids'}) into the recommendation model."""
+    invoice_id = request.json.get('invoice_id')
+    product_ids = request.json.get('product_ids', [])
+    if not invoice_id or not product_ids or not isinstance(product_ids, list):
+        return jsonify({"error": "invoice_id and a list of product_ids are required."}), 400
+    record_purchase(invoice_id, product_ids)
+    return jsonify({"status": "success"})
+
+@app.route('/api/purchases/<invoice_id>', methods=['DELETE'])
+def remove_purchase_endpoint(invoice_id):
+    """
+    Takes a cancelled purchase out of the recommendation model. With a JSON body {'product_ids': [...]},
+    only those items are removed (a return).
+    """
+    product_ids = (request.get_json(silent=True) or {}).get('product_ids')
+    if product_ids is not None and (not product_ids or not isinstance(product_ids, list)):
+        return jsonify({"error": "product_ids must be a non-empty list when given."}), 400
+    if not remove_purchase(invoice_id, product_ids):
+        return jsonify({"error": "Purchase not found."}), 404
+    return jsonify({"status": "success"})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
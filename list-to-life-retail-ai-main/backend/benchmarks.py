@@ -0,0 +1,1200 @@
+"""
+Micro-benchmarks for the backend engines.
+
+Run from the backend directory (the engines load their JSON data relative to it):
+
+    python benchmarks.py navigator
+"""
+import argparse
+import random
+import statistics
+import time
+
+
+def _percentiles(samples_ms: list) -> tuple:
+    """Returns (p50, p99) in milliseconds for a list of latency samples."""
+    if len(samples_ms) < 2:
+        return samples_ms[0], samples_ms[0] # statistics.quantiles needs two points
+    cuts = statistics.quantiles(samples_ms, n=100, method='inclusive')
+    return cuts[49], cuts[98]
+
+
+def _time_calls(func, inputs: list) -> list:
+    """Calls func once per input and returns the latency of each call in milliseconds."""
+    samples = []
+    for value in inputs:
+        start = time.perf_counter()
+        func(value)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+# --- Store Navigator ---
+
+def _greedy_path_with_bfs(shopping_list_items: list) -> list:
+    """Reference implementation: the original greedy loop running one BFS per candidate."""
+    import store_navigator as nav
+
+    items_to_visit = [
+        {"product_id": item['product_id'], "location_node": nav.PRODUCT_LOCATIONS_MAP[item['product_id']]}
+        for item in shopping_list_items if item['product_id'] in nav.PRODUCT_LOCATIONS_MAP
+    ]
+    path = []
+    current_node = nav.STORE_ENTRY_POINT
+    while items_to_visit:
+        closest_item, min_cost = None, float('inf')
+        for item in items_to_visit:
+            cost = nav._find_shortest_path_cost(nav.STORE_GRAPH, current_node, item['location_node'])
+            if cost < min_cost:
+                min_cost, closest_item = cost, item
+        if not closest_item:
+            break
+        path.append(closest_item)
+        current_node = closest_item['location_node']
+        items_to_visit.remove(closest_item)
+    return path
+
+
+def bench_chat_history(runs: int, seed: int):
+    """Per-message cost of carrying chat history in the session cookie against the server-side conversation store."""
+    import base64
+    import hashlib
+    import hmac
+    import json
+    import os
+    import tempfile
+    import zlib
+    from conversation_store import ConversationStore
+    from product_retriever import PRODUCT_RETRIEVER
+
+    rng = random.Random(seed)
+    product_names = [product["product_name"] for product in PRODUCT_RETRIEVER.products]
+    secret_key = b"bench"
+    requests = ["taco night for six", "add salsa and sour cream", "something for a bbq this weekend",
+                "what is cheaper than the cola?", "swap the chips for a healthier snack", "weekly groceries for two"]
+
+    def exchange(number):
+        user_text = f"{rng.choice(requests)} ({number})"
+        picks = rng.sample(product_names, rng.randint(3, 8))
+        model_text = (f"Here's your list with {len(picks)} items: " + ", ".join(f"{rng.randint(1, 4)} x {name}" for name in picks)
+                      + f". Your estimated total is ${rng.uniform(10, 120):.2f}.")
+        return [{"role": "user", "text": user_text}, {"role": "model", "text": model_text}]
+
+    def sign_cookie(session_data):
+        """What Flask's cookie session does on every response: JSON, zlib if it helps, base64, HMAC."""
+        payload = json.dumps(session_data, separators=(',', ':')).encode('utf-8')
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload) - 1:
+            payload = b"." + compressed
+        encoded = base64.urlsafe_b64encode(payload).rstrip(b"=")
+        return encoded + b"." + base64.urlsafe_b64encode(hmac.new(secret_key, encoded, hashlib.sha1).digest()).rstrip(b"=")
+
+    def load_cookie(cookie):
+        encoded, signature = cookie.rsplit(b".", 1)
+        expected = base64.urlsafe_b64encode(hmac.new(secret_key, encoded, hashlib.sha1).digest()).rstrip(b"=")
+        assert hmac.compare_digest(signature, expected)
+        payload = base64.urlsafe_b64decode(encoded + b"=" * (-len(encoded) % 4))
+        return json.loads(zlib.decompress(payload[1:]) if payload.startswith(b".") else payload)
+
+    num_exchanges = 150
+    checkpoints = {5, 25, 50, 100, 150}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "conversations.db")
+        store = ConversationStore(db_path=db_path, max_turns=200)
+        cookie = sign_cookie({"chat_history": []})
+        cookie_over_limit_at = None
+        rows = []
+        for number in range(1, num_exchanges + 1):
+            new_turns = exchange(number)
+
+            start = time.perf_counter()
+            session_data = load_cookie(cookie)
+            session_data["chat_history"].extend(new_turns)
+            cookie = sign_cookie(session_data)
+            cookie_body = json.dumps({"chat_history": session_data["chat_history"]})
+            cookie_ms = (time.perf_counter() - start) * 1000
+            if cookie_over_limit_at is None and len(cookie) > 4093:
+                cookie_over_limit_at = number
+
+            start = time.perf_counter()
+            store.window("chat-1")
+            first_new_turn = store.append("chat-1", new_turns)
+            store_body = json.dumps({"chat_history": new_turns, "history_since": first_new_turn,
+                                     "turn_count": first_new_turn + len(new_turns)})
+            store_ms = (time.perf_counter() - start) * 1000
+            if number in checkpoints:
+                rows.append((number, len(cookie), len(cookie_body), cookie_ms, len(store_body), store_ms))
+
+        print(f"{'exchange':>9} {'cookie B':>9} {'body B':>8} {'cookie ms':>10} {'store body B':>13} {'store ms':>9}")
+        for number, cookie_bytes, cookie_body_bytes, cookie_ms, store_body_bytes, store_ms in rows:
+            print(f"{number:>9} {cookie_bytes:>9} {cookie_body_bytes:>8} {cookie_ms:>10.3f} {store_body_bytes:>13} {store_ms:>9.3f}")
+        print(f"session cookie passes the 4 KB browser limit at exchange {cookie_over_limit_at}; the store's cookie carries a 36-character id")
+        store_sizes = [row[4] for row in rows]
+        assert max(store_sizes) < 2 * min(store_sizes), "Response size grew with the conversation"
+
+        # Long conversations are trimmed, survive a restart through SQLite, and window to a bounded prompt
+        history = store.history("chat-1")
+        assert history["turn_count"] == 2 * num_exchanges and len(history["turns"]) == 200
+        store.close()
+        reopened = ConversationStore(db_path=db_path, max_turns=200)
+        assert reopened.history("chat-1") == history, "Conversation changed across a restart"
+        assert reopened.history("chat-1", since=history["turn_count"] - 2)["turns"] == history["turns"][-2:]
+        window = reopened.window("chat-1")
+        assert len(window["turns"]) == 8 and window["summary"].startswith(f"{2 * num_exchanges - 8} earlier messages")
+        print(f"prompt window: {len(window['turns'])} turns + summary of {len(window['summary'])} chars")
+        print("trimming, restart and since= checks: ok")
+        reopened.close()
+
+
+def bench_llm_cache(runs: int, seed: int):
+    """Response cache and request coalescing in front of a stub model with a fixed 20 ms latency."""
+    import threading
+    from llm_cache import LLMResponseCache, conversation_fingerprint
+
+    rng = random.Random(seed)
+    upstream_calls = []
+    calls_lock = threading.Lock()
+
+    def stub_model(message):
+        with calls_lock:
+            upstream_calls.append(message)
+        time.sleep(0.02)
+        return {"action": "new_list", "list_items": [{"product_id": f"WMK_P{len(message) % 200 + 1:03d}", "quantity": 1}]}
+
+    # 1. 32 concurrent identical prompts (with spelling variants) share one upstream call
+    cache = LLMResponseCache("bench")
+    variants = ["Taco night", "taco night!", "  TACO   night ", "Taco Night?"]
+    barrier = threading.Barrier(32)
+    results = []
+
+    def identical_request(thread_index):
+        barrier.wait()
+        message = variants[thread_index % len(variants)]
+        results.append(cache.get_or_generate(message, lambda: stub_model(message)))
+
+    threads = [threading.Thread(target=identical_request, args=(thread_index,)) for thread_index in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(upstream_calls) == 1, f"{len(upstream_calls)} upstream calls for one prompt"
+    assert all(parsed_json is results[0][0] for parsed_json, _ in results), "Coalesced callers got different responses"
+    sources = sorted({source for _, source in results})
+    print(f"32 concurrent identical prompts -> {len(upstream_calls)} upstream call ({', '.join(sources)}): ok")
+
+    # The same follow-up sent in two different conversations must not share an answer, in flight or cached
+    upstream_calls.clear()
+    windows = [{"summary": "", "turns": [{"role": "user", "text": f"dinner for {guests}"}, {"role": "model", "text": "ok"}]}
+               for guests in (2, 8)]
+    barrier = threading.Barrier(2)
+    answers = [None, None]
+
+    def follow_up(index):
+        barrier.wait()
+        answers[index] = cache.get_or_generate("make it vegetarian", lambda: stub_model(f"vegetarian {index}"),
+                                               conversation_fingerprint(windows[index]))[0]
+
+    threads = [threading.Thread(target=follow_up, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(upstream_calls) == 2 and answers[0] is not answers[1], "Different conversations shared one answer"
+    assert cache.get("make it vegetarian", conversation_fingerprint(windows[0])) is answers[0]
+    assert cache.get("make it vegetarian") is None
+    print("same message in two conversations -> 2 upstream calls, answers kept apart: ok")
+
+    # 2. Skewed traffic: a few popular list requests and a long tail, 16 threads
+    popular = ["taco night", "weekly groceries", "bbq party", "breakfast for four", "movie night snacks"]
+    messages = [rng.choice(popular) if rng.random() < 0.7 else f"list for occasion {rng.randint(1, 500)}"
+                for _ in range(runs * 8)]
+    print(f"\n{'impl':>12} {'requests':>9} {'upstream':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, use_cache in (("no cache", False), ("cache", True)):
+        upstream_calls.clear()
+        cache = LLMResponseCache("bench")
+        latencies, latencies_lock = [], threading.Lock()
+
+        def worker(batch):
+            for message in batch:
+                start = time.perf_counter()
+                if use_cache:
+                    cache.get_or_generate(message, lambda: stub_model(message))
+                else:
+                    stub_model(message)
+                with latencies_lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=worker, args=(messages[index::16],)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        p50, p99 = _percentiles(latencies)
+        print(f"{label:>12} {len(messages):>9} {len(upstream_calls):>9} {p50:>8.2f} {p99:>8.2f}")
+    print(f"cache stats: {cache.stats()}")
+
+
+def bench_llm_client(runs: int, seed: int):
+    """The LLM client against the in-process fake server: latency stays within the deadline as the upstream degrades."""
+    import json
+    import socket
+    import threading
+    import llm_client
+    from fake_llm_server import FakeLLMServer
+    from product_retriever import PRODUCT_RETRIEVER
+
+    server = FakeLLMServer(port=0, latency_ms=50, jitter_ms=20, seed=seed).start()
+    with socket.socket() as probe: # a port nothing listens on, for the 'down' scenario
+        probe.bind(("127.0.0.1", 0))
+        dead_url = f"http://127.0.0.1:{probe.getsockname()[1]}/generate"
+    conversation = [{"role": "user", "parts": ["taco night for six"]}]
+    deadline_seconds = 0.5
+    scenarios = [
+        ("healthy", {"latency_ms": 50, "error_rate": 0.0, "hang_rate": 0.0}, server.url, 8),
+        ("flaky 30% 503", {"latency_ms": 50, "error_rate": 0.3, "hang_rate": 0.0}, server.url, 8),
+        ("hanging 20%", {"latency_ms": 50, "error_rate": 0.0, "hang_rate": 0.2}, server.url, 8),
+        ("overloaded", {"latency_ms": 300, "error_rate": 0.0, "hang_rate": 0.0}, server.url, 64),
+        ("down", {}, dead_url, 8),
+    ]
+    try:
+        # Streaming returns the same document as a plain call
+        client = llm_client.LLMClient(llm_client.HTTPBackend(server.url), llm_client.LocalListBackend(PRODUCT_RETRIEVER))
+        streamed = "".join(client.stream(conversation))
+        assert json.loads(streamed) == json.loads(client.generate(conversation)[0]), "Streamed response differs"
+        print("streamed and plain responses match: ok")
+
+        print(f"\n{'scenario':>14} {'threads':>8} {'p50 ms':>8} {'p99 ms':>8} {'backend %':>10} {'retries':>8} {'breaker':>10}")
+        for label, behaviour, url, num_threads in scenarios:
+            server.behaviour.update(behaviour)
+            client = llm_client.LLMClient(
+                llm_client.HTTPBackend(url), llm_client.LocalListBackend(PRODUCT_RETRIEVER), max_concurrency=8,
+                deadline_seconds=deadline_seconds, backoff_base_seconds=0.05,
+                breaker=llm_client.CircuitBreaker(failure_threshold=5, reset_seconds=0.5))
+            latencies, sources, lock = [], [], threading.Lock()
+
+            def worker():
+                for _ in range(max(1, runs // 20)):
+                    start = time.perf_counter()
+                    text, source = client.generate(conversation)
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    assert json.loads(text)["list_items"], "Empty answer"
+                    with lock:
+                        latencies.append(elapsed_ms)
+                        sources.append(source)
+
+            threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            p50, p99 = _percentiles(latencies)
+            stats = client.stats()
+            backend_share = 100 * sources.count("http") / len(sources)
+            print(f"{label:>14} {num_threads:>8} {p50:>8.1f} {p99:>8.1f} {backend_share:>10.1f} {stats['retries']:>8} "
+                  f"{stats['breaker_state']:>10}")
+            assert max(latencies) < (deadline_seconds + 0.25) * 1000, f"{label}: a call overran its deadline"
+            if label == "healthy":
+                assert backend_share == 100, "A healthy upstream within the concurrency limit needed the fallback"
+    finally:
+        server.stop()
+
+
+def bench_navigator(runs: int, seed: int):
+    import store_navigator as nav
+
+    rng = random.Random(seed)
+    product_ids = sorted(nav.PRODUCT_LOCATIONS_MAP)
+    print(f"Layout: {len(nav.STORE_GRAPH)} nodes, {len(product_ids)} located products, {runs} runs per size")
+    print(f"{'items':>6} {'impl':>16} {'p50 ms':>10} {'p99 ms':>10}")
+
+    for size in (10, 50, 200):
+        lists = [
+            [{"product_id": rng.choice(product_ids), "quantity": 1} for _ in range(size)]
+            for _ in range(runs)
+        ]
+        # Both implementations must visit the same nodes in the same order
+        for shopping_list in lists[:5]:
+            expected = [item['location_node'] for item in _greedy_path_with_bfs(shopping_list)]
+            actual = [item['location_node'] for item in nav.optimize_shopping_path(shopping_list, nav.STORE_ENTRY_POINT)]
+            assert expected == actual, "Distance index and BFS greedy paths differ"
+
+        for label, func in (
+            ("bfs (baseline)", _greedy_path_with_bfs),
+            ("distance index", lambda items: nav.optimize_shopping_path(items, nav.STORE_ENTRY_POINT)),
+        ):
+            p50, p99 = _percentiles(_time_calls(func, lists))
+            print(f"{size:>6} {label:>16} {p50:>10.3f} {p99:>10.3f}")
+
+
+def bench_route_solvers(runs: int, seed: int):
+    import store_navigator as nav
+
+    rng = random.Random(seed)
+    product_ids = sorted(nav.PRODUCT_LOCATIONS_MAP)
+    print(f"{'items':>6} {'solver':>13} {'mean hops':>10} {'p50 ms':>10} {'p99 ms':>10}")
+
+    for size in (10, 50, 200):
+        lists = [
+            [{"product_id": rng.choice(product_ids), "quantity": 1} for _ in range(size)]
+            for _ in range(runs)
+        ]
+        for solver in ("greedy", "exact", "local_search"):
+            hops = []
+
+            def solve(items):
+                hops.append(nav.solve_shopping_route(items, solver=solver, end_at_checkout=True)['total_hops'])
+
+            p50, p99 = _percentiles(_time_calls(solve, lists))
+            print(f"{size:>6} {solver:>13} {statistics.mean(hops):>10.2f} {p50:>10.3f} {p99:>10.3f}")
+
+
+def bench_batch_routes(runs: int, seed: int):
+    import os
+    import store_navigator as nav
+
+    rng = random.Random(seed)
+    product_ids = sorted(nav.PRODUCT_LOCATIONS_MAP)
+    orders = [
+        {"order_id": f"ORD{i:05d}",
+         "shopping_list": [{"product_id": rng.choice(product_ids), "quantity": 1} for _ in range(rng.randint(5, 40))]}
+        for i in range(runs * 5)
+    ]
+    print(f"{len(orders)} orders, {os.cpu_count()} CPUs available")
+    print(f"{'workers':>8} {'routes/sec':>12} {'speedup':>8}")
+
+    baseline = None
+    worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    for workers in worker_counts:
+        nav.optimize_shopping_paths_batch(orders[:50], max_workers=workers)  # Warm the pool and worker layouts
+        result = nav.optimize_shopping_paths_batch(orders, max_workers=workers)
+        baseline = baseline or result['routes_per_sec']
+        print(f"{result['workers']:>8} {result['routes_per_sec']:>12.1f} {result['routes_per_sec'] / baseline:>7.2f}x")
+
+    pool = nav._get_batch_pool()
+    def route_paths(routes):
+        return [(route['order_id'], route['total_distance'], route['solver']) for route in routes]
+
+    inline = route_paths(nav.optimize_shopping_paths_batch(orders, max_workers=1)['routes'])
+    for workers in worker_counts:
+        assert route_paths(nav.optimize_shopping_paths_batch(orders, max_workers=workers)['routes']) == inline
+    assert nav._get_batch_pool() is pool, "batch pool was rebuilt for a different max_workers"
+    print(f"one pool of {nav.BATCH_POOL_WORKERS} workers serves every max_workers with identical routes: ok")
+
+    wave = nav.optimize_shopping_paths_batch(orders[:20], merge_wave=True)['wave']
+    separate = sum(route['total_distance'] for route in nav.optimize_shopping_paths_batch(orders[:20])['routes'])
+    print(f"Merged wave for 20 orders: distance {wave['total_distance']:g} vs {separate:g} walking each order separately")
+
+
+# --- Recommendation Engine ---
+
+def _synthetic_purchases(num_rows: int, rng: random.Random, num_products: int = 2000) -> list:
+    """Purchase-log rows with skewed product popularity and baskets of 1-30 items."""
+    product_ids = [f"WMK_P{i:05d}" for i in range(num_products)]
+    weights = [1 / (rank + 1) for rank in range(num_products)]
+    rows = []
+    invoice = 0
+    while len(rows) < num_rows:
+        invoice += 1
+        basket_size = min(num_rows - len(rows), max(1, int(rng.expovariate(1 / 8))), 30)
+        for product_id in rng.choices(product_ids, weights=weights, k=basket_size):
+            rows.append({"invoice_id": f"INV{invoice:08d}", "product_id": product_id})
+    return rows
+
+
+def bench_fbt_build(runs: int, seed: int):
+    import recommendation_engine as recs
+
+    if not recs.SPARSE_BUILD_AVAILABLE:
+        print("NumPy/SciPy not installed: only the pure-Python build can be timed.")
+    rng = random.Random(seed)
+    print(f"{'rows':>9} {'method':>8} {'seconds':>9} {'speedup':>8}")
+
+    for num_rows in (10_000, 100_000, 1_000_000):
+        purchases = _synthetic_purchases(num_rows, rng)
+        results = {}
+        timings = {}
+        for method in ("python", "sparse") if recs.SPARSE_BUILD_AVAILABLE else ("python",):
+            start = time.perf_counter()
+            results[method] = recs.build_frequently_bought_together_rules(purchases, method=method)
+            timings[method] = time.perf_counter() - start
+            print(f"{num_rows:>9} {method:>8} {timings[method]:>9.3f} {timings['python'] / timings[method]:>7.1f}x")
+        if len(results) == 2:
+            assert results["python"] == results["sparse"], "Sparse and pure-Python FBT rules differ"
+
+    # Purchases and returns made through the API survive restarts, with or without a snapshot in between
+    import os
+    import tempfile
+    purchases = _synthetic_purchases(5_000, rng, num_products=200)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        snapshot_file = os.path.join(temp_dir, "fbt_snapshot.json")
+        event_log = recs.PurchaseEventLog(os.path.join(temp_dir, "fbt_purchase_events.jsonl"))
+        live = recs.load_or_build_fbt_store(purchases, snapshot_file, event_log.read())
+        for step in range(runs * 4):
+            if step % 5 == 4:
+                event = {"op": "remove", "invoice_id": rng.choice(sorted(live.transactions)),
+                         "product_ids": None if rng.random() < 0.5 else [f"WMK_P{rng.randint(0, 199):05d}"]}
+            else:
+                event = {"op": "add", "invoice_id": f"API{step}", "product_ids": [f"WMK_P{rng.randint(0, 199):05d}" for _ in range(3)]}
+            event_log.append(event)
+            live.apply_purchase_event(event)
+            if step == runs * 2:
+                live.save_snapshot(snapshot_file)
+        event_log.close()
+        with open(event_log.path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "add", "invoi') # a crash mid-write
+        restarted = recs.load_or_build_fbt_store(purchases, snapshot_file, event_log.read())
+        assert restarted.rules == live.rules and restarted.transactions == live.transactions, "Purchase events lost across a restart"
+        os.remove(snapshot_file)
+        rebuilt = recs.load_or_build_fbt_store(purchases, snapshot_file, event_log.read())
+        assert rebuilt.rules == live.rules, "Purchase events lost when the model was rebuilt"
+        event_log.append({"op": "add", "invoice_id": "after-crash", "product_ids": ["WMK_P00001", "WMK_P00002"]})
+        assert event_log.read()[-1]["invoice_id"] == "after-crash", "Entry after a torn line was lost"
+        event_log.close()
+    print(f"\n{runs * 4} API purchase events replayed after restart (snapshot, rebuild, torn last line): ok")
+
+
+# --- Deal Optimizer ---
+
+def _synthetic_deals(num_deals: int, product_ids: list, categories: list, rng: random.Random) -> list:
+    """A promo calendar mixing every deal type, each applicable to a handful of products."""
+    deals = []
+    for i in range(num_deals):
+        # Category-wide promotions are rare; most deals target specific products
+        deal_type = rng.choices(["BOGO", "BUNDLE_THRESHOLD", "PERCENTAGE_ITEM", "FIXED_AMOUNT_ITEM", "PERCENTAGE_CATEGORY"],
+                                weights=[25, 20, 25, 25, 1])[0]
+        deals.append({
+            "deal_id": f"SYN{i:05d}", "deal_name": f"Synthetic deal {i}", "type": deal_type,
+            "applicable_product_ids": rng.sample(product_ids, rng.randint(2, 8)) if deal_type != "PERCENTAGE_CATEGORY" else [],
+            "category_restriction": rng.choice(categories), "excluded_subcategories": [],
+            "discount_value": rng.choice([0.5, 1.0, 2.0]), "discount_percentage": rng.choice([5, 10, 20]),
+            "min_quantity_for_deal": 3, "apply_to_n_lowest_price": 1,
+            "active": rng.random() < 0.9, "priority": rng.randint(1, 100)
+        })
+    deals.sort(key=lambda d: d['priority'], reverse=True)
+    return deals
+
+
+def bench_deal_index(runs: int, seed: int):
+    import contextlib
+    import io
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    product_ids = sorted(deals_module.products_by_id_local)
+    categories = sorted({p['category'] for p in deals_module.products_by_id_local.values()})
+    carts = [
+        [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 4)} for _ in range(20)]
+        for _ in range(runs)
+    ]
+    original_deals, original_index = deals_module.deals_data_local, deals_module.DEAL_INDEX
+    print(f"{'deals':>6} {'impl':>28} {'p50 ms':>10} {'p99 ms':>10}")
+
+    try:
+        for num_deals in (25, 1000, 5000):
+            calendar = _synthetic_deals(num_deals, product_ids, categories, rng)
+            deals_module.deals_data_local = calendar
+            deals_module.DEAL_INDEX = deals_module.compile_deal_index(calendar)
+
+            def linear_scan_matching(cart):
+                # The pre-index cost of just finding applicable items: every deal x every item
+                for deal in calendar:
+                    if deal.get('active', False):
+                        for item in cart:
+                            item['product_id'] in deal['applicable_product_ids']
+
+            def indexed_apply(cart):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    deals_module.apply_deals_to_list(cart)
+
+            for label, func in (("linear scan (matching only)", linear_scan_matching), ("indexed (full pricing)", indexed_apply)):
+                p50, p99 = _percentiles(_time_calls(func, carts))
+                print(f"{num_deals:>6} {label:>28} {p50:>10.3f} {p99:>10.3f}")
+    finally:
+        deals_module.deals_data_local, deals_module.DEAL_INDEX = original_deals, original_index
+
+
+def _bogo_free_value_by_unit_expansion(deal: dict, matched_items: list) -> float:
+    """Reference: the original BOGO evaluation, one list entry per purchased unit."""
+    units = []
+    for item in sorted(matched_items, key=lambda x: x['original_price']):
+        for _ in range(item['quantity']):
+            units.append(item)
+    units.sort(key=lambda x: x['original_price'])
+    free_units = (len(units) // deal['min_quantity_for_deal']) * deal['apply_to_n_lowest_price']
+    return sum(unit['original_price'] for unit in units[:free_units])
+
+
+def bench_bulk_bogo(runs: int, seed: int):
+    import tracemalloc
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    deal = {"min_quantity_for_deal": 3, "apply_to_n_lowest_price": 1}
+    print(f"{'units/line':>10} {'impl':>16} {'p50 ms':>10} {'p99 ms':>10} {'peak KiB':>9}")
+
+    for units_per_line in (10, 500, 5000):
+        # B2B carts: a dozen SKUs under the same promotion, bought by the case
+        carts = [
+            [{"product_id": f"SKU{i}", "quantity": rng.randint(units_per_line // 2, units_per_line),
+              "original_price": round(rng.uniform(1, 30), 2)} for i in range(12)]
+            for _ in range(runs)
+        ]
+        for cart in carts[:5]:
+            expected = _bogo_free_value_by_unit_expansion(deal, cart)
+            actual = sum(item['original_price'] * free for item, free in deals_module.allocate_bogo_free_units(deal, cart))
+            assert abs(expected - actual) < 0.01, "Run-based BOGO disagrees with unit expansion"
+
+        for label, func in (
+            ("unit expansion", lambda cart: _bogo_free_value_by_unit_expansion(deal, cart)),
+            ("price runs", lambda cart: deals_module.allocate_bogo_free_units(deal, cart)),
+        ):
+            tracemalloc.start()
+            func(carts[0])
+            peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+            p50, p99 = _percentiles(_time_calls(func, carts))
+            print(f"{units_per_line:>10} {label:>16} {p50:>10.3f} {p99:>10.3f} {peak_kib:>9.1f}")
+
+
+def bench_cart_session(runs: int, seed: int):
+    import contextlib
+    import io
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    product_ids = sorted(deals_module.products_by_id_local)
+    print(f"{'lines':>6} {'impl':>22} {'p50 ms':>10} {'p99 ms':>10}")
+
+    for num_lines in (10, 40):
+        with contextlib.redirect_stdout(io.StringIO()):
+            cart_session = deals_module.CartPricingSession(
+                [{"product_id": product_id, "quantity": rng.randint(1, 4)} for product_id in rng.sample(product_ids, num_lines)]
+            )
+        changes = [
+            [{"op": "set_quantity", "product_id": rng.choice(list(cart_session.lines)), "quantity": rng.randint(1, 6)}]
+            for _ in range(runs)
+        ]
+
+        def full_recompute(change):
+            # What the client does today: re-post the whole list after every edit
+            cart = [{"product_id": line['product_id'], "quantity": line['quantity']} for line in cart_session.lines.values()]
+            with contextlib.redirect_stdout(io.StringIO()):
+                deals_module.apply_deals_to_list(cart)
+
+        def session_delta(change):
+            with contextlib.redirect_stdout(io.StringIO()):
+                cart_session.apply_changes(change)
+
+        for label, func in (("full recompute", full_recompute), ("session delta", session_delta)):
+            p50, p99 = _percentiles(_time_calls(func, changes))
+            print(f"{num_lines:>6} {label:>22} {p50:>10.3f} {p99:>10.3f}")
+
+
+def bench_cents_pricing(runs: int, seed: int):
+    """Throughput of apply_deals_to_list's integer-cents pricing in each deal mode (properties are in test_deal_pricing.py)."""
+    import contextlib
+    import io
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    product_ids = sorted(deals_module.products_by_id_local)
+    carts = [
+        [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 12)} for _ in range(rng.randint(1, 40))]
+        for _ in range(runs)
+    ]
+
+    print(f"{'mode':>18} {'p50 ms':>10} {'p99 ms':>10} {'carts/s':>10}")
+    for mode in deals_module.DEAL_MODES:
+        def price(cart, mode=mode):
+            with contextlib.redirect_stdout(io.StringIO()):
+                deals_module.apply_deals_to_list(cart, mode=mode)
+        samples = _time_calls(price, carts)
+        p50, p99 = _percentiles(samples)
+        print(f"{mode:>18} {p50:>10.3f} {p99:>10.3f} {1000 * len(samples) / sum(samples):>10.0f}")
+
+
+def _best_bundle_savings_cents(quantity: int, bundles: list) -> int:
+    """Reference: the best total of (group_size, value_cents) bundles drawn from one line, by unbounded knapsack."""
+    best = [0] * (quantity + 1)
+    for units in range(1, quantity + 1):
+        best[units] = best[units - 1]
+        for group_size, value_cents in bundles:
+            if group_size <= units:
+                best[units] = max(best[units], best[units - group_size] + value_cents)
+    return best[quantity]
+
+
+def _check_bulk_bundle_allocation(deals_module, rng: random.Random, num_carts: int):
+    """Bulk lines where overlapping bundles interact through leftover units must still be solved exactly."""
+
+    def bundle_deal(number, group_size, value_cents, priority):
+        return {"deal_id": f"CHK{number}", "deal_name": f"Check bundle {number}", "type": "BUNDLE_THRESHOLD",
+                "applicable_product_ids": ["CHK_P1"], "category_restriction": "Check", "excluded_subcategories": [],
+                "discount_value": value_cents / 100, "discount_percentage": 0, "min_quantity_for_deal": group_size,
+                "apply_to_n_lowest_price": 1, "active": True, "priority": priority}
+
+    # 100 units at $1, '2 for 13c off' and '3 for 25c off': 2 + 32 groups (826c) beats 33 groups of the second (825c)
+    cases = [(100, [(2, 13), (3, 25)])]
+    for _ in range(num_carts):
+        cases.append((rng.randint(40, 150), [(rng.randint(2, 5), rng.randint(5, 60)) for _ in range(rng.randint(2, 3))]))
+    for quantity, bundles in cases:
+        deal_index = deals_module.compile_deal_index(
+            [bundle_deal(number, group_size, value_cents, 100 - number) for number, (group_size, value_cents) in enumerate(bundles)])
+        item = {"product_id": "CHK_P1", "quantity": quantity, "original_price": 1.0, "category": "Check", "brand": "Check",
+                "subcategory": "Check"}
+        result = deals_module.optimize_deal_allocation([item], deal_index, time_budget_ms=10_000)
+        expected = _best_bundle_savings_cents(quantity, bundles)
+        assert result['optimal'] and result['total_savings_cents'] == expected, \
+            f"{quantity} units with bundles {bundles}: {result['total_savings_cents']}c (optimal={result['optimal']}), best is {expected}c"
+    print(f"bulk bundle allocations match an exact knapsack for {len(cases)} carts: ok\n")
+
+
+def bench_deal_allocation(runs: int, seed: int):
+    import contextlib
+    import io
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    _check_bulk_bundle_allocation(deals_module, random.Random(seed), max(20, runs))
+    product_ids = sorted(deals_module.products_by_id_local)
+    categories = sorted({p['category'] for p in deals_module.products_by_id_local.values()})
+    original_deals, original_index = deals_module.deals_data_local, deals_module.DEAL_INDEX
+    print(f"{'deals':>6} {'lines':>6} {'mode':>10} {'p50 ms':>10} {'p99 ms':>10} {'optimal':>8} {'$/cart vs stacked':>17}")
+
+    try:
+        for num_deals in (25, 200):
+            if num_deals != len(original_deals):
+                calendar = _synthetic_deals(num_deals, product_ids, categories, rng)
+                deals_module.deals_data_local = calendar
+                deals_module.DEAL_INDEX = deals_module.compile_deal_index(calendar)
+            for num_lines in (20, 100):
+                carts = [
+                    [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 6)} for _ in range(num_lines)]
+                    for _ in range(runs)
+                ]
+                results = {}
+                for mode in deals_module.DEAL_MODES:
+                    results[mode] = []
+
+                    def price(cart, mode=mode):
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            results[mode].append(deals_module.apply_deals_to_list(cart, mode=mode))
+
+                    p50, p99 = _percentiles(_time_calls(price, carts))
+                    optimal = sum(r.get('allocation_optimal', True) for r in results[mode]) / len(results[mode])
+                    stacked_total = sum(r['total_after_discount'] for r in results['stacked'])
+                    mode_total = sum(r['total_after_discount'] for r in results[mode])
+                    print(f"{num_deals:>6} {num_lines:>6} {mode:>10} {p50:>10.3f} {p99:>10.3f} {optimal:>8.0%} "
+                          f"{(mode_total - stacked_total) / len(carts):>+17.2f}")
+    finally:
+        deals_module.deals_data_local, deals_module.DEAL_INDEX = original_deals, original_index
+
+
+def bench_nearly_qualifying(runs: int, seed: int):
+    import contextlib
+    import io
+    import deal_optimizer as deals_module
+
+    rng = random.Random(seed)
+    product_ids = sorted(deals_module.products_by_id_local)
+    carts = [
+        [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 3)} for _ in range(20)]
+        for _ in range(runs)
+    ]
+
+    def reprice_per_candidate(cart):
+        # The naive way: re-run the full pricing once per product that could be added
+        with contextlib.redirect_stdout(io.StringIO()):
+            base = deals_module.apply_deals_to_list(cart)['total_after_discount']
+            for product_id in product_ids:
+                deals_module.apply_deals_to_list(cart + [{"product_id": product_id, "quantity": 1}])['total_after_discount'] - base
+
+    def indexed(cart):
+        deals_module.find_nearly_qualifying_deals(cart)
+
+    # Products the availability check rejects (out of stock) are never suggested
+    unavailable = set(rng.sample(product_ids, len(product_ids) // 3))
+    suggested = [item['product_id'] for cart in carts
+                 for deal in deals_module.find_nearly_qualifying_deals(cart, is_available=lambda pid: pid not in unavailable)
+                 for item in deal['suggested_items']]
+    assert suggested and not unavailable.intersection(suggested), "An unavailable product was suggested"
+    print(f"{len(suggested)} suggestions across {len(carts)} carts, none of them unavailable: ok\n")
+
+    print(f"{'impl':>24} {'p50 ms':>10} {'p99 ms':>10}")
+    # The naive approach is ~50 full pricings per cart, so it only gets a sample of the carts
+    for label, func, inputs in (("reprice per candidate", reprice_per_candidate, carts[:max(5, runs // 10)]),
+                                ("deal index", indexed, carts)):
+        p50, p99 = _percentiles(_time_calls(func, inputs))
+        print(f"{label:>24} {p50:>10.3f} {p99:>10.3f}")
+
+
+def bench_stock_bulk(runs: int, seed: int):
+    import stock_engine
+
+    rng = random.Random(seed)
+    product_ids = sorted(stock_engine.products_by_id)
+    print(f"{'list size':>10} {'impl':>26} {'p50 ms':>10} {'p99 ms':>10}")
+    for list_size in (20, 200):
+        lists = [[rng.choice(product_ids) for _ in range(list_size)] for _ in range(runs)]
+
+        def per_item(product_id_list):
+            for product_id in product_id_list:
+                stock_engine.get_stock_status(product_id)
+
+        for label, func in (("get_stock_status per item", per_item), ("get_stock_status_bulk", stock_engine.get_stock_status_bulk)):
+            p50, p99 = _percentiles(_time_calls(func, lists))
+            print(f"{list_size:>10} {label:>26} {p50:>10.3f} {p99:>10.3f}")
+
+    print(f"\n{'catalog':>10} {'report impl':>26} {'p50 ms':>10} {'p99 ms':>10}")
+    for catalog_size in (10_000, 200_000):
+        records = [
+            {"store_id": "S001", "product_id": f"P{ordinal:07d}", "current_stock": rng.choice([0, 1, 2, 5, 20, 80]),
+             "daily_sales_rate": rng.choice([0, 1, 4, 15])}
+            for ordinal in range(catalog_size)
+        ]
+        inventory = stock_engine.ColumnarInventory(records)
+        methods = ["python"] + (["numpy"] if stock_engine.VECTORIZED_STOCK_AVAILABLE else [])
+        reports = [inventory.stock_report("S001", method=method) for method in methods]
+        assert all(report == reports[0] for report in reports), "Stock report implementations disagree"
+        for method in methods:
+            samples = _time_calls(lambda _: inventory.stock_report("S001", method=method), range(max(3, runs // 20)))
+            p50, p99 = _percentiles(samples)
+            print(f"{catalog_size:>10} {method:>26} {p50:>10.3f} {p99:>10.3f}")
+
+
+def bench_stock_journal(runs: int, seed: int):
+    """Per-decrement cost of rewriting inventory.json against journal appends, with a crash-replay check."""
+    import json
+    import os
+    import tempfile
+    import threading
+    import stock_engine
+
+    rng = random.Random(seed)
+    keys = sorted(stock_engine.inventory_by_store_product)
+    saved_paths = (stock_engine.INVENTORY_FILE, stock_engine.STOCK_JOURNAL_FILE,
+                   stock_engine.STOCK_JOURNAL_COMPACTING_FILE, stock_engine.STOCK_JOURNAL)
+    saved_stock = {key: record['current_stock'] for key, record in stock_engine.inventory_by_store_product.items()}
+    service = stock_engine.INVENTORY_SERVICE
+    saved_service_state = (service.journal, service._snapshot_position)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stock_engine.INVENTORY_FILE = os.path.join(temp_dir, "inventory.json")
+        stock_engine.STOCK_JOURNAL_FILE = os.path.join(temp_dir, "inventory_journal.jsonl")
+        stock_engine.STOCK_JOURNAL_COMPACTING_FILE = stock_engine.STOCK_JOURNAL_FILE + ".compacting"
+        stock_engine.STOCK_JOURNAL = stock_engine.StockJournal(stock_engine.STOCK_JOURNAL_FILE)
+        service.journal = stock_engine.STOCK_JOURNAL
+        try:
+            def full_rewrite(key):
+                # Reference: the original path, serializing the whole map on every decrement
+                record = stock_engine.inventory_by_store_product[key]
+                record['current_stock'] = max(0, record['current_stock'] - 1)
+                with open(stock_engine.INVENTORY_FILE, 'w', encoding='utf-8') as f:
+                    json.dump(list(stock_engine.inventory_by_store_product.values()), f, indent=2)
+
+            def journaled(key):
+                stock_engine.update_product_stock(key[1], 1, key[0])
+
+            print(f"{'impl':>28} {'p50 ms':>10} {'p99 ms':>10}")
+            for label, func in (("full rewrite per decrement", full_rewrite), ("journal append + fsync", journaled)):
+                p50, p99 = _percentiles(_time_calls(func, [rng.choice(keys) for _ in range(runs)]))
+                print(f"{label:>28} {p50:>10.3f} {p99:>10.3f}")
+
+            print(f"\n{'threads':>8} {'decrements':>11} {'fsyncs':>8} {'decrements/s':>14}")
+            for num_threads in (1, 8, 32):
+                fsyncs_before = stock_engine.STOCK_JOURNAL.fsyncs
+                per_thread = max(1, runs // 4)
+                work = [[rng.choice(keys) for _ in range(per_thread)] for _ in range(num_threads)]
+                threads = [threading.Thread(target=lambda batch=batch: [journaled(key) for key in batch]) for batch in work]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                decrements = num_threads * per_thread
+                print(f"{num_threads:>8} {decrements:>11} {stock_engine.STOCK_JOURNAL.fsyncs - fsyncs_before:>8} {decrements / elapsed:>14.0f}")
+
+            # Crash check: snapshot + journal replayed from disk must equal the in-memory state
+            expected = {key: record['current_stock'] for key, record in stock_engine.inventory_by_store_product.items()}
+            stock_engine.compact_inventory()
+            for key in keys[:50]:
+                journaled(key)
+                expected[key] = stock_engine.inventory_by_store_product[key]['current_stock']
+            with open(stock_engine.INVENTORY_FILE, 'r', encoding='utf-8') as f:
+                for record in json.load(f):
+                    stock_engine.inventory_by_store_product[(record['store_id'], record['product_id'])]['current_stock'] = record['current_stock']
+            stock_engine._replay_journal_file(stock_engine.STOCK_JOURNAL_FILE)
+            replayed = {key: record['current_stock'] for key, record in stock_engine.inventory_by_store_product.items()}
+            assert replayed == expected, "Snapshot + journal replay does not reproduce the in-memory inventory"
+            print("\nsnapshot + journal replay reproduces in-memory stock: ok")
+        finally:
+            stock_engine.STOCK_JOURNAL.close()
+            (stock_engine.INVENTORY_FILE, stock_engine.STOCK_JOURNAL_FILE,
+             stock_engine.STOCK_JOURNAL_COMPACTING_FILE, stock_engine.STOCK_JOURNAL) = saved_paths
+            # The reference writes and the replay bypass the stock listeners, so rebuild what they keep current
+            service.journal = None
+            for (store_id, product_id), stock in saved_stock.items():
+                service.set_stock(product_id, stock, store_id)
+                stock_engine.SUBSTITUTION_GRAPH.invalidate(store_id, product_id)
+            with stock_engine._substitute_index_lock:
+                for store_id in {store_id for store_id, _ in saved_stock}:
+                    stock_engine._refresh_best_substitutes(store_id, stock_engine.ranked_substitutes_by_original_id)
+            service.journal, service._snapshot_position = saved_service_state
+
+
+def bench_stock_reservations(runs: int, seed: int):
+    """Oversell checks for the reservation API, then throughput and lock contention by stripe count."""
+    import threading
+    import stock_engine
+
+    rng = random.Random(seed)
+
+    def synthetic_records(num_products: int, stock_choices: tuple) -> dict:
+        return {("S001", f"P{ordinal:05d}"): {"store_id": "S001", "product_id": f"P{ordinal:05d}",
+                                             "current_stock": rng.choice(stock_choices), "daily_sales_rate": 1}
+                for ordinal in range(num_products)}
+
+    def run_threads(num_threads: int, worker) -> float:
+        threads = [threading.Thread(target=worker, args=(thread_index,)) for thread_index in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    # 1. Scarce stock: 32 threads race for a few units of 20 products with multi-item baskets
+    records = synthetic_records(20, (1, 2, 3))
+    initial_stock = {key: record['current_stock'] for key, record in records.items()}
+    service = stock_engine.InventoryService(records)
+    product_ids = [key[1] for key in records]
+    committed = [{} for _ in range(32)]
+
+    def checkout_worker(thread_index):
+        worker_rng = random.Random(seed * 1000 + thread_index)
+        for _ in range(max(1, runs // 10)):
+            basket = {product_id: worker_rng.randint(1, 2) for product_id in worker_rng.sample(product_ids, 2)}
+            outcome = worker_rng.random()
+            ttl_seconds = 0.001 if outcome >= 0.8 else 60 # abandoned checkouts rely on the TTL to hand units back
+            reservation = service.reserve(basket, "S001", ttl_seconds=ttl_seconds)
+            if not reservation['success']:
+                continue
+            if outcome < 0.6:
+                if service.commit(reservation['reservation_id'])['success']:
+                    for product_id, quantity in basket.items():
+                        committed[thread_index][product_id] = committed[thread_index].get(product_id, 0) + quantity
+            elif outcome < 0.8:
+                service.release(reservation['reservation_id'])
+
+    run_threads(32, checkout_worker)
+    time.sleep(0.01)
+    service.expire_reservations()
+    for key, record in records.items():
+        sold = sum(per_thread.get(key[1], 0) for per_thread in committed)
+        assert sold <= initial_stock[key], f"Oversold {key}: {sold} sold from {initial_stock[key]}"
+        assert record['current_stock'] == initial_stock[key] - sold, f"Stock for {key} does not match committed sales"
+        assert service.available(key[1], "S001") == record['current_stock'], f"Holds leaked for {key}"
+    units_sold = sum(sum(per_thread.values()) for per_thread in committed)
+    print(f"scarce stock: {units_sold} of {sum(initial_stock.values())} units sold, no oversell, no leaked holds: ok")
+
+    # Holds against everything else that touches stock
+    records = {("S001", "P00000"): {"store_id": "S001", "product_id": "P00000", "current_stock": 5, "daily_sales_rate": 1}}
+    service = stock_engine.InventoryService(records)
+    for bad_ttl in ("soon", -1, float('nan')):
+        try:
+            service.reserve({"P00000": 2}, "S001", ttl_seconds=bad_ttl)
+            raise AssertionError(f"ttl_seconds={bad_ttl!r} was accepted")
+        except ValueError:
+            pass
+    assert service.available("P00000", "S001") == 5, "A rejected reservation left units on hold"
+    reservation = service.reserve({"P00000": 3}, "S001")
+    assert service.decrement("P00000", 4, "S001") == 3, "A direct sale took units held by a reservation"
+    assert service.commit(reservation['reservation_id'])['success'] and records[("S001", "P00000")]['current_stock'] == 0
+    service.set_stock("P00000", 4, "S001")
+    reservation = service.reserve({"P00000": 3}, "S001")
+    service.set_stock("P00000", 1, "S001") # a stock count finds fewer units than are held
+    result = service.commit(reservation['reservation_id'])
+    assert not result['success'] and result['shortages'], "A reservation was committed past the stock on hand"
+    assert records[("S001", "P00000")]['current_stock'] == 1 and service.available("P00000", "S001") == 1
+    store_key = (stock_engine.DEFAULT_STORE_ID, next(iter(stock_engine.products_by_id)))
+    store_record = stock_engine.inventory_by_store_product.get(store_key)
+    if store_record and store_record['current_stock'] > 0:
+        held = stock_engine.INVENTORY_SERVICE.reserve({store_key[1]: store_record['current_stock']}, store_key[0])
+        try:
+            assert stock_engine.get_stock_status(store_key[1], store_key[0])['status'] == "Out of Stock"
+            assert stock_engine.get_stock_status_bulk([store_key[1]], store_key[0])[store_key[1]]['status'] == "Out of Stock"
+            assert store_key[1] in stock_engine.get_store_stock_report(store_key[0], limit=None)['out_of_stock']
+        finally:
+            stock_engine.INVENTORY_SERVICE.release(held['reservation_id'])
+    # A fully reserved substitute is no longer offered, and comes back when the hold is released
+    store_id = stock_engine.DEFAULT_STORE_ID
+    best_by_original = stock_engine.best_substitute_by_store.get(store_id, {})
+    original_product_id = next(iter(sorted(best_by_original)), None)
+    if original_product_id:
+        substitute_id = best_by_original[original_product_id].product_id
+        held = stock_engine.INVENTORY_SERVICE.reserve(
+            {substitute_id: stock_engine.INVENTORY_SERVICE.available(substitute_id, store_id)}, store_id)
+        try:
+            match = stock_engine.find_smart_substitute(original_product_id, store_id)
+            assert match is None or match.product_id != substitute_id, "A fully reserved substitute was offered"
+            assert match is None or stock_engine.get_stock_status(match.product_id, store_id)['status'] != "Out of Stock"
+        finally:
+            stock_engine.INVENTORY_SERVICE.release(held['reservation_id'])
+        assert stock_engine.find_smart_substitute(original_product_id, store_id).product_id == substitute_id
+    print("bad TTLs rejected without holds, direct sales and stock counts respect holds, statuses net of holds: ok")
+    print("fully reserved substitutes are not offered until their holds are released: ok")
+
+    # 2. Throughput: reserve + commit of 1-3 items over a large catalog, one global lock against stripes
+    print(f"\n{'stripes':>8} {'threads':>8} {'checkouts/s':>12} {'contended %':>12}")
+    for num_stripes in (1, stock_engine.INVENTORY_LOCK_STRIPES):
+        for num_threads in (1, 8, 32):
+            records = synthetic_records(5000, (10_000,))
+            service = stock_engine.InventoryService(records, num_stripes=num_stripes)
+            product_ids = [key[1] for key in records]
+            per_thread = max(1, runs * 4 // num_threads)
+
+            def throughput_worker(thread_index):
+                worker_rng = random.Random(seed * 1000 + thread_index)
+                for _ in range(per_thread):
+                    basket = {product_id: 1 for product_id in worker_rng.sample(product_ids, worker_rng.randint(1, 3))}
+                    reservation = service.reserve(basket, "S001")
+                    service.commit(reservation['reservation_id'])
+
+            elapsed = run_threads(num_threads, throughput_worker)
+            stats = service.stats()
+            contended = 100 * stats['contended_acquires'] / max(1, stats['lock_acquires'])
+            print(f"{num_stripes:>8} {num_threads:>8} {num_threads * per_thread / elapsed:>12.0f} {contended:>12.2f}")
+
+
+def bench_stream_parser(runs: int, seed: int):
+    """Checks incremental list-item parsing against json.loads under random chunking, then how early items arrive."""
+    import json
+    from stream_utils import ListItemStreamParser
+
+    rng = random.Random(seed)
+    reasons = ["", "Party staple", 'Says "bring {extra} chips"', "Backslash \\ and [brackets]"]
+
+    def model_response(num_items: int) -> tuple:
+        items = [{"product_id": f"WMK_P{rng.randint(1, 200):03d}", "quantity": rng.randint(1, 4), "reason": rng.choice(reasons)}
+                 for _ in range(num_items)]
+        response = {"action": "new_list", "note": '"list_items": [{}]', "list_items": items, "meta": {"list_items": [{}]}}
+        return items, json.dumps(response, indent=rng.choice([None, 2]))
+
+    for _ in range(runs * 10):
+        items, text = model_response(rng.randint(0, 12))
+        parser, parsed_items, position = ListItemStreamParser(), [], 0
+        while position < len(text):
+            chunk_size = rng.randint(1, 40)
+            parsed_items.extend(parser.feed(text[position:position + chunk_size]))
+            position += chunk_size
+        assert parsed_items == items and json.loads(parser.text)["list_items"] == items, "Streamed items differ from json.loads"
+    print(f"incremental parser matches json.loads on {runs * 10} randomly chunked responses: ok")
+
+    # A model streaming ~40-character chunks: where in the response does each item become available?
+    print(f"\n{'items':>6} {'chunks':>7} {'first item at chunk':>20} {'last item at chunk':>19}")
+    for num_items in (5, 20, 50):
+        _, text = model_response(num_items)
+        chunks = [text[position:position + 40] for position in range(0, len(text), 40)]
+        parser, arrivals = ListItemStreamParser(), []
+        for chunk_number, chunk in enumerate(chunks, start=1):
+            arrivals.extend([chunk_number] * len(parser.feed(chunk)))
+        print(f"{num_items:>6} {len(chunks):>7} {arrivals[0]:>20} {arrivals[-1]:>19}")
+
+    def parse_in_chunks(text):
+        parser = ListItemStreamParser()
+        for position in range(0, len(text), 40):
+            parser.feed(text[position:position + 40])
+
+    samples = _time_calls(parse_in_chunks, [model_response(30)[1] for _ in range(runs)])
+    p50, p99 = _percentiles(samples)
+    print(f"\nparse a 30-item response in 40-char chunks: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+
+
+def bench_retrieval(runs: int, seed: int):
+    """Prompt catalog size with full-catalog grounding against BM25 retrieval, retrieval latency and recall."""
+    import product_retriever
+
+    rng = random.Random(seed)
+    base_products = product_retriever.products_data_retrieval
+
+    # Recall: a product's own name and brand should retrieve it within the prompt budget
+    retriever = product_retriever.PRODUCT_RETRIEVER
+    top_n = product_retriever.RETRIEVAL_TOP_N
+    hits = sum(1 for product in base_products
+               if product in retriever.retrieve(f"{product['brand']} {product['product_name']}", top_n, pad=False))
+    print(f"recall@{top_n} for name+brand queries: {hits}/{len(base_products)}")
+    assert hits == len(base_products), "A product is not retrieved by its own name and brand"
+
+    def catalog_line(product):
+        return f"- {product['product_name']} (ID: {product['product_id']}, Category: {product['category']})\n"
+
+    queries = ["taco night", "weekly groceries with eggs and milk", "fragrance free body wash", "bbq snacks and cola",
+               "laundry detergent", "something for breakfast", "cleaning supplies for the kitchen"]
+    print(f"\n{'catalog':>8} {'full prompt chars':>18} {'retrieved chars':>16} {'p50 ms':>8} {'p99 ms':>8}")
+    for catalog_size in (200, 2000, 20000):
+        products = [dict(rng.choice(base_products), product_id=f"SYN{ordinal:06d}") for ordinal in range(catalog_size)]
+        synthetic_retriever = product_retriever.ProductRetriever(products)
+        full_chars = sum(len(catalog_line(product)) for product in products)
+        samples = _time_calls(lambda query: synthetic_retriever.retrieve(query, top_n), [rng.choice(queries) for _ in range(runs)])
+        retrieved_chars = max(sum(len(catalog_line(product)) for product in synthetic_retriever.retrieve(query, top_n))
+                              for query in queries)
+        p50, p99 = _percentiles(samples)
+        print(f"{catalog_size:>8} {full_chars:>18} {retrieved_chars:>16} {p50:>8.3f} {p99:>8.3f}")
+
+
+def _find_substitute_by_sorting(original_product_id: str, store_id: str):
+    """Reference: the original lookup, re-sorting candidates and checking stock status one by one on every call."""
+    import stock_engine
+
+    potential_substitutes = stock_engine.substitutions_by_original_id.get(original_product_id, [])
+    for sub_info in sorted(potential_substitutes, key=lambda x: x.get('substitution_score', 0), reverse=True):
+        if sub_info['substitute_product_id'] not in stock_engine.products_by_id:
+            continue
+        if stock_engine.get_stock_status(sub_info['substitute_product_id'], store_id)['status'] in ["In Stock", "Low Stock"]:
+            return (sub_info['substitute_product_id'], sub_info['substitution_score'], sub_info['reason'])
+    return None
+
+
+def bench_substitutes(runs: int, seed: int):
+    """Checks the precomputed best-substitute index against the sorting lookup while stock changes, then times both."""
+    import stock_engine
+
+    rng = random.Random(seed)
+    service = stock_engine.INVENTORY_SERVICE
+    saved_journal, service.journal = service.journal, None # benchmark stock changes stay in memory
+    saved_stock = {key: record['current_stock'] for key, record in stock_engine.inventory_by_store_product.items()}
+    originals = sorted(stock_engine.ranked_substitutes_by_original_id)
+    candidate_keys = sorted(key for key in stock_engine.inventory_by_store_product
+                            if key[1] in stock_engine.originals_by_substitute_id)
+    store_ids = sorted({key[0] for key in stock_engine.inventory_by_store_product})
+
+    def check_all():
+        for store_id in store_ids:
+            for original_product_id in originals:
+                match = stock_engine.find_smart_substitute(original_product_id, store_id, max_hops=1)
+                found = None if match is None else (match.product_id, match.substitution_score, match.substitution_reason)
+                assert found == _find_substitute_by_sorting(original_product_id, store_id), \
+                    f"Index disagrees for {original_product_id} at {store_id}"
+
+    try:
+        check_all()
+        for _ in range(runs):
+            store_id, product_id = rng.choice(candidate_keys)
+            if rng.random() < 0.5:
+                service.set_stock(product_id, rng.choice([0, 0, 1, 5]), store_id)
+            else:
+                service.decrement(product_id, rng.randint(1, 3), store_id)
+            check_all()
+        print(f"index matches the sorting lookup for {len(originals)} products x {len(store_ids)} stores "
+              f"across {runs} stock changes: ok")
+
+        lookups = [(rng.choice(originals), rng.choice(store_ids)) for _ in range(runs * 20)]
+        print(f"\n{'impl':>24} {'p50 us':>10} {'p99 us':>10}")
+        for label, func in (("sort + status per call", _find_substitute_by_sorting),
+                            ("best-substitute index", lambda *args: stock_engine.find_smart_substitute(*args, max_hops=1))):
+            samples = _time_calls(lambda args: func(*args), lookups)
+            p50, p99 = _percentiles(samples)
+            print(f"{label:>24} {p50 * 1000:>10.2f} {p99 * 1000:>10.2f}")
+        rescued = sum(1 for store_id in store_ids for original_product_id in originals
+                      if stock_engine.find_smart_substitute(original_product_id, store_id, max_hops=1) is None
+                      and stock_engine.find_smart_substitute(original_product_id, store_id) is not None)
+        print(f"\nproducts with no direct substitute in stock that the graph search still covers: {rescued}")
+    finally:
+        for (store_id, product_id), stock in saved_stock.items():
+            service.set_stock(product_id, stock, store_id)
+        service.journal = saved_journal
+
+    _bench_substitution_graph(runs, seed)
+
+
+def _best_chain_score(graph, original_product_id: str, store_id: str, max_hops: int, min_score: float) -> float | None:
+    """Reference: the best chained score over every simple path, by exhaustive depth-first search."""
+    best = None
+    stack = [(original_product_id, 1.0, (original_product_id,))]
+    while stack:
+        product_id, score, path = stack.pop()
+        for match in graph.ranked_substitutes.get(product_id, ()):
+            chained_score = score * match.substitution_score
+            if match.product_id in path or chained_score < min_score:
+                continue
+            if graph.is_available(store_id, match.product_id):
+                best = chained_score if best is None else max(best, chained_score)
+            if len(path) < max_hops:
+                stack.append((match.product_id, chained_score, path + (match.product_id,)))
+    return best
+
+
+def _bench_substitution_graph(runs: int, seed: int):
+    """Multi-hop search on a synthetic catalog: exhaustive-search agreement, cache invalidation and timings."""
+    import stock_engine
+
+    rng = random.Random(seed)
+    product_ids = [f"P{ordinal:05d}" for ordinal in range(5000)]
+    ranked = {}
+    for product_id in product_ids:
+        edges = [(rng.choice(product_ids), round(rng.uniform(0.5, 0.99), 2)) for _ in range(rng.randint(1, 4))]
+        edges = [(target, score) for target, score in dict(edges).items() if target != product_id]
+        edges.sort(key=lambda edge: edge[1], reverse=True)
+        ranked[product_id] = tuple(stock_engine.SubstituteMatch(target, product_id, score, "synthetic") for target, score in edges)
+    available = {product_id: rng.random() < 0.3 for product_id in product_ids}
+    graph = stock_engine.SubstitutionGraph(ranked, lambda store_id, product_id: available[product_id])
+    max_hops, min_score = stock_engine.SUBSTITUTE_MAX_HOPS, stock_engine.SUBSTITUTE_MIN_SCORE
+
+    for step in range(runs * 5):
+        original_product_id = rng.choice(product_ids)
+        match = graph.find(original_product_id, "S001")
+        expected = _best_chain_score(graph, original_product_id, "S001", max_hops, min_score)
+        found = None if match is None else match.substitution_score
+        assert (found is None) == (expected is None) and (found is None or abs(found - expected) < 1e-3), \
+            f"Graph search disagrees with exhaustive search for {original_product_id}: {found} vs {expected}"
+        assert match == graph.search(original_product_id, "S001")[0], "Cached result is stale"
+        flipped = rng.choice(product_ids)
+        available[flipped] = not available[flipped]
+        graph.invalidate("S001", flipped)
+    print(f"graph search matches exhaustive search and stays fresh across {runs * 5} availability flips: ok")
+
+    popular_product_ids = rng.sample(product_ids, 200) # lists keep asking for the same out-of-stock staples
+    lookups = [rng.choice(popular_product_ids) for _ in range(runs * 20)]
+    print(f"\n{'multi-hop impl':>24} {'p50 us':>10} {'p99 us':>10}")
+    for label, func in (("uncached search", lambda product_id: graph.search(product_id, "S001")),
+                        ("memoized find", lambda product_id: graph.find(product_id, "S001"))):
+        p50, p99 = _percentiles(_time_calls(func, lookups))
+        print(f"{label:>24} {p50 * 1000:>10.2f} {p99 * 1000:>10.2f}")
+    print(f"cache: {graph.stats()}")
+
+
+BENCHMARKS = {
+    "batch-routes": bench_batch_routes,
+    "bulk-bogo": bench_bulk_bogo,
+    "cart-session": bench_cart_session,
+    "cents-pricing": bench_cents_pricing,
+    "chat-history": bench_chat_history,
+    "deal-allocation": bench_deal_allocation,
+    "deal-index": bench_deal_index,
+    "fbt-build": bench_fbt_build,
+    "llm-cache": bench_llm_cache,
+    "llm-client": bench_llm_client,
+    "navigator": bench_navigator,
+    "nearly-qualifying": bench_nearly_qualifying,
+    "retrieval": bench_retrieval,
+    "route-solvers": bench_route_solvers,
+    "stock-bulk": bench_stock_bulk,
+    "stock-journal": bench_stock_journal,
+    "stock-reservations": bench_stock_reservations,
+    "stream-parser": bench_stream_parser,
+    "substitutes": bench_substitutes,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backend micro-benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("--runs", type=int, default=200, help="Samples per configuration.")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+
+    selected = sorted(BENCHMARKS) if args.benchmark == "all" else [args.benchmark]
+    for name in selected:
+        print(f"\n=== {name} ===")
+        BENCHMARKS[name](args.runs, args.seed)
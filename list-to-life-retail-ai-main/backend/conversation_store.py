@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+import time
+
+from cache_utils import LRUTTLCache
+
+# Chat history lives on the server, keyed by the session's chat_id, so the session cookie only carries that id
+# and each request appends and returns a fixed number of turns however long the conversation gets.
+CONVERSATION_MAX_SESSIONS = int(os.getenv('CONVERSATION_MAX_SESSIONS', 10000)) # conversations kept in memory
+CONVERSATION_TTL_SECONDS = int(os.getenv('CONVERSATION_TTL_SECONDS', 24 * 3600)) # idle time before one is dropped
+CONVERSATION_MAX_TURNS = 200 # turns kept per conversation; older ones are trimmed
+CONVERSATION_PROMPT_TURNS = 8 # most recent turns sent to the model verbatim
+CONVERSATION_SUMMARY_REQUESTS = 5 # earlier user requests named in the summary of older turns
+CONVERSATION_SUMMARY_CHARS = 100 # each one shortened to this length
+
+
+class _Conversation:
+    __slots__ = ("offset", "turns")
+
+    def __init__(self, offset: int = 0, turns: list = None):
+        self.offset = offset # number of turns trimmed from the front; turns[0] is turn number offset
+        self.turns = turns or []
+
+    @property
+    def turn_count(self) -> int:
+        return self.offset + len(self.turns)
+
+
+class ConversationStore:
+    """
+    Chat turns per session: an in-memory LRU with a TTL, optionally written through to SQLite (db_path)
+    so conversations survive restarts and evictions. Turns are numbered from 0 for the life of the
+    conversation; clients that keep a copy can ask for the turns from a number on instead of all of them.
+    """
+
+    def __init__(self, db_path: str = None, max_sessions: int = CONVERSATION_MAX_SESSIONS,
+                 ttl_seconds: float = CONVERSATION_TTL_SECONDS, max_turns: int = CONVERSATION_MAX_TURNS):
+        self.max_turns = max_turns
+        self.db_path = db_path
+        self._conversations = LRUTTLCache(max_entries=max_sessions, ttl_seconds=ttl_seconds)
+        # One lock for loads and appends: a conversation evicted and reloaded mid-append could otherwise
+        # lose turns or reuse turn numbers. Chat requests spend far longer waiting on the model.
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_turns (session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+                "text TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+            )
+            self._db.commit()
+
+    def _load(self, session_id: str) -> _Conversation:
+        """The conversation from memory, else from the database (its last max_turns turns), else a new one."""
+        conversation = self._conversations.get(session_id)
+        if conversation is not None:
+            return conversation
+        conversation = _Conversation()
+        if self._db is not None:
+            rows = self._db.execute(
+                "SELECT seq, role, text FROM chat_turns WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, self.max_turns)
+            ).fetchall()
+            if rows:
+                rows.reverse()
+                conversation = _Conversation(rows[0][0], [{"role": role, "text": text} for _, role, text in rows])
+        self._conversations.set(session_id, conversation)
+        return conversation
+
+    def append(self, session_id: str, turns: list) -> int:
+        """Adds turns ({'role', 'text'} dicts) to a conversation and returns the number of the first one."""
+        with self._lock:
+            conversation = self._load(session_id)
+            first_turn = conversation.turn_count
+            new_turns = [{"role": turn["role"], "text": turn["text"]} for turn in turns]
+            conversation.turns.extend(new_turns)
+            overflow = len(conversation.turns) - self.max_turns
+            if overflow > 0:
+                del conversation.turns[:overflow]
+                conversation.offset += overflow
+            if self._db is not None:
+                now = time.time()
+                self._db.executemany(
+                    "INSERT INTO chat_turns (session_id, seq, role, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                    [(session_id, first_turn + i, turn["role"], turn["text"], now) for i, turn in enumerate(new_turns)]
+                )
+                if overflow > 0:
+                    self._db.execute("DELETE FROM chat_turns WHERE session_id = ? AND seq < ?", (session_id, conversation.offset))
+                self._db.commit()
+            self._conversations.set(session_id, conversation) # refreshes the TTL
+            return first_turn
+
+    def history(self, session_id: str, since: int = 0) -> dict:
+        """
+        Turns numbered since and later. If earlier turns were trimmed, 'since' in the result is the
+        first number still kept.
+
+        Returns:
+            dict: {'since', 'turn_count', 'turns'}
+        """
+        with self._lock:
+            conversation = self._load(session_id)
+            start = max(since, conversation.offset)
+            turns = conversation.turns[start - conversation.offset:]
+            return {"since": start, "turn_count": conversation.turn_count, "turns": turns}
+
+    def window(self, session_id: str, recent_turns: int = CONVERSATION_PROMPT_TURNS) -> dict:
+        """
+        What a prompt needs from the conversation: the last recent_turns turns verbatim, plus a short summary
+        of the ones before them (their count and the user's latest earlier requests), so prompt size stays
+        bounded however long the conversation runs.
+
+        Returns:
+            dict: {'summary': str ('' when nothing is left out), 'turns': list}
+        """
+        with self._lock:
+            conversation = self._load(session_id)
+            split = max(0, len(conversation.turns) - recent_turns)
+            recent = conversation.turns[split:]
+            earlier_count = conversation.offset + split
+            if not earlier_count:
+                return {"summary": "", "turns": recent}
+            earlier_requests = []
+            for turn in reversed(conversation.turns[:split]):
+                if turn["role"] == "user":
+                    text = " ".join(turn["text"].split())
+                    if len(text) > CONVERSATION_SUMMARY_CHARS:
+                        text = text[:CONVERSATION_SUMMARY_CHARS - 3] + "..."
+                    earlier_requests.append(f"'{text}'")
+                    if len(earlier_requests) == CONVERSATION_SUMMARY_REQUESTS:
+                        break
+        summary = f"{earlier_count} earlier messages are not shown."
+        if earlier_requests:
+            summary += " The user's most recent earlier requests were: " + "; ".join(reversed(earlier_requests)) + "."
+        return {"summary": summary, "turns": recent}
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._conversations.pop(session_id)
+            if self._db is not None:
+                self._db.execute("DELETE FROM chat_turns WHERE session_id = ?", (session_id,))
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        stats = self._conversations.stats()
+        stats.update({"max_turns": self.max_turns, "db_path": self.db_path})
+        return stats
+
+
+def create_conversation_store() -> ConversationStore:
+    """Builds the store from the environment: CONVERSATION_DB names a SQLite file to persist conversations to."""
+    return ConversationStore(db_path=os.getenv('CONVERSATION_DB') or None)
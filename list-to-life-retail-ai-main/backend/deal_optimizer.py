@@ -1,5 +1,9 @@
 import json
-import math 
+import operator
+import os
+import threading
+import time
+from array import array
 
 def load_data_local(filename):
     """Helper function to load JSON data locally."""
@@ -13,190 +17,985 @@ def load_data_local(filename):
         print(f"Error (deal_optimizer.py): Could not decode JSON from '{filename}'.")
         return []
 
+DEALS_FILE = 'deals.json'
+
+def _get_file_mtime(filename):
+    """Returns the modification time of a file, or None if it does not exist."""
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
 products_data_local = load_data_local('products.json')
 products_by_id_local = {p['product_id']: p for p in products_data_local}
-deals_data_local = load_data_local('deals.json')
+deals_data_local = load_data_local(DEALS_FILE)
+deals_mtime = _get_file_mtime(DEALS_FILE)
 
 deals_data_local.sort(key=lambda d: d.get('priority', 0), reverse=True)
 
+# Deal types that fire on specific product IDs vs. on a whole category
+PRODUCT_DEAL_TYPES = ("BOGO", "FIXED_AMOUNT_ITEM", "PERCENTAGE_ITEM", "BUNDLE_THRESHOLD")
+CATEGORY_DEAL_TYPES = ("PERCENTAGE_CATEGORY",)
+SET_DEAL_TYPES = ("BOGO", "BUNDLE_THRESHOLD") # deals that need a minimum quantity and consume units in groups
+
+
+def compile_deal_index(deals: list) -> dict:
+    """
+    Compiles deals into inverted indexes so a cart only visits deals that can fire for it.
+
+    Args:
+        deals (list): Deals already sorted by descending priority.
+
+    Returns:
+        dict: {
+            'deals': active deals in priority order (position = deal ordinal),
+            'applicable_ids': frozenset of applicable_product_ids per deal ordinal,
+            'cheapest_products': (price, product_id) pairs by ascending price per BOGO/BUNDLE deal ordinal,
+            'by_product': {product_id: [deal ordinals]},
+            'by_category': {category: [deal ordinals]},
+            'by_brand': {brand: [deal ordinals]} for deals with a brand_restriction
+        }
+    """
+    active_deals = [deal for deal in deals if deal.get('active', False)]
+    applicable_ids = [frozenset(deal.get('applicable_product_ids') or ()) for deal in active_deals]
+    by_product, by_category, by_brand = {}, {}, {}
+
+    for ordinal, deal in enumerate(active_deals):
+        if deal['type'] in PRODUCT_DEAL_TYPES:
+            for product_id in applicable_ids[ordinal]:
+                by_product.setdefault(product_id, []).append(ordinal)
+        elif deal['type'] in CATEGORY_DEAL_TYPES and deal.get('category_restriction'):
+            by_category.setdefault(deal['category_restriction'], []).append(ordinal)
+        if deal.get('brand_restriction'):
+            by_brand.setdefault(deal['brand_restriction'], []).append(ordinal)
+
+    # Cheapest way to add units towards each threshold deal: its products by ascending price
+    cheapest_products = [
+        tuple(sorted(
+            (products_by_id_local[product_id]['price'], product_id)
+            for product_id in applicable_ids[ordinal] if product_id in products_by_id_local
+        )) if deal['type'] in SET_DEAL_TYPES else ()
+        for ordinal, deal in enumerate(active_deals)
+    ]
+
+    return {
+        "deals": active_deals,
+        "applicable_ids": applicable_ids,
+        "cheapest_products": cheapest_products,
+        "by_product": by_product,
+        "by_category": by_category,
+        "by_brand": by_brand
+    }
+
+
+DEAL_INDEX = compile_deal_index(deals_data_local)
+
+
+def refresh_deal_index(force: bool = False) -> bool:
+    """
+    Reloads deals.json and recompiles the deal index if the file changed on disk.
+
+    Returns:
+        bool: True if the deals were reloaded.
+    """
+    global deals_data_local, deals_mtime, DEAL_INDEX
+
+    current_mtime = _get_file_mtime(DEALS_FILE)
+    if not force and current_mtime == deals_mtime:
+        return False
+
+    new_deals = load_data_local(DEALS_FILE)
+    new_deals.sort(key=lambda d: d.get('priority', 0), reverse=True)
+    DEAL_INDEX = compile_deal_index(new_deals)
+    deals_data_local = new_deals
+    deals_mtime = current_mtime
+    print(f"DEBUG (deal_optimizer.py): Recompiled deal index for {len(DEAL_INDEX['deals'])} active deals.")
+    return True
+
+
+def _deal_matches_item(deal_index: dict, ordinal: int, item: dict) -> bool:
+    """Whether an item counts towards a deal, using the same rules as before indexing."""
+    deal = deal_index['deals'][ordinal]
+    if deal['type'] in PRODUCT_DEAL_TYPES:
+        return item['product_id'] in deal_index['applicable_ids'][ordinal]
+    if deal['type'] in CATEGORY_DEAL_TYPES:
+        return item['category'] == deal['category_restriction'] and \
+            (not deal.get('excluded_subcategories') or item['subcategory'] not in deal['excluded_subcategories'])
+    return False
+
+
+def match_deals_to_items(items: list, deal_index: dict = None) -> dict:
+    """
+    Finds the deals that can fire for a cart via the inverted indexes.
+
+    Returns:
+        dict: {deal ordinal: [matching items in cart order]}, only for deals with at least one match.
+    """
+    deal_index = deal_index or DEAL_INDEX
+    by_product, by_category, by_brand = deal_index['by_product'], deal_index['by_category'], deal_index['by_brand']
+    matched = {}
+    for item in items:
+        candidates = set(by_product.get(item['product_id'], ()))
+        candidates.update(by_category.get(item['category'], ()))
+        candidates.update(by_brand.get(item['brand'], ()))
+        for ordinal in candidates:
+            if _deal_matches_item(deal_index, ordinal, item):
+                matched.setdefault(ordinal, []).append(item)
+    return matched
+
+
+def allocate_bogo_free_units(deal: dict, matched_items: list) -> list:
+    """
+    Works out which units a BOGO deal makes free without expanding lines into units.
+    Every complete set of min_quantity_for_deal units frees apply_to_n_lowest_price units,
+    taken from the cheapest lines first (ties keep cart order).
+
+    Returns:
+        list: (item, free_units) pairs for lines that receive free units.
+    """
+    min_quantity = deal['min_quantity_for_deal']
+    total_units = sum(item['quantity'] for item in matched_items)
+    units_left_to_free = min(total_units, (total_units // min_quantity) * deal['apply_to_n_lowest_price'])
+
+    free_units_by_item = []
+    for item in sorted(matched_items, key=lambda x: x['original_price']):
+        if units_left_to_free <= 0:
+            break
+        free_units = min(units_left_to_free, item['quantity'])
+        if free_units > 0:
+            free_units_by_item.append((item, free_units))
+            units_left_to_free -= free_units
+    return free_units_by_item
+
+
+# --- Exclusive deal allocation ---
+# In 'exclusive' mode every purchased unit can be claimed by at most one deal, and the
+# allocation that minimises the basket total is searched for instead of stacking by priority.
+DEAL_MODES = ("stacked", "exclusive")
+DEAL_ALLOCATION_TIME_BUDGET_MS = 15 # leaves headroom for matching and pricing within a 20ms checkout call
+DEAL_SEARCH_MAX_BRANCHES = 32 # set deals with fewer possible groups than this have every group count tried
+DEAL_SEARCH_BREAKPOINT_SLACK = 2
+
+
+class _DealSearchTimeout(Exception):
+    pass
+
+
+def _to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+price_cents_by_product_local = {product_id: _to_cents(product['price']) for product_id, product in products_by_id_local.items()}
+
+
+def _basis_points(percentage: float) -> int:
+    return int(round(percentage * 100))
+
+
+def _percentage_of_cents(amount_cents: int, basis_points: int) -> int:
+    """A percentage (in basis points) of an amount in cents, rounded half up with integer arithmetic only."""
+    return (amount_cents * basis_points + 5000) // 10000
+
+
+def _per_unit_saving_cents(deal: dict, price_cents: int) -> int:
+    """Saving on one unit for the deal types that discount each unit independently."""
+    if deal['type'] == "FIXED_AMOUNT_ITEM":
+        return min(price_cents, _to_cents(deal['discount_value']))
+    return _percentage_of_cents(price_cents, _basis_points(deal['discount_percentage']))
+
+
+def _free_units_before(position: int, group_size: int, free_per_group: int) -> int:
+    """How many of the first `position` drawn units are free; the last free_per_group units of each group are."""
+    return (position // group_size) * free_per_group + max(0, position % group_size - (group_size - free_per_group))
+
+
+def _set_deal_gain(spec: dict, remaining: list, groups: int, unit_saving: list, price_cents: list) -> int:
+    """
+    Net saving (cents) of forming `groups` groups of a BOGO/BUNDLE deal from the remaining units,
+    minus the per-unit deal savings those units give up. Units are drawn in spec['order'] in runs
+    per line, so this is O(lines) whatever the quantities.
+    """
+    group_size, free_per_group = spec['group_size'], spec['free_per_group']
+    units_to_take = groups * group_size
+    gain = groups * spec['value_per_group']
+    position = 0
+    for line in spec['order']:
+        if position >= units_to_take:
+            break
+        taken = min(remaining[line], units_to_take - position)
+        if taken <= 0:
+            continue
+        gain -= taken * unit_saving[line]
+        if free_per_group:
+            gain += price_cents[line] * (_free_units_before(position + taken, group_size, free_per_group)
+                                         - _free_units_before(position, group_size, free_per_group))
+        position += taken
+    return gain
+
+
+def _set_deal_consumption(spec: dict, remaining: list, groups: int) -> tuple:
+    """The (line, units) pairs consumed by forming `groups` groups, in draw order."""
+    units_to_take = groups * spec['group_size']
+    consumed = []
+    for line in spec['order']:
+        if units_to_take <= 0:
+            break
+        taken = min(remaining[line], units_to_take)
+        if taken > 0:
+            consumed.append((line, taken))
+            units_to_take -= taken
+    return tuple(consumed)
+
+
+def _candidate_group_counts(spec: dict, remaining: list, unit_saving: list, price_cents: list, every_count: bool = False) -> list:
+    """
+    Group counts worth branching on, best first. Small counts are all enumerated. For bulk quantities
+    only the points where the draw moves on to the next line (and a few groups either side) are tried:
+    between those the deal's own gain is linear in the number of groups. That shortcut is only exact
+    for the last deal to draw from these units; a deal that leaves units to later deals passes
+    every_count, since what they can form from the leftovers depends on their group sizes.
+    """
+    group_size = spec['group_size']
+    max_groups = sum(remaining[line] for line in spec['order']) // group_size
+    if every_count or max_groups < DEAL_SEARCH_MAX_BRANCHES:
+        counts = range(max_groups + 1)
+    else:
+        counts = {0, max_groups}
+        cumulative = 0
+        for line in spec['order']:
+            if remaining[line] <= 0:
+                continue
+            cumulative += remaining[line]
+            for offset in range(-DEAL_SEARCH_BREAKPOINT_SLACK, DEAL_SEARCH_BREAKPOINT_SLACK + 1):
+                counts.add(min(max_groups, max(0, cumulative // group_size + offset)))
+    return sorted(((_set_deal_gain(spec, remaining, groups, unit_saving, price_cents), groups) for groups in counts), reverse=True)
+
+
+def optimize_deal_allocation(items: list, deal_index: dict = None, time_budget_ms: float = DEAL_ALLOCATION_TIME_BUDGET_MS) -> dict:
+    """
+    Finds the cheapest basket when deals are exclusive claims on units.
+
+    Per-unit deals (percentage / fixed amount) price each unit independently, so a unit that no
+    set deal claims simply takes its best one. BOGO and BUNDLE deals claim groups of units; how many
+    groups each of them forms is solved by branch-and-bound with memoization on the remaining
+    quantities. Within a deal, BOGO groups are drawn from the most expensive units down (so the free
+    units are as valuable as possible) and bundles from the units with the smallest per-unit saving.
+    Deals that share no cart lines are searched independently. If the search exceeds time_budget_ms,
+    the remaining deals keep a greedy allocation (each deal in priority order takes its best group count).
+
+    Args:
+        items (list): Cart lines with product_id, quantity, original_price, category, brand, subcategory.
+
+    Returns:
+        dict: {
+            'deal_allocations': [{'deal_id', 'deal_name', 'type', 'groups', 'savings_cents',
+                                  'units': [{'line_index', 'product_id', 'units', 'discount_cents'}]}],
+            'total_savings_cents': int,
+            'optimal': False if the greedy fallback was used,
+            'solver_time_ms': float
+        }
+    """
+    started = time.perf_counter()
+    deal_index = deal_index or DEAL_INDEX
+    matched_items_by_deal = match_deals_to_items(items, deal_index)
+    line_of_item = {id(item): line for line, item in enumerate(items)}
+    price_cents = [_to_cents(item['original_price']) for item in items]
+    quantities = [max(0, int(item['quantity'])) for item in items]
+
+    # Best per-unit deal for every line
+    unit_saving = [0] * len(items)
+    unit_deal = [None] * len(items)
+    set_specs = []
+    for ordinal in sorted(matched_items_by_deal):
+        deal = deal_index['deals'][ordinal]
+        lines = [line_of_item[id(item)] for item in matched_items_by_deal[ordinal]]
+        if deal['type'] in SET_DEAL_TYPES:
+            if deal.get('min_quantity_for_deal', 0) > 0 and sum(quantities[line] for line in lines) >= deal['min_quantity_for_deal']:
+                set_specs.append({"ordinal": ordinal, "lines": lines})
+            continue
+        for line in lines:
+            saving = _per_unit_saving_cents(deal, price_cents[line])
+            if saving > unit_saving[line]:
+                unit_saving[line], unit_deal[line] = saving, ordinal
+
+    for spec in set_specs:
+        deal = deal_index['deals'][spec['ordinal']]
+        spec['group_size'] = deal['min_quantity_for_deal']
+        if deal['type'] == "BOGO":
+            spec['free_per_group'] = min(deal['apply_to_n_lowest_price'], spec['group_size'])
+            spec['value_per_group'] = 0
+            spec['order'] = sorted(spec['lines'], key=lambda line: (-price_cents[line], unit_saving[line], line))
+        else:
+            spec['free_per_group'] = 0
+            spec['value_per_group'] = _to_cents(deal['discount_value'])
+            spec['order'] = sorted(spec['lines'], key=lambda line: (unit_saving[line], line))
+
+    # Set deals that share no lines are independent, so each connected group is searched on its own
+    component_of = list(range(len(set_specs)))
+
+    def find(position):
+        while component_of[position] != position:
+            component_of[position] = component_of[component_of[position]]
+            position = component_of[position]
+        return position
+
+    spec_by_line = {}
+    for position, spec in enumerate(set_specs):
+        for line in spec['lines']:
+            if line in spec_by_line:
+                component_of[find(position)] = find(spec_by_line[line])
+            else:
+                spec_by_line[line] = position
+    components = {}
+    for position in range(len(set_specs)):
+        components.setdefault(find(position), []).append(position)
+
+    # Greedy fallback, computed up front so running out of budget costs nothing extra:
+    # each deal in priority order forms its individually best number of groups.
+    remaining = list(quantities)
+    greedy_plans = {}
+    for positions in components.values():
+        plan = ()
+        for position in positions:
+            spec = set_specs[position]
+            groups = _candidate_group_counts(spec, remaining, unit_saving, price_cents)[0][1]
+            for line, units in _set_deal_consumption(spec, remaining, groups):
+                remaining[line] -= units
+            plan += (groups,)
+        greedy_plans[id(set_specs[positions[0]])] = plan
+
+    deadline = started + time_budget_ms / 1000
+    zero_saving = [0] * len(items)
+    remaining = list(quantities)
+    groups_by_spec = {}
+    optimal = True
+
+    for positions in components.values():
+        specs = [set_specs[position] for position in positions]
+        # Optimistic bound per suffix of set deals: every group formed, no per-unit savings given up
+        bounds = [0] * (len(specs) + 1)
+        for position in range(len(specs) - 1, -1, -1):
+            spec = specs[position]
+            max_groups = sum(quantities[line] for line in spec['lines']) // spec['group_size']
+            bounds[position] = bounds[position + 1] + max(0, _set_deal_gain(spec, quantities, max_groups, zero_saving, price_cents))
+        lines_from = [sorted({line for spec in specs[position:] for line in spec['lines']}) for position in range(len(specs) + 1)]
+        memo = {}
+
+        def search(position):
+            if position == len(specs):
+                return 0, ()
+            key = (position, tuple(remaining[line] for line in lines_from[position]))
+            if key in memo:
+                return memo[key]
+            if time.perf_counter() > deadline:
+                raise _DealSearchTimeout()
+
+            spec = specs[position]
+            best_gain, best_plan = None, ()
+            candidates = _candidate_group_counts(spec, remaining, unit_saving, price_cents, every_count=position < len(specs) - 1)
+            for gain, groups in candidates:
+                if best_gain is not None and gain + bounds[position + 1] <= best_gain:
+                    continue
+                consumed = _set_deal_consumption(spec, remaining, groups)
+                for line, units in consumed:
+                    remaining[line] -= units
+                try:
+                    rest_gain, rest_plan = search(position + 1)
+                finally:
+                    for line, units in consumed:
+                        remaining[line] += units
+                if best_gain is None or gain + rest_gain > best_gain:
+                    best_gain, best_plan = gain + rest_gain, (groups,) + rest_plan
+            memo[key] = (best_gain, best_plan)
+            return memo[key]
+
+        try:
+            _, plan = search(0)
+        except _DealSearchTimeout:
+            optimal = False
+            plan = greedy_plans[id(specs[0])]
+        for spec, groups in zip(specs, plan):
+            groups_by_spec[id(spec)] = groups
+
+    if not optimal:
+        print(f"Warning (deal_optimizer.py): Deal allocation exceeded {time_budget_ms}ms, used greedy allocation for part of the cart.")
+
+    # Turn the plan into per-deal unit claims
+    # Components share no lines, so replaying every deal in priority order reproduces each component's draw
+    remaining = list(quantities)
+    allocations = []
+    for spec in set_specs:
+        groups = groups_by_spec[id(spec)]
+        if groups == 0:
+            continue
+        consumed = _set_deal_consumption(spec, remaining, groups)
+        deal = deal_index['deals'][spec['ordinal']]
+        group_size, free_per_group = spec['group_size'], spec['free_per_group']
+        consumed_value = sum(price_cents[line] * units for line, units in consumed)
+        bundle_value = groups * spec['value_per_group']
+        bundle_left = bundle_value
+        claims = []
+        position = 0
+        for claim_number, (line, units) in enumerate(consumed):
+            remaining[line] -= units
+            if free_per_group:
+                discount = price_cents[line] * (_free_units_before(position + units, group_size, free_per_group)
+                                                - _free_units_before(position, group_size, free_per_group))
+            elif claim_number == len(consumed) - 1 or consumed_value == 0:
+                discount = bundle_left
+            else:
+                # Bundle value is shared in proportion to the value of the units it consumed
+                discount = bundle_value * price_cents[line] * units // consumed_value
+            bundle_left -= discount
+            position += units
+            claims.append({"line_index": line, "product_id": items[line]['product_id'], "units": units, "discount_cents": discount})
+        allocations.append({
+            "deal_id": deal.get('deal_id'), "deal_name": deal['deal_name'], "type": deal['type'],
+            "groups": groups, "savings_cents": sum(claim['discount_cents'] for claim in claims), "units": claims
+        })
+
+    per_unit_claims = {}
+    for line, ordinal in enumerate(unit_deal):
+        if ordinal is not None and remaining[line] > 0:
+            per_unit_claims.setdefault(ordinal, []).append({
+                "line_index": line, "product_id": items[line]['product_id'],
+                "units": remaining[line], "discount_cents": remaining[line] * unit_saving[line]
+            })
+    for ordinal in sorted(per_unit_claims):
+        deal = deal_index['deals'][ordinal]
+        claims = per_unit_claims[ordinal]
+        allocations.append({
+            "deal_id": deal.get('deal_id'), "deal_name": deal['deal_name'], "type": deal['type'],
+            "groups": None, "savings_cents": sum(claim['discount_cents'] for claim in claims), "units": claims
+        })
+
+    return {
+        "deal_allocations": allocations,
+        "total_savings_cents": sum(allocation['savings_cents'] for allocation in allocations),
+        "optimal": optimal,
+        "solver_time_ms": round((time.perf_counter() - started) * 1000, 3)
+    }
+
+
+def build_processing_item(product_id: str, quantity: int) -> dict:
+    """A cart line with full product details, as used for deal processing (zero-priced if the product is unknown)."""
+    product_details = products_by_id_local.get(product_id)
+    if product_details:
+        return {
+            "product_id": product_id,
+            "quantity": quantity,
+            "original_price": product_details['price'],
+            "price_cents": price_cents_by_product_local[product_id],
+            "final_price_per_unit": product_details['price'],
+            "applied_discount_per_unit": 0.0,
+                        "product_name": product_details['product_name'],
+            "category": product_details['category'],
+            "brand": product_details['brand'],
+            "subcategory": product_details.get('subcategory', '')
+        }
+    print(f"Warning (deal_optimizer.py): Product ID {product_id} not found in products.json. Skipping for deal calculation.")
+    return {
+        "product_id": product_id,
+        "quantity": quantity,
+        "original_price": 0.0,
+        "price_cents": 0,
+        "final_price_per_unit": 0.0,
+        "applied_discount_per_unit": 0.0,
+                "product_name": f"Unknown Product (ID: {product_id})",
+        "category": "N/A",
+        "brand": "N/A",
+        "subcategory": "N/A"
+    }
 
-def apply_deals_to_list(shopping_list_items: list) -> dict:
+
+def apply_deals_to_list(shopping_list_items: list, mode: str = "stacked", time_budget_ms: float = DEAL_ALLOCATION_TIME_BUDGET_MS) -> dict:
     """
     Applies active deals to a given list of shopping items and calculates totals.
+    Pricing is done in integer cents (see price_cart_cents); the dollar fields are derived from them.
 
     Args:
         shopping_list_items (list): A list of dictionaries, each with 'product_id' and 'quantity'.
                                     Example: [{'product_id': 'WMK_P001', 'quantity': 2}]
+        mode (str): 'stacked' applies every matching deal in priority order (deals stack on the same units).
+                    'exclusive' lets each unit be claimed by one deal only and picks the cheapest allocation
+                    (see optimize_deal_allocation); the result then also carries 'deal_allocations'.
+        time_budget_ms (float): Search budget for 'exclusive' mode before falling back to greedy.
 
     Returns:
         dict: A dictionary containing:
-            'processed_items': list of items with applied_discount and final_price.
+            'processed_items': list of items with applied_discount and final_price (and line_total_cents / line_discount_cents).
             'total_before_discount': float.
             'total_discount': float.
             'total_after_discount': float.
+            'total_before_discount_cents', 'total_discount_cents', 'total_after_discount_cents': int.
             'applied_deals_summary': list of strings describing applied deals.
     """
-    processed_items = []
-    total_before_discount = 0.0
-    total_discount = 0.0
+    if mode not in DEAL_MODES:
+        raise ValueError(f"Unknown deal mode '{mode}'. Expected one of {DEAL_MODES}.")
+
+    # --- Apply Deals ---
+    # Only deals reachable from the cart's products/categories/brands are visited, in priority order.
+    refresh_deal_index()
+    deal_index = DEAL_INDEX
+    if mode == "exclusive":
+        current_processing_list = [build_processing_item(item['product_id'], item['quantity']) for item in shopping_list_items]
+        return _apply_deal_allocation(current_processing_list, deal_index, time_budget_ms)
+    return price_cart_cents(shopping_list_items, deal_index)
+
+def _apply_deal_allocation(current_processing_list: list, deal_index: dict, time_budget_ms: float) -> dict:
+    """Prices a cart from an exclusive deal allocation, in the same shape as apply_deals_to_list."""
+    allocation = optimize_deal_allocation(current_processing_list, deal_index, time_budget_ms)
+    lines = CartLines(current_processing_list)
     applied_deals_summary = []
 
-    # Create a mutable copy of the shopping list with full product details for easier processing
-    # Each item in `current_processing_list` will be {product_id, quantity, product_name, price, category, etc.}
-    current_processing_list = []
+    for deal_allocation in allocation['deal_allocations']:
+        for claim in deal_allocation['units']:
+            lines.discount_cents[claim['line_index']] += claim['discount_cents']
+        applied_deals_summary.append(
+            f"{deal_allocation['deal_name']} applied (-${deal_allocation['savings_cents'] / 100:.2f})"
+        )
+
+    return {
+        **lines.priced(allocation['total_savings_cents']),
+        "applied_deals_summary": applied_deals_summary,
+        "deal_allocations": allocation['deal_allocations'],
+        "allocation_optimal": allocation['optimal'],
+        "solver_time_ms": allocation['solver_time_ms']
+    }
+
+# --- Fixed-point pricing core ---
+# Money is held as integer cents in array-backed columns, so totals are exact sums and the same
+# cart prices to the same cents in every process (no float accumulation order to depend on).
+# Dollar amounts in results are derived from the cents once, when the result is built.
+
+
+class CartLines:
+    """
+    Column-oriented cart lines: parallel int64 arrays of unit price, quantity and deal discount, all in cents,
+    beside the build_processing_item dicts they were made from (used for deal matching and names only).
+    """
+
+    __slots__ = ("items", "price_cents", "quantities", "discount_cents", "line_of_item")
+
+    def __init__(self, items: list):
+        self.items = items
+        self.price_cents = array('q', [item['price_cents'] for item in items])
+        self.quantities = array('q', [item['quantity'] for item in items])
+        self.discount_cents = array('q', [0]) * len(items)
+        self.line_of_item = {id(item): line for line, item in enumerate(items)} # item dict -> line number
+
+    def line_totals_cents(self) -> array:
+        return array('q', map(operator.mul, self.price_cents, self.quantities))
+
+    def priced(self, total_discount_cents: int) -> dict:
+        """
+        The totals part of a pricing result: sums over the columns, the dollar amounts derived from them,
+        and the line dicts' prices filled in (once, as they were built for this call).
+        """
+        line_totals_cents = self.line_totals_cents()
+        total_before_discount_cents = sum(line_totals_cents)
+        total_after_discount_cents = total_before_discount_cents - total_discount_cents
+        for item, quantity, line_total_cents, discount_cents in zip(self.items, self.quantities, line_totals_cents, self.discount_cents):
+            item['line_total_cents'] = line_total_cents
+            item['line_discount_cents'] = discount_cents
+            if quantity > 0:
+                item['applied_discount_per_unit'] = discount_cents / quantity / 100
+                item['final_price_per_unit'] = max(0, line_total_cents - discount_cents) / quantity / 100
+        return {
+            "processed_items": self.items,
+            "total_before_discount": total_before_discount_cents / 100,
+            "total_discount": total_discount_cents / 100,
+            "total_after_discount": total_after_discount_cents / 100,
+            "total_before_discount_cents": total_before_discount_cents,
+            "total_discount_cents": total_discount_cents,
+            "total_after_discount_cents": total_after_discount_cents
+        }
+
+
+def _spread_cents(total_cents: int, weights: list) -> list:
+    """Splits total_cents in proportion to weights by largest remainder; shares always sum to total_cents."""
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        return [0] * len(weights)
+    shares = [total_cents * weight // weight_sum for weight in weights]
+    remainders = sorted(range(len(weights)), key=lambda position: (-(total_cents * weights[position] % weight_sum), position))
+    for position in remainders[:total_cents - sum(shares)]:
+        shares[position] += 1
+    return shares
+
+
+def evaluate_deal_cents(deal: dict, matched_items: list) -> dict:
+    """
+    Works out what one deal takes off its matched cart lines when deals stack, in integer cents.
+    Every deal type is computed from the lines' original prices and quantities, so a deal's result
+    does not depend on any other deal and can be recomputed on its own when its lines change.
+
+    Percentage discounts are rounded half up once per line total; bundle discounts are spread by
+    largest remainder in proportion to line value, so they add up to the bundle value exactly.
+
+    Returns:
+        dict: {
+            'line_discounts': (item, discount cents for the whole line) pairs,
+            'total_discount_cents': int,
+            'summaries': strings for applied_deals_summary
+        }
+    """
+    line_discounts = []
+
+    if deal['type'] in ("PERCENTAGE_CATEGORY", "PERCENTAGE_ITEM"):
+        basis_points = _basis_points(deal['discount_percentage'])
+        line_discounts = [(item, _percentage_of_cents(item['price_cents'] * item['quantity'], basis_points))
+                          for item in matched_items]
+    elif deal['type'] == "FIXED_AMOUNT_ITEM":
+        discount_value_cents = _to_cents(deal['discount_value'])
+        line_discounts = [(item, discount_value_cents * item['quantity']) for item in matched_items]
+    elif deal['type'] == "BOGO":
+        line_discounts = [(item, item['price_cents'] * free_units)
+                          for item, free_units in allocate_bogo_free_units(deal, matched_items)]
+    elif deal['type'] == "BUNDLE_THRESHOLD":
+        applicable_count = sum(item['quantity'] for item in matched_items)
+        if applicable_count >= deal['min_quantity_for_deal']:
+            total_bundle_cents = (applicable_count // deal['min_quantity_for_deal']) * _to_cents(deal['discount_value'])
+            shares = _spread_cents(total_bundle_cents, [item['price_cents'] * item['quantity'] for item in matched_items])
+            line_discounts = list(zip(matched_items, shares))
+
+    line_discounts = [(item, discount) for item, discount in line_discounts if discount > 0]
+    total_discount_cents = sum(discount for _, discount in line_discounts)
+    if deal['type'] in SET_DEAL_TYPES:
+        summaries = [f"{deal['deal_name']} applied (-${total_discount_cents / 100:.2f})"] if total_discount_cents else []
+    else:
+        summaries = [f"{deal['deal_name']} applied to {item['product_name']} (-${discount / 100:.2f})"
+                     for item, discount in line_discounts]
+    return {"line_discounts": line_discounts, "total_discount_cents": total_discount_cents, "summaries": summaries}
+
+
+def _set_line_prices(item: dict, discount_cents: int) -> int:
+    """
+    Fills in one processing item's prices from its total deal discount in cents (CartLines.priced does this
+    for a whole cart); returns its line total in cents.
+    """
+    line_total_cents = item['price_cents'] * item['quantity']
+    item['line_total_cents'] = line_total_cents
+    item['line_discount_cents'] = discount_cents
+    if item['quantity'] > 0:
+        item['applied_discount_per_unit'] = discount_cents / item['quantity'] / 100
+        item['final_price_per_unit'] = max(0, line_total_cents - discount_cents) / item['quantity'] / 100
+    return line_total_cents
+
+
+def price_cart_cents(shopping_list_items: list, deal_index: dict = None) -> dict:
+    """
+    Prices a cart with stacked deals in integer cents: every matching deal in priority order.
+
+    Args:
+        shopping_list_items (list): Items with 'product_id' and 'quantity'.
+
+    Returns:
+        dict: The apply_deals_to_list result (dollar fields derived from cents).
+    """
+    if deal_index is None:
+        refresh_deal_index()
+        deal_index = DEAL_INDEX
+
+    lines = CartLines([build_processing_item(item['product_id'], item['quantity']) for item in shopping_list_items])
+    discount_cents, line_of_item = lines.discount_cents, lines.line_of_item
+    total_discount_cents = 0
+    applied_deals_summary = []
+
+    matched_items_by_deal = match_deals_to_items(lines.items, deal_index)
+    for ordinal in sorted(matched_items_by_deal):
+        deal_result = evaluate_deal_cents(deal_index['deals'][ordinal], matched_items_by_deal[ordinal])
+        for item, discount in deal_result['line_discounts']:
+            discount_cents[line_of_item[id(item)]] += discount
+        total_discount_cents += deal_result['total_discount_cents']
+        applied_deals_summary.extend(deal_result['summaries'])
+
+    return {**lines.priced(total_discount_cents), "applied_deals_summary": applied_deals_summary}
+
+
+# --- Nearly qualifying deals ---
+NEARLY_QUALIFYING_MAX_UNITS_SHORT = 2
+NEARLY_QUALIFYING_MAX_OPTIONS = 3
+
+
+def _set_deal_savings_cents(deal: dict, matched_items: list) -> int:
+    """What a BOGO/BUNDLE_THRESHOLD deal saves on its own for the given matched lines, in cents."""
+    min_quantity = deal['min_quantity_for_deal']
+    units = sum(item['quantity'] for item in matched_items)
+    if units < min_quantity:
+        return 0
+    if deal['type'] == "BOGO":
+        return sum(_to_cents(item['original_price']) * free_units for item, free_units in allocate_bogo_free_units(deal, matched_items))
+    return (units // min_quantity) * _to_cents(deal['discount_value'])
+
+
+def find_nearly_qualifying_deals(shopping_list_items: list, max_units_short: int = NEARLY_QUALIFYING_MAX_UNITS_SHORT,
+                                 max_options: int = NEARLY_QUALIFYING_MAX_OPTIONS, deal_index: dict = None,
+                                 is_available=None) -> list:
+    """
+    Finds threshold deals (BOGO / BUNDLE_THRESHOLD) the basket is a few units short of triggering,
+    or of triggering one more time, along with the cheapest products to add.
+
+    Only deals reachable from the basket through the deal index are looked at, and each is priced
+    on its own matched lines, so this costs about one index lookup per cart line rather than a
+    full apply_deals_to_list per candidate product.
+
+    Args:
+        shopping_list_items (list): Items with 'product_id' and 'quantity'.
+        max_units_short (int): Deals needing more units than this are not reported.
+        max_options (int): How many of the cheapest qualifying products to suggest per deal.
+        is_available (callable): product_id -> bool; products it rejects (e.g. out of stock) are not suggested.
+
+    Returns:
+        list: Dicts with deal_id, deal_name, type, units_in_basket, units_short, cost_to_qualify,
+              savings_unlocked, message and suggested_items ([{product_id, product_name, price, quantity,
+              cost, savings_unlocked}], cheapest first); fewest units short first, then largest saving.
+    """
+    if deal_index is None:
+        refresh_deal_index()
+        deal_index = DEAL_INDEX
+
+    basket_lines = []
     for item in shopping_list_items:
         product_details = products_by_id_local.get(item['product_id'])
         if product_details:
-            current_item = {
+            basket_lines.append({
                 "product_id": item['product_id'],
                 "quantity": item['quantity'],
                 "original_price": product_details['price'],
-                "final_price_per_unit": product_details['price'], 
-                "applied_discount_per_unit": 0.0,
-                "product_name": product_details['product_name'],
                 "category": product_details['category'],
                 "brand": product_details['brand'],
-                "subcategory": product_details.get('subcategory', '') 
-            }
-            current_processing_list.append(current_item)
-            total_before_discount += current_item["original_price"] * current_item["quantity"]
-        else:
-            print(f"Warning (deal_optimizer.py): Product ID {item['product_id']} not found in products.json. Skipping for deal calculation.")
-            current_processing_list.append({
-                "product_id": item['product_id'],
-                "quantity": item['quantity'],
-                "original_price": 0.0,
-                "final_price_per_unit": 0.0,
-                "applied_discount_per_unit": 0.0,
-                "product_name": f"Unknown Product (ID: {item['product_id']})",
-                "category": "N/A",
-                "brand": "N/A",
-                "subcategory": "N/A"
+                "subcategory": product_details.get('subcategory', '')
             })
 
-    # Sort processed_items by price (ascending), useful for BOGO deals where lowest price is free
-    processed_items_sorted_for_deals = sorted(current_processing_list, key=lambda x: x['original_price'])
+    nearly_qualifying = []
+    for ordinal, matched_items in match_deals_to_items(basket_lines, deal_index).items():
+        deal = deal_index['deals'][ordinal]
+        if deal['type'] not in SET_DEAL_TYPES or deal.get('min_quantity_for_deal', 0) <= 0:
+            continue
+        units_in_basket = sum(item['quantity'] for item in matched_items)
+        units_short = deal['min_quantity_for_deal'] - units_in_basket % deal['min_quantity_for_deal']
+        if units_short > max_units_short:
+            continue
 
-    # --- Apply Deals ---
-    for deal in deals_data_local:
-        if not deal.get('active', False):
-            continue 
-
-        if deal['type'] == "BOGO": 
-            applicable_units_in_cart = []
-            for item in processed_items_sorted_for_deals:
-                if item['product_id'] in deal['applicable_product_ids']:
-                    for _ in range(item['quantity']):
-                        applicable_units_in_cart.append(item) 
-
-            applicable_units_in_cart.sort(key=lambda x: x['original_price'])
-
-            sets_available = math.floor(len(applicable_units_in_cart) / deal['min_quantity_for_deal'])
-            free_items_to_discount = sets_available * deal['apply_to_n_lowest_price']
-
-            if free_items_to_discount > 0:
-                discount_applied_for_deal = 0.0
-                for i in range(min(free_items_to_discount, len(applicable_units_in_cart))):
-                    unit_to_discount = applicable_units_in_cart[i]
-                    discount_amount_for_unit = unit_to_discount['original_price']
-
-                    # Apply discount directly to the item's final price per unit
-                    unit_to_discount['final_price_per_unit'] -= discount_amount_for_unit
-                    unit_to_discount['applied_discount_per_unit'] += discount_amount_for_unit
-                    discount_applied_for_deal += discount_amount_for_unit
-
-                total_discount += discount_applied_for_deal
-                applied_deals_summary.append(
-                    f"{deal['deal_name']} applied (-${discount_applied_for_deal:.2f})"
-                )
-                print(f"DEBUG: Applied BOGO for {deal['deal_name']}. Discount: ${discount_applied_for_deal:.2f}")
-
-
-        elif deal['type'] == "PERCENTAGE_CATEGORY":
-            for item in current_processing_list: 
-                if item['category'] == deal['category_restriction'] and \
-                   (not deal.get('excluded_subcategories') or item['subcategory'] not in deal['excluded_subcategories']):
-
-                    discount_per_unit = item['original_price'] * (deal['discount_percentage'] / 100)
-                    discount_amount_total_for_item = discount_per_unit * item['quantity']
-
-                    item['final_price_per_unit'] -= discount_per_unit
-                    item['applied_discount_per_unit'] += discount_per_unit
-                    total_discount += discount_amount_total_for_item
-                    applied_deals_summary.append(
-                        f"{deal['deal_name']} applied to {item['product_name']} (-${discount_amount_total_for_item:.2f})"
-                    )
-                    print(f"DEBUG: Applied PERCENTAGE_CATEGORY for {item['product_name']}. Discount: ${discount_amount_total_for_item:.2f}")
-
-
-        elif deal['type'] == "FIXED_AMOUNT_ITEM":
-            for item in current_processing_list:
-                if item['product_id'] in deal['applicable_product_ids']:
-                    discount_per_unit = deal['discount_value']
-                    discount_amount_total_for_item = discount_per_unit * item['quantity'] 
-
-                    item['final_price_per_unit'] -= discount_per_unit
-                    item['applied_discount_per_unit'] += discount_per_unit
-                    total_discount += discount_amount_total_for_item
-                    applied_deals_summary.append(
-                        f"{deal['deal_name']} applied to {item['product_name']} (-${discount_amount_total_for_item:.2f})"
-                    )
-                    print(f"DEBUG: Applied FIXED_AMOUNT_ITEM for {item['product_name']}. Discount: ${discount_amount_total_for_item:.2f}")
-
-        elif deal['type'] == "PERCENTAGE_ITEM":
-            for item in current_processing_list:
-                if item['product_id'] in deal['applicable_product_ids']:
-                    discount_per_unit = item['original_price'] * (deal['discount_percentage'] / 100)
-                    discount_amount_total_for_item = discount_per_unit * item['quantity']
-
-                    item['final_price_per_unit'] -= discount_per_unit
-                    item['applied_discount_per_unit'] += discount_per_unit
-                    total_discount += discount_amount_total_for_item
-                    applied_deals_summary.append(
-                        f"{deal['deal_name']} applied to {item['product_name']} (-${discount_amount_total_for_item:.2f})"
-                    )
-                    print(f"DEBUG: Applied PERCENTAGE_ITEM for {item['product_name']}. Discount: ${discount_amount_total_for_item:.2f}")
-
-        elif deal['type'] == "BUNDLE_THRESHOLD": 
-            applicable_items_in_bundle = [item for item in current_processing_list if item['product_id'] in deal['applicable_product_ids']]
-            applicable_count = sum(item['quantity'] for item in applicable_items_in_bundle)
-
-            if applicable_count >= deal['min_quantity_for_deal']:
-                num_bundles = math.floor(applicable_count / deal['min_quantity_for_deal'])
-                total_bundle_discount = num_bundles * deal['discount_value']
-
-                remaining_discount_to_distribute = total_bundle_discount
-                total_value_in_bundle = sum(item['original_price'] * item['quantity'] for item in applicable_items_in_bundle)
-
-                if total_value_in_bundle > 0: 
-                    for item in applicable_items_in_bundle:
-                        if remaining_discount_to_distribute > 0:
-                            item_value_proportion = (item['original_price'] * item['quantity']) / total_value_in_bundle
-                            discount_for_this_item = total_bundle_discount * item_value_proportion
-
-                            item['final_price_per_unit'] -= (discount_for_this_item / item['quantity'])
-                            item['applied_discount_per_unit'] += (discount_for_this_item / item['quantity'])
-                            remaining_discount_to_distribute -= discount_for_this_item
-
-                total_discount += total_bundle_discount
-                applied_deals_summary.append(
-                    f"{deal['deal_name']} applied (-${total_bundle_discount:.2f})"
-                )
-                print(f"DEBUG: Applied BUNDLE_THRESHOLD for {deal['deal_name']}. Discount: ${total_bundle_discount:.2f}")
-
-
-    total_after_discount = total_before_discount - total_discount
-
-    for item in current_processing_list:
-        item['final_price_per_unit'] = max(0.0, item['final_price_per_unit'])
+        current_savings_cents = _set_deal_savings_cents(deal, matched_items)
+        suggested_items = []
+        for price, product_id in deal_index['cheapest_products'][ordinal]:
+            if len(suggested_items) >= max_options:
+                break
+            if is_available is not None and not is_available(product_id):
+                continue
+            added_line = {"product_id": product_id, "quantity": units_short, "original_price": price}
+            savings_unlocked_cents = _set_deal_savings_cents(deal, matched_items + [added_line]) - current_savings_cents
+            if savings_unlocked_cents <= 0:
+                continue
+            suggested_items.append({
+                "product_id": product_id,
+                "product_name": products_by_id_local[product_id]['product_name'],
+                "price": price,
+                "quantity": units_short,
+                "cost": _to_cents(price) * units_short / 100,
+                "savings_unlocked": savings_unlocked_cents / 100
+            })
+        if not suggested_items:
+            continue
+
+        cheapest = suggested_items[0]
+        nearly_qualifying.append({
+            "deal_id": deal.get('deal_id'),
+            "deal_name": deal['deal_name'],
+            "type": deal['type'],
+            "units_in_basket": units_in_basket,
+            "units_short": units_short,
+            "cost_to_qualify": cheapest['cost'],
+            "savings_unlocked": cheapest['savings_unlocked'],
+            "message": f"Add {units_short} more {cheapest['product_name']} to get ${cheapest['savings_unlocked']:.2f} off with '{deal['deal_name']}'.",
+            "suggested_items": suggested_items
+        })
+
+    nearly_qualifying.sort(key=lambda suggestion: (suggestion['units_short'], -suggestion['savings_unlocked']))
+    return nearly_qualifying
+
+
+# --- Incremental cart pricing ---
+CART_CHANGE_OPS = ("add", "remove", "set_quantity")
+
+
+class CartPricingSession:
+    """
+    A priced cart kept between requests, re-priced incrementally as it changes.
+
+    Lines are keyed by product_id, in the order they were added. Each deal's stacked result
+    (evaluate_deal_cents) is cached; a change only re-evaluates the deals the changed product reaches
+    through the deal index, then re-prices the lines those deals touch. Prices match
+    apply_deals_to_list in 'stacked' mode for the same cart. Lines stay dicts here rather than
+    CartLines columns: they are added and removed one at a time and re-priced individually.
+    """
+
+    def __init__(self, shopping_list_items: list = ()):
+        self.lines = {} # product_id -> processing item (see build_processing_item)
+        self.version = 0
+        self._lock = threading.RLock()
+        for item in shopping_list_items:
+            if not isinstance(item['quantity'], int) or item['quantity'] < 0:
+                raise ValueError("Shopping list 'quantity' must be a non-negative integer.")
+            if item['product_id'] in self.lines:
+                self.lines[item['product_id']]['quantity'] += item['quantity']
+            elif item['quantity'] > 0:
+                self.lines[item['product_id']] = build_processing_item(item['product_id'], item['quantity'])
+        self._reprice_all()
+
+    def _reprice_all(self):
+        refresh_deal_index()
+        self.deal_index = DEAL_INDEX
+        self.matched_lines = match_deals_to_items(list(self.lines.values()), self.deal_index)
+        self.deal_results = {ordinal: evaluate_deal_cents(self.deal_index['deals'][ordinal], matched_items)
+                             for ordinal, matched_items in self.matched_lines.items()}
+        self.line_deal_discounts = {product_id: {} for product_id in self.lines} # product_id -> {ordinal: line discount cents}
+        for ordinal, deal_result in self.deal_results.items():
+            for item, discount_cents in deal_result['line_discounts']:
+                self.line_deal_discounts[item['product_id']][ordinal] = discount_cents
+        for product_id in self.lines:
+            self._reprice_line(product_id)
+
+    def _reprice_line(self, product_id: str):
+        _set_line_prices(self.lines[product_id], sum(self.line_deal_discounts[product_id].values()))
+
+    def _deals_for_line(self, line: dict) -> set:
+        """Deal ordinals the line counts towards (its product -> deal dependencies)."""
+        candidates = set(self.deal_index['by_product'].get(line['product_id'], ()))
+        candidates.update(self.deal_index['by_category'].get(line['category'], ()))
+        candidates.update(self.deal_index['by_brand'].get(line['brand'], ()))
+        return {ordinal for ordinal in candidates if _deal_matches_item(self.deal_index, ordinal, line)}
+
+    def totals(self) -> dict:
+        total_before_discount_cents = sum(line['line_total_cents'] for line in self.lines.values())
+        total_discount_cents = sum(deal_result['total_discount_cents'] for deal_result in self.deal_results.values())
+        total_after_discount_cents = total_before_discount_cents - total_discount_cents
+        return {
+            "total_before_discount": total_before_discount_cents / 100,
+            "total_discount": total_discount_cents / 100,
+            "total_after_discount": total_after_discount_cents / 100,
+            "total_before_discount_cents": total_before_discount_cents,
+            "total_discount_cents": total_discount_cents,
+            "total_after_discount_cents": total_after_discount_cents
+        }
+
+    def applied_deals_summary(self) -> list:
+        return [summary for ordinal in sorted(self.deal_results) for summary in self.deal_results[ordinal]['summaries']]
+
+    def snapshot(self) -> dict:
+        """The whole priced cart, in the same shape as apply_deals_to_list."""
+        with self._lock:
+            return {
+                "processed_items": [dict(line) for line in self.lines.values()],
+                **self.totals(),
+                "applied_deals_summary": self.applied_deals_summary(),
+                "version": self.version
+            }
+
+    def apply_changes(self, changes: list) -> dict:
+        """
+        Applies cart changes and returns what changed.
+
+        Args:
+            changes (list): Dicts with 'op' ('add', 'remove' or 'set_quantity'), 'product_id' and,
+                            except for 'remove', 'quantity'. 'add' increases an existing line.
+
+        Returns:
+            dict: {
+                'version': int, incremented per call,
+                'changed_items': processed items that were added or whose quantity/price changed,
+                'removed_product_ids': list,
+                'total_before_discount', 'total_discount', 'total_after_discount',
+                'applied_deals_summary': list,
+                'reevaluated_deals': how many deals were re-evaluated
+            }
+        """
+        for change in changes:
+            if change.get('op') not in CART_CHANGE_OPS:
+                raise ValueError(f"Unknown cart change op '{change.get('op')}'. Expected one of {CART_CHANGE_OPS}.")
+            if not change.get('product_id'):
+                raise ValueError("Cart change is missing 'product_id'.")
+            if change['op'] != "remove" and (not isinstance(change.get('quantity'), int) or change['quantity'] < 0):
+                raise ValueError("Cart change 'quantity' must be a non-negative integer.")
+
+        with self._lock:
+            before = {product_id: (line['quantity'], line['final_price_per_unit']) for product_id, line in self.lines.items()}
+
+            if refresh_deal_index() or self.deal_index is not DEAL_INDEX:
+                # Deals changed on disk: nothing cached is valid any more
+                self._apply_line_changes(changes, affected_deals=set())
+                self._reprice_all()
+                touched_lines = set(self.lines)
+                reevaluated_deals = len(self.deal_results)
+            else:
+                affected_deals = set()
+                self._apply_line_changes(changes, affected_deals)
+                touched_lines = set()
+                for ordinal in affected_deals:
+                    for item, _ in self.deal_results.pop(ordinal, {"line_discounts": ()})['line_discounts']:
+                        self.line_deal_discounts.get(item['product_id'], {}).pop(ordinal, None)
+                        touched_lines.add(item['product_id'])
+                    matched_items = self.matched_lines.get(ordinal)
+                    if not matched_items:
+                        self.matched_lines.pop(ordinal, None)
+                        continue
+                    self.deal_results[ordinal] = evaluate_deal_cents(self.deal_index['deals'][ordinal], matched_items)
+                    for item, discount_cents in self.deal_results[ordinal]['line_discounts']:
+                        self.line_deal_discounts[item['product_id']][ordinal] = discount_cents
+                        touched_lines.add(item['product_id'])
+                touched_lines.update(change['product_id'] for change in changes)
+                touched_lines &= set(self.lines)
+                for product_id in touched_lines:
+                    self._reprice_line(product_id)
+                reevaluated_deals = len(affected_deals)
+
+            self.version += 1
+            changed_items = [
+                dict(line) for product_id, line in self.lines.items()
+                if product_id in touched_lines and before.get(product_id) != (line['quantity'], line['final_price_per_unit'])
+            ]
+            return {
+                "version": self.version,
+                "changed_items": changed_items,
+                "removed_product_ids": [product_id for product_id in before if product_id not in self.lines],
+                **self.totals(),
+                "applied_deals_summary": self.applied_deals_summary(),
+                "reevaluated_deals": reevaluated_deals
+            }
+
+    def _apply_line_changes(self, changes: list, affected_deals: set):
+        """Updates lines and per-deal matched lines, collecting the deals whose inputs changed."""
+        for change in changes:
+            product_id = change['product_id']
+            line = self.lines.get(product_id)
+            if change['op'] == "add":
+                new_quantity = (line['quantity'] if line else 0) + change['quantity']
+            elif change['op'] == "set_quantity":
+                new_quantity = change['quantity']
+            else:
+                new_quantity = 0
+
+            if line is None:
+                if new_quantity <= 0:
+                    continue
+                line = build_processing_item(product_id, new_quantity)
+                self.lines[product_id] = line
+                self.line_deal_discounts[product_id] = {}
+                deals_for_line = self._deals_for_line(line)
+                for ordinal in deals_for_line:
+                    self.matched_lines.setdefault(ordinal, []).append(line)
+            else:
+                deals_for_line = self._deals_for_line(line)
+                if new_quantity <= 0:
+                    del self.lines[product_id]
+                    del self.line_deal_discounts[product_id]
+                    for ordinal in deals_for_line:
+                        self.matched_lines[ordinal] = [item for item in self.matched_lines.get(ordinal, ()) if item is not line]
+                else:
+                    line['quantity'] = new_quantity
+            affected_deals.update(deals_for_line)
 
-    return {
-        "processed_items": current_processing_list, 
-        "total_before_discount": round(total_before_discount, 2),
-        "total_discount": round(total_discount, 2),
-        "total_after_discount": round(total_after_discount, 2),
-        "applied_deals_summary": applied_deals_summary
-    }
 
 if __name__ == "__main__":
     print("--- Running deal_optimizer.py for independent testing ---")
@@ -241,4 +1040,22 @@ if __name__ == "__main__":
     else:
         print("No deals applied.")
 
+    print("\n--- Exclusive Deal Allocation (one deal per unit) ---")
+    exclusive_results = apply_deals_to_list(sample_list, mode="exclusive")
+    for deal_allocation in exclusive_results['deal_allocations']:
+        claimed = ", ".join(f"{claim['product_id']} x{claim['units']}" for claim in deal_allocation['units'])
+        print(f"- {deal_allocation['deal_name']}: {claimed} (-${deal_allocation['savings_cents'] / 100:.2f})")
+    print(f"Total After Discount: ${exclusive_results['total_after_discount']:.2f} "
+          f"(optimal: {exclusive_results['allocation_optimal']}, {exclusive_results['solver_time_ms']}ms)")
+
+    print("\n--- Nearly Qualifying Deals ---")
+    for suggestion in find_nearly_qualifying_deals(sample_list):
+        print(f"- {suggestion['message']} (adds ${suggestion['cost_to_qualify']:.2f})")
+
+    print("\n--- Incremental Cart Pricing Session ---")
+    cart_session = CartPricingSession(sample_list)
+    diff = cart_session.apply_changes([{"op": "add", "product_id": "WMK_P049", "quantity": 2}])
+    print(f"Re-evaluated {diff['reevaluated_deals']} deal(s); {len(diff['changed_items'])} line(s) changed. "
+          f"Total After Discount: ${diff['total_after_discount']:.2f}")
+
     print("\n--- deal_optimizer.py independent testing complete ---")
\ No newline at end of file
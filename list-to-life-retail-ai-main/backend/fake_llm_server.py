@@ -0,0 +1,112 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_client import LocalListBackend, _last_user_message
+from product_retriever import PRODUCT_RETRIEVER
+
+# Stand-in for the model API so load tests run offline. Point the app at it with
+#   LLM_BACKEND=http LLM_HTTP_URL=http://127.0.0.1:8081/generate
+# and dial in latency and failures from the command line (or live, through FakeLLMServer.behaviour).
+
+class _LoadTestHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the default backlog of 5 drops connections under a burst of clients
+
+
+class FakeLLMServer:
+    """A threaded HTTP server answering POST /generate with deterministic shopping lists."""
+
+    def __init__(self, port: int = 8081, latency_ms: float = 800, jitter_ms: float = 200, error_rate: float = 0.0,
+                 hang_rate: float = 0.0, chunk_size: int = 40, seed: int = None):
+        self.behaviour = {"latency_ms": latency_ms, "jitter_ms": jitter_ms, "error_rate": error_rate,
+                          "hang_rate": hang_rate, "chunk_size": chunk_size}
+        self.responder = LocalListBackend(PRODUCT_RETRIEVER)
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = _LoadTestHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}/generate"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass # keep load tests quiet
+
+            def do_POST(self):
+                try:
+                    self._answer()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # the client hit its deadline and hung up
+
+            def _answer(self):
+                if not self.path.startswith("/generate"):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                behaviour = server.behaviour
+                with server._lock:
+                    server.requests += 1
+                    roll = server._rng.random()
+                    delay = max(0.0, behaviour["latency_ms"] + server._rng.uniform(-1, 1) * behaviour["jitter_ms"]) / 1000
+                if roll < behaviour["hang_rate"]:
+                    time.sleep(3600) # never answers; the client's deadline has to cut it off
+                    return
+                time.sleep(delay)
+                if roll < behaviour["hang_rate"] + behaviour["error_rate"]:
+                    self.send_error(503, "Simulated upstream failure")
+                    return
+
+                response = server.responder.respond(_last_user_message(body.get("contents", [])))
+                response.pop("fallback")
+                text = json.dumps(response)
+                if "stream=1" in self.path:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.end_headers()
+                    size = behaviour["chunk_size"]
+                    for position in range(0, len(text), size):
+                        self.wfile.write((json.dumps({"text": text[position:position + size]}) + "\n").encode('utf-8'))
+                        self.wfile.flush()
+                        time.sleep(delay / 20)
+                    return
+                payload = json.dumps({"text": text}).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def start(self):
+        """Serves on a background thread (for benchmarks and tests)."""
+        threading.Thread(target=self.httpd.serve_forever, name="fake-llm-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline stand-in for the LLM API.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 503.")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Share of requests that never answer.")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.hang_rate)
+    print(f"--- Fake LLM server listening on {server.url} ---")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from cache_utils import LRUTTLCache, SingleFlight
+
+LLM_CACHE_SIZE = 2048
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', 3600))
+
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+def normalize_message(message: str) -> str:
+    """Case, punctuation and spacing do not change the request: 'Taco night!' == 'taco  night'."""
+    return " ".join(_WORD_PATTERN.findall(message.lower()))
+
+def conversation_fingerprint(window: dict = None) -> str:
+    """
+    Identifies the conversation a prompt is built from (a ConversationStore.window): '' when there is none yet,
+    so opening messages are shared between users, otherwise a digest of the turns and summary.
+    """
+    if not window or not (window.get("turns") or window.get("summary")):
+        return ""
+    return hashlib.sha1(json.dumps([window.get("summary", ""), window.get("turns", [])]).encode('utf-8')).hexdigest()
+
+def is_cacheable_response(parsed_json) -> bool:
+    """
+    Only fresh list generations from the model are reused. Edits ('add_item', 'remove_item', ...) and plain-text
+    replies depend on the conversation so far, not just the message; local fallback answers are not model output.
+    """
+    return (isinstance(parsed_json, dict) and isinstance(parsed_json.get("list_items"), list)
+            and parsed_json.get("action", "new_list") == "new_list" and not parsed_json.get("fallback"))
+
+
+class LLMResponseCache:
+    """
+    Parsed model responses for list-generation requests, keyed on the catalog version, the normalized
+    message and the conversation it was sent in (conversation_fingerprint), with a TTL. Concurrent identical
+    requests share one upstream call. Prompts carry the chat history and what was retrieved for it, so
+    only requests made in the same conversation state share a response, in practice opening messages. Stock and substitutes are
+    not cached: callers enrich the cached list_items against live inventory on every request.
+    Cached responses are shared between requests and must be treated as read-only.
+    """
+
+    def __init__(self, catalog_version: str, max_entries: int = LLM_CACHE_SIZE, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.catalog_version = catalog_version
+        self._responses = LRUTTLCache(max_entries, ttl_seconds)
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+
+    def key(self, message: str, conversation: str = "") -> tuple:
+        return (self.catalog_version, conversation, normalize_message(message))
+
+    def get(self, message: str, conversation: str = ""):
+        """The cached parsed response for a message sent in a conversation (its fingerprint), or None."""
+        return self._responses.get(self.key(message, conversation))
+
+    def store(self, message: str, parsed_json, conversation: str = ""):
+        """Caches a response obtained elsewhere (e.g. streamed) if it is a list generation."""
+        if is_cacheable_response(parsed_json):
+            self._responses.set(self.key(message, conversation), parsed_json)
+
+    def get_or_generate(self, message: str, generate, conversation: str = "") -> tuple:
+        """
+        Returns (parsed_json, source) where source is 'hit', 'miss' (this request called generate())
+        or 'coalesced' (it waited for an identical request in the same conversation state already calling
+        the model). Exceptions from generate() reach every coalesced caller.
+        """
+        key = self.key(message, conversation)
+        cached = self._responses.get(key)
+        if cached is not None:
+            return cached, "hit"
+
+        def call_upstream():
+            with self._lock:
+                self.upstream_calls += 1
+            parsed_json = generate()
+            if is_cacheable_response(parsed_json):
+                self._responses.set(key, parsed_json)
+            return parsed_json
+
+        parsed_json, ran_upstream = self._single_flight.do(key, call_upstream)
+        return parsed_json, ("miss" if ran_upstream else "coalesced")
+
+    def stats(self) -> dict:
+        stats = self._responses.stats()
+        coalesced = self._single_flight.followers
+        requests = stats["hits"] + stats["misses"]
+        stats.update({
+            "catalog_version": self.catalog_version,
+            "upstream_calls": self.upstream_calls,
+            "coalesced": coalesced,
+            # Requests answered without their own model call
+            "saved_call_rate": round((stats["hits"] + coalesced) / requests, 4) if requests else None
+        })
+        return stats
@@ -0,0 +1,333 @@
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+try:
+    import google.generativeai as genai
+    GEMINI_AVAILABLE = True
+except ImportError: # Optional: without it only the 'http' and 'local' backends are available
+    genai = None
+    GEMINI_AVAILABLE = False
+
+LLM_BACKENDS = ("gemini", "http", "local")
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8)) # upstream calls in flight per process
+LLM_DEADLINE_SECONDS = float(os.getenv('LLM_DEADLINE_SECONDS', 20)) # whole call, retries and queueing included
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_BACKOFF_BASE_SECONDS = 0.25
+LLM_BREAKER_FAILURE_THRESHOLD = 5 # consecutive failures that open the circuit
+LLM_BREAKER_RESET_SECONDS = 30.0 # how long the circuit stays open before one probe call
+LOCAL_LIST_SIZE = 8
+
+
+class LLMBackendError(Exception):
+    """An upstream call failed. retryable=False for errors a retry cannot fix (e.g. a rejected request)."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _last_user_message(conversation: list) -> str:
+    for turn in reversed(conversation):
+        if turn.get("role") == "user":
+            parts = turn.get("parts") or [turn.get("text", "")]
+            return " ".join(str(part) for part in parts)
+    return ""
+
+
+# --- 1. Backends ---
+# A backend turns a Gemini-style conversation ([{'role', 'parts'}]) into the model's JSON response text.
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self, api_key: str, model_name: str = GEMINI_MODEL_NAME):
+        if not GEMINI_AVAILABLE:
+            raise RuntimeError("google-generativeai is not installed.")
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, conversation: list, timeout: float) -> str:
+        try:
+            response = self.model.generate_content(
+                conversation,
+                generation_config={"response_mime_type": "application/json"},
+                request_options={"timeout": timeout}
+            )
+            return response.text
+        except Exception as e:
+            raise LLMBackendError(f"Gemini call failed: {e}")
+
+    def stream(self, conversation: list, timeout: float):
+        try:
+            response_stream = self.model.generate_content(
+                conversation,
+                generation_config={"response_mime_type": "application/json"},
+                request_options={"timeout": timeout},
+                stream=True
+            )
+            for chunk in response_stream:
+                yield chunk.text
+        except Exception as e:
+            raise LLMBackendError(f"Gemini stream failed: {e}")
+
+
+class HTTPBackend:
+    """
+    A model behind a plain JSON endpoint (see fake_llm_server.py): POST {'contents': conversation} returns
+    {'text': ...}; with ?stream=1 the response is newline-delimited {'text': chunk} objects.
+    """
+    name = "http"
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def _open(self, conversation: list, timeout: float, stream: bool):
+        url = self.url + ("?stream=1" if stream else "")
+        request = urllib.request.Request(url, data=json.dumps({"contents": conversation}).encode('utf-8'),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            return urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            raise LLMBackendError(f"HTTP {e.code} from {self.url}", retryable=(e.code == 429 or e.code >= 500))
+        except (urllib.error.URLError, OSError) as e: # refused, reset or timed out
+            raise LLMBackendError(f"Could not reach {self.url}: {e}")
+
+    def generate(self, conversation: list, timeout: float) -> str:
+        with self._open(conversation, timeout, stream=False) as response:
+            try:
+                return json.loads(response.read())["text"]
+            except (OSError, ValueError, KeyError) as e:
+                raise LLMBackendError(f"Bad response from {self.url}: {e}")
+
+    def stream(self, conversation: list, timeout: float):
+        with self._open(conversation, timeout, stream=True) as response:
+            try:
+                for line in response:
+                    if line.strip():
+                        yield json.loads(line)["text"]
+            except (OSError, ValueError, KeyError) as e:
+                raise LLMBackendError(f"Stream from {self.url} broke: {e}")
+
+
+class LocalListBackend:
+    """
+    Deterministic, offline stand-in for the model: builds a 'new_list' answer from the products that best
+    match the user's message. Used as the fallback when the upstream is failing or saturated.
+    """
+    name = "local"
+
+    def __init__(self, retriever, list_size: int = LOCAL_LIST_SIZE):
+        self.retriever = retriever
+        self.list_size = list_size
+
+    def respond(self, user_message: str) -> dict:
+        products = self.retriever.retrieve(user_message, top_n=self.list_size)
+        return {
+            "action": "new_list",
+            "list_items": [{"product_id": product['product_id'], "quantity": 1, "reason": "Matches your request"}
+                           for product in products],
+            "fallback": True # answered locally; not cached as a model response
+        }
+
+    def generate(self, conversation: list, timeout: float = None) -> str:
+        return json.dumps(self.respond(_last_user_message(conversation)))
+
+    def stream(self, conversation: list, timeout: float = None):
+        yield self.generate(conversation)
+
+
+# --- 2. Circuit Breaker ---
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures so callers stop waiting on a broken upstream.
+    After reset_seconds one probe call is let through (half-open); its result closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.times_opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def cancel_probe(self):
+        """Lets another call probe when the permitted one gave up before reaching the upstream."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self.state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+# --- 3. Client ---
+class LLMClient:
+    """
+    Calls a backend with a bounded number of calls in flight, a deadline per call (queueing and retries
+    included), retries with full-jitter exponential backoff, and a circuit breaker. Whenever the backend
+    cannot answer in time the deterministic fallback answers instead, so latency is capped by the deadline.
+    """
+
+    def __init__(self, backend, fallback: LocalListBackend = None, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 deadline_seconds: float = LLM_DEADLINE_SECONDS, max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base_seconds: float = LLM_BACKOFF_BASE_SECONDS, breaker: CircuitBreaker = None):
+        self.backend = backend
+        self.fallback = fallback
+        self.max_concurrency = max_concurrency
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "backend_successes": 0, "retries": 0, "failures": 0,
+                          "fallbacks": 0, "rejected_by_breaker": 0, "queue_timeouts": 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _fall_back(self, conversation: list, reason: str):
+        self._count("fallbacks")
+        if self.fallback is None:
+            raise LLMBackendError(f"Model unavailable ({reason}) and no fallback configured.", retryable=False)
+        return self.fallback.generate(conversation)
+
+    def _acquire(self, deadline: float) -> bool:
+        """Takes a concurrency slot (waiting no longer than the deadline) and asks the breaker for permission."""
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._count("queue_timeouts")
+            return False
+        if not self.breaker.allow():
+            self._slots.release()
+            self._count("rejected_by_breaker")
+            return False
+        return True
+
+    def _call_with_retries(self, deadline: float, attempt_call):
+        """Runs attempt_call(timeout) until it succeeds; returns its result, or None when the fallback should answer."""
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if attempt == 0:
+                    self.breaker.cancel_probe()
+                break
+            try:
+                result = attempt_call(remaining)
+                self.breaker.record_success()
+                self._count("backend_successes")
+                return result
+            except LLMBackendError as e:
+                self._count("failures")
+                print(f"Warning (llm_client.py): {self.backend.name} attempt {attempt + 1} failed: {e}")
+                if not e.retryable:
+                    self.breaker.record_success() # the upstream answered; the request itself was bad
+                    return None
+                self.breaker.record_failure()
+                backoff = random.uniform(0, self.backoff_base_seconds * (2 ** attempt))
+                if attempt == self.max_retries or self.breaker.state == "open" or time.monotonic() + backoff >= deadline:
+                    break
+                self._count("retries")
+                time.sleep(backoff)
+        return None
+
+    def generate(self, conversation: list, deadline_seconds: float = None) -> tuple:
+        """Returns (response_text, source) where source is the backend name or 'fallback'."""
+        self._count("calls")
+        deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+        if not self._acquire(deadline):
+            return self._fall_back(conversation, "overloaded or circuit open"), "fallback"
+        try:
+            text = self._call_with_retries(deadline, lambda timeout: self.backend.generate(conversation, timeout))
+        finally:
+            self._slots.release()
+        if text is None:
+            return self._fall_back(conversation, "backend failed or timed out"), "fallback"
+        return text, self.backend.name
+
+    def stream(self, conversation: list, deadline_seconds: float = None):
+        """
+        Yields response text chunks, holding a concurrency slot until the stream ends. Retries and the fallback
+        only apply until the first chunk arrives; a stream that breaks after that raises LLMBackendError,
+        since its chunks have already been used.
+        """
+        self._count("calls")
+        deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+        if not self._acquire(deadline):
+            yield self._fall_back(conversation, "overloaded or circuit open")
+            return
+        try:
+            def open_stream(timeout):
+                chunks = self.backend.stream(conversation, timeout)
+                return chunks, next(chunks, "") # the first chunk proves the call went through
+
+            opened = self._call_with_retries(deadline, open_stream)
+            if opened is None:
+                yield self._fall_back(conversation, "backend failed or timed out")
+                return
+            chunks, first_chunk = opened
+            yield first_chunk
+            yield from chunks
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({"backend": self.backend.name, "breaker_state": self.breaker.state,
+                      "breaker_times_opened": self.breaker.times_opened, "max_concurrency": self.max_concurrency,
+                      "deadline_seconds": self.deadline_seconds})
+        return stats
+
+
+def create_llm_client(retriever) -> LLMClient:
+    """
+    Builds the client from the environment: LLM_BACKEND ('gemini', 'http' or 'local'; defaults to 'gemini')
+    and LLM_HTTP_URL for the 'http' backend. The local list generator is only the primary backend when
+    LLM_BACKEND=local is set; a missing GOOGLE_API_KEY is an error rather than a silent switch to it.
+    """
+    api_key = os.getenv("GOOGLE_API_KEY")
+    backend_name = os.getenv("LLM_BACKEND", "gemini")
+    fallback = LocalListBackend(retriever)
+    if backend_name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND '{backend_name}'. Use one of {LLM_BACKENDS}.")
+    if backend_name == "gemini":
+        if not api_key:
+            raise ValueError("GOOGLE_API_KEY not found (set LLM_BACKEND=local or http to run without Gemini).")
+        backend = GeminiBackend(api_key)
+    elif backend_name == "http":
+        backend = HTTPBackend(os.getenv("LLM_HTTP_URL", "http://127.0.0.1:8081/generate"))
+    else:
+        backend = fallback
+    return LLMClient(backend, fallback)
@@ -0,0 +1,157 @@
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+
+# --- Data Loading (from local JSONs) ---
+def load_data_local(filename):
+    """Helper function to load JSON data locally."""
+    if not os.path.exists(filename):
+        print(f"Error (product_retriever.py): Data file '{filename}' not found. Please ensure it's generated.")
+        return []
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        print(f"Error (product_retriever.py): Could not decode JSON from '{filename}'. Check file format.")
+        return []
+
+products_data_retrieval = load_data_local('products.json')
+customer_purchases_data_retrieval = load_data_local('customer_purchases.json')
+
+# --- 1. Text Processing ---
+RETRIEVAL_TOP_N = int(os.getenv('RETRIEVAL_TOP_N', 40)) # products put in each prompt
+RETRIEVAL_HISTORY_TURNS = 3 # earlier user messages added to the query
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Field weights, applied by repeating a field's tokens (a simple BM25F)
+FIELD_WEIGHTS = {"product_name": 3, "brand": 2, "category": 2, "subcategory": 1, "attributes": 1}
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_STOP_WORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "buy", "can", "for", "from", "get", "i", "in", "is", "it", "me",
+    "my", "need", "of", "on", "or", "please", "some", "the", "to", "want", "we", "with", "you"
+))
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens with stop words removed and plurals folded ('berries' -> 'berry', 'chips' -> 'chip')."""
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in _STOP_WORDS:
+            continue
+        if len(token) > 4 and token.endswith("ies"):
+            token = token[:-3] + "y"
+        elif len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+def _attribute_text(attributes: dict) -> str:
+    """Attribute names that are set (e.g. 'fragrance_free': true) and text values; numbers are left out."""
+    words = []
+    for name, value in (attributes or {}).items():
+        if value is True:
+            words.append(name.replace("_", " "))
+        elif isinstance(value, str):
+            words.append(value)
+    return " ".join(words)
+
+def product_document(product: dict) -> list:
+    """Weighted token list indexed for a product."""
+    tokens = []
+    for field, weight in FIELD_WEIGHTS.items():
+        text = _attribute_text(product.get(field)) if field == "attributes" else str(product.get(field) or "")
+        tokens.extend(tokenize(text) * weight)
+    return tokens
+
+# --- 2. BM25 Index ---
+class ProductRetriever:
+    """
+    Okapi BM25 over the product catalog, built once at startup, so a prompt can carry the handful of
+    products relevant to a conversation instead of the whole catalog. When fewer than top_n products
+    match, the rest of the budget is filled with best sellers so the prompt size stays fixed.
+    """
+
+    def __init__(self, products: list, popularity: dict = None):
+        self.products = list(products)
+        # Changes whenever the indexed catalog does; cached model answers are keyed on it
+        self.catalog_version = hashlib.sha1(json.dumps(self.products, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.postings = {} # token -> [(product ordinal, term frequency)]
+        self.document_lengths = []
+        for ordinal, product in enumerate(self.products):
+            term_counts = Counter(product_document(product))
+            self.document_lengths.append(sum(term_counts.values()))
+            for token, count in term_counts.items():
+                self.postings.setdefault(token, []).append((ordinal, count))
+        num_products = len(self.products)
+        self.average_length = (sum(self.document_lengths) / num_products) if num_products else 0.0
+        average_length = self.average_length or 1.0
+        self.length_norms = [BM25_K1 * (1 - BM25_B + BM25_B * length / average_length) for length in self.document_lengths]
+        self.idf = {
+            token: math.log(1 + (num_products - len(postings) + 0.5) / (len(postings) + 0.5))
+            for token, postings in self.postings.items()
+        }
+        # Padding order: most purchased first, then catalog order
+        popularity = popularity or {}
+        self.popular_ordinals = sorted(range(num_products),
+                                       key=lambda ordinal: (-popularity.get(self.products[ordinal]['product_id'], 0), ordinal))
+
+    def score(self, query: str) -> dict:
+        """BM25 score per product ordinal for every product matching at least one query term."""
+        scores = {}
+        length_norms = self.length_norms
+        for token, query_count in Counter(tokenize(query)).items():
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = self.idf[token]
+            weight = query_count * idf * (BM25_K1 + 1)
+            for ordinal, term_frequency in postings:
+                scores[ordinal] = scores.get(ordinal, 0.0) + weight * term_frequency / (term_frequency + length_norms[ordinal])
+        return scores
+
+    def retrieve(self, query: str, top_n: int = RETRIEVAL_TOP_N, pad: bool = True) -> list:
+        """
+        The top_n products for a query, best match first (ties in catalog order), padded with best sellers.
+
+        Returns:
+            list: product dicts from the catalog (shared; do not modify).
+        """
+        scores = self.score(query)
+        ranked = heapq.nsmallest(top_n, scores, key=lambda ordinal: (-scores[ordinal], ordinal))
+        if pad and len(ranked) < top_n:
+            chosen = set(ranked)
+            for ordinal in self.popular_ordinals:
+                if len(ranked) >= top_n:
+                    break
+                if ordinal not in chosen:
+                    ranked.append(ordinal)
+        return [self.products[ordinal] for ordinal in ranked]
+
+def _purchase_counts(purchases: list) -> dict:
+    counts = Counter()
+    for row in purchases:
+        counts[row['product_id']] += row.get('quantity', 1)
+    return counts
+
+PRODUCT_RETRIEVER = ProductRetriever(products_data_retrieval, _purchase_counts(customer_purchases_data_retrieval))
+
+def retrieve_products_for_conversation(user_message: str, chat_history: list = None, top_n: int = RETRIEVAL_TOP_N) -> list:
+    """Products relevant to the new message and the user's last few messages."""
+    earlier_messages = [turn.get('text', '') for turn in (chat_history or []) if turn.get('role') == 'user']
+    query = " ".join(earlier_messages[-RETRIEVAL_HISTORY_TURNS:] + [user_message])
+    return PRODUCT_RETRIEVER.retrieve(query, top_n)
+
+
+# --- Example Usage (for testing this module independently) ---
+if __name__ == "__main__":
+    print("--- Running product_retriever.py for independent testing ---")
+    print(f"Indexed {len(PRODUCT_RETRIEVER.products)} products, {len(PRODUCT_RETRIEVER.postings)} distinct terms.")
+    for query in ("laundry detergent", "fragrance free body wash", "snacks for a party"):
+        print(f"\nTop 5 for '{query}':")
+        for product in PRODUCT_RETRIEVER.retrieve(query, top_n=5, pad=False):
+            print(f"  {product['product_id']}: {product['product_name']} ({product['brand']}, {product['category']})")
+    print("\n--- product_retriever.py independent testing complete ---")
@@ -1,6 +1,20 @@
+import atexit
+import heapq
 import json
+import os
+import threading
+import time
 from collections import defaultdict
-import os 
+
+from cache_utils import LRUTTLCache
+
+try:
+    import numpy as np
+    import scipy.sparse as sp
+    SPARSE_BUILD_AVAILABLE = True
+except ImportError: # Optional: the pure-Python FBT build is used without them
+    np = sp = None
+    SPARSE_BUILD_AVAILABLE = False
 
 # --- Data Loading (from local JSONs) ---
 def load_data_local(filename):
@@ -22,54 +36,667 @@ customer_purchases_data = load_data_local('customer_purchases.json')
 
 # --- 1. Core Recommendation Logic: Frequently Bought Together (FBT) ---
 
-# FBT_RULES will be populated by the function call below once when module loads
-FBT_RULES = {} # Initialize global FBT_RULES as an empty dict
+FBT_SNAPSHOT_FILE = 'fbt_snapshot.json'
+FBT_EVENTS_FILE = 'fbt_purchase_events.jsonl' # purchases recorded or removed through the API
+FBT_SNAPSHOT_EVERY_EVENTS = 500 # purchase events between snapshots (one is also written at exit)
+FBT_TOP_K = 25 # Neighbors kept per product
+FBT_MIN_SUPPORT = 2 # Minimum co-occurrence count for a neighbor to become a rule
 
-def build_frequently_bought_together_rules(purchases: list, min_support: int = 2) -> dict:
+def build_frequently_bought_together_rules(purchases: list, min_support: int = 2, method: str = "auto") -> dict:
     """
     Analyzes customer purchase history to find items frequently bought together.
-    Returns rules: { product_id: { recommended_product_id: count } }
+    Returns rules: { product_id: [{"product_id": recommended_product_id, "count": count}, ...] }
+    with neighbors ordered by descending count, ties broken by product_id.
+
+    method: 'python' (nested loops per basket), 'sparse' (NumPy/SciPy X^T.X over the
+    invoice x product incidence matrix), or 'auto' (sparse when NumPy/SciPy are installed).
+    Both methods return identical rules.
     """
     if not purchases:
         print("Warning (recs): No purchase data to build FBT rules.")
         return {}
 
-    transactions = defaultdict(list)
+    if method not in ("auto", "python", "sparse"):
+        raise ValueError(f"Unknown FBT build method '{method}'. Expected 'auto', 'python' or 'sparse'.")
+    if method == "auto":
+        method = "sparse" if SPARSE_BUILD_AVAILABLE else "python"
+    elif method == "sparse" and not SPARSE_BUILD_AVAILABLE:
+        print("Warning (recs): NumPy/SciPy not installed. Falling back to the pure-Python FBT build.")
+        method = "python"
+
+    transactions = _group_purchases_by_invoice(purchases)
+    if method == "sparse":
+        fbt_rules_local = _build_rules_sparse(transactions, min_support)
+    else:
+        co_occurrences = defaultdict(lambda: defaultdict(int))
+        for unique_items_in_transaction in transactions.values():
+            for item_a in unique_items_in_transaction:
+                for item_b in unique_items_in_transaction:
+                    if item_a != item_b:
+                        co_occurrences[item_a][item_b] += 1
+
+        fbt_rules_local = {} # Use a local variable for building the rules
+        for product_a, related_items in co_occurrences.items():
+            sorted_related = sorted(related_items.items(), key=lambda item: (-item[1], item[0]))
+
+            fbt_rules_local[product_a] = [
+                {"product_id": pid, "count": count}
+                for pid, count in sorted_related if count >= min_support
+            ]
+
+    print(f"DEBUG (recs): Built {len(fbt_rules_local)} FBT rules from {len(transactions)} transactions.")
+    return fbt_rules_local # FIX: Return the local fbt_rules_local variable
+
+
+def _co_occurrence_matrix(transactions: dict) -> tuple:
+    """
+    Builds the product x product co-occurrence matrix C = X^T.X, where X is the binary
+    invoice x product incidence matrix. Columns follow sorted product_id order.
+
+    Returns:
+        tuple: (product_ids, C as CSR with a zero diagonal, per-product transaction counts)
+    """
+    product_ids = sorted({pid for items in transactions.values() for pid in items})
+    column_of = {pid: i for i, pid in enumerate(product_ids)}
+
+    indptr = np.zeros(len(transactions) + 1, dtype=np.int64)
+    indices = np.fromiter(
+        (column_of[pid] for items in transactions.values() for pid in items),
+        dtype=np.int32, count=sum(len(items) for items in transactions.values())
+    )
+    np.cumsum([len(items) for items in transactions.values()], out=indptr[1:])
+    incidence = sp.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(transactions), len(product_ids))
+    )
+
+    co_occurrences = (incidence.T @ incidence).tocsr()
+    item_counts = co_occurrences.diagonal().copy()
+    co_occurrences.setdiag(0)
+    co_occurrences.eliminate_zeros()
+    co_occurrences.sort_indices()
+    return product_ids, co_occurrences, item_counts
+
+
+def _build_rules_sparse(transactions: dict, min_support: int) -> dict:
+    """Vectorized equivalent of the nested-loop rule build (see build_frequently_bought_together_rules)."""
+    product_ids, co_occurrences, _ = _co_occurrence_matrix(transactions)
+
+    # Every product with at least one co-occurrence gets a rule list, even if pruning empties it
+    has_neighbors = np.diff(co_occurrences.indptr) > 0
+
+    rows = np.repeat(np.arange(co_occurrences.shape[0]), np.diff(co_occurrences.indptr))
+    keep = co_occurrences.data >= min_support
+    rows, cols, counts = rows[keep], co_occurrences.indices[keep], co_occurrences.data[keep]
+    # Per row: descending count, then ascending column (= product_id order)
+    order = np.lexsort((cols, -counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    row_starts = np.searchsorted(rows, np.arange(len(product_ids) + 1))
+
+    fbt_rules_local = {}
+    for row in np.flatnonzero(has_neighbors):
+        start, end = row_starts[row], row_starts[row + 1]
+        fbt_rules_local[product_ids[row]] = [
+            {"product_id": product_ids[col], "count": count}
+            for col, count in zip(cols[start:end].tolist(), counts[start:end].tolist())
+        ]
+    return fbt_rules_local
+
+
+def _group_purchases_by_invoice(purchases: list) -> dict:
+    """Groups purchase rows into {invoice_id: set(product_ids)}, preserving first-seen invoice order."""
+    transactions = {}
     for purchase in purchases:
         if 'invoice_id' in purchase and 'product_id' in purchase:
-            transactions[purchase['invoice_id']].append(purchase['product_id'])
+            transactions.setdefault(purchase['invoice_id'], set()).add(purchase['product_id'])
+    return transactions
 
-    co_occurrences = defaultdict(lambda: defaultdict(int))
-    for invoice_id in transactions:
-        items_in_transaction = transactions[invoice_id]
-        unique_items_in_transaction = list(set(items_in_transaction)) 
-        
-        for i, item_a in enumerate(unique_items_in_transaction):
-            for j, item_b in enumerate(unique_items_in_transaction):
+
+def _count_co_occurrences(transactions) -> tuple:
+    """Bulk pair and item counts over an iterable of product-id sets."""
+    pair_counts = defaultdict(lambda: defaultdict(int))
+    item_counts = defaultdict(int)
+    for items in transactions:
+        for item_a in items:
+            item_counts[item_a] += 1
+            neighbors = pair_counts[item_a]
+            for item_b in items:
                 if item_a != item_b:
-                    co_occurrences[item_a][item_b] += 1
-    
-    fbt_rules_local = {} # Use a local variable for building the rules
-    for product_a, related_items in co_occurrences.items():
-        sorted_related = sorted(related_items.items(), key=lambda item: item[1], reverse=True)
-        
-        fbt_rules_local[product_a] = [
-            {"product_id": pid, "count": count} 
-            for pid, count in sorted_related if count >= min_support
+                    neighbors[item_b] += 1
+    return pair_counts, item_counts
+
+
+def _count_co_occurrences_sparse(transactions: dict) -> tuple:
+    """Same result as _count_co_occurrences, with the pair counting done as one sparse product."""
+    product_ids, co_occurrences, diagonal = _co_occurrence_matrix(transactions)
+    pair_counts = {}
+    indptr, indices, data = co_occurrences.indptr, co_occurrences.indices.tolist(), co_occurrences.data.tolist()
+    for row, product_id in enumerate(product_ids):
+        start, end = indptr[row], indptr[row + 1]
+        if start != end:
+            pair_counts[product_id] = {product_ids[col]: count for col, count in zip(indices[start:end], data[start:end])}
+    item_counts = defaultdict(int, zip(product_ids, diagonal.tolist()))
+    return pair_counts, item_counts
+
+
+class CoOccurrenceStore:
+    """
+    Incrementally maintained "frequently bought together" model.
+
+    Keeps pairwise co-occurrence counts over transactions plus a bounded top-k neighbor list per
+    product, so a new or cancelled transaction only touches the products in its basket.
+    `rules` mirrors the shape returned by build_frequently_bought_together_rules (truncated to top_k).
+    """
+
+    def __init__(self, top_k: int = FBT_TOP_K, min_support: int = FBT_MIN_SUPPORT):
+        self.top_k = top_k
+        self.min_support = min_support
+        self.transactions = {} # invoice_id -> set(product_ids)
+        self.pair_counts = defaultdict(dict) # product_id -> {neighbor_id: count}
+        self.item_counts = defaultdict(int) # product_id -> number of transactions containing it
+        self.top_neighbors = {} # product_id -> neighbor ids sorted by (-count, product_id), at most top_k
+        self.rules = {} # product_id -> [{"product_id", "count"}], the serving view
+        self.rows_applied = 0 # Purchase log rows folded in (the log is append-only)
+        self.last_row_key = None # (invoice_id, product_id) of the last folded row, to detect rewritten logs
+        self.events_applied = 0 # Purchase event log entries folded in (see PurchaseEventLog)
+        self.version = 0 # Bumped on every change so caches can invalidate
+        self._lock = threading.RLock()
+
+    # --- Building ---
+
+    @classmethod
+    def from_transactions(cls, transactions: dict, top_k: int = FBT_TOP_K, min_support: int = FBT_MIN_SUPPORT):
+        """Bulk-builds a store from {invoice_id: product_ids} in one counting pass."""
+        store = cls(top_k, min_support)
+        store.transactions = {invoice_id: set(items) for invoice_id, items in transactions.items()}
+        if SPARSE_BUILD_AVAILABLE and store.transactions:
+            pair_counts, item_counts = _count_co_occurrences_sparse(store.transactions)
+        else:
+            pair_counts, item_counts = _count_co_occurrences(store.transactions.values())
+        store.pair_counts = defaultdict(dict, {pid: dict(neighbors) for pid, neighbors in pair_counts.items()})
+        store.item_counts = item_counts
+        for product_id in store.pair_counts:
+            store._rebuild_top_neighbors(product_id)
+        return store
+
+    def _sort_key(self, product_id: str):
+        counts = self.pair_counts[product_id]
+        return lambda neighbor_id: (-counts[neighbor_id], neighbor_id)
+
+    def _rebuild_top_neighbors(self, product_id: str):
+        """Recomputes one product's top-k from its full neighbor counts. O(neighbors)."""
+        counts = self.pair_counts.get(product_id)
+        if not counts:
+            self.pair_counts.pop(product_id, None)
+            self.top_neighbors.pop(product_id, None)
+            self.rules.pop(product_id, None)
+            return
+        self.top_neighbors[product_id] = heapq.nsmallest(self.top_k, counts, key=self._sort_key(product_id))
+        self._refresh_rules(product_id)
+
+    def _refresh_rules(self, product_id: str):
+        counts = self.pair_counts[product_id]
+        self.rules[product_id] = [
+            {"product_id": neighbor_id, "count": counts[neighbor_id]}
+            for neighbor_id in self.top_neighbors.get(product_id, []) if counts[neighbor_id] >= self.min_support
         ]
-    
-    print(f"DEBUG (recs): Built {len(fbt_rules_local)} FBT rules from {len(transactions)} transactions.")
-    return fbt_rules_local # FIX: Return the local fbt_rules_local variable
 
-# Build FBT rules once when the module loads
-FBT_RULES.update(build_frequently_bought_together_rules(customer_purchases_data)) # Populate the global FBT_RULES here
+    # --- Incremental updates ---
+
+    def _apply_basket(self, items: set, delta: int):
+        """Adds (delta=+1) or subtracts (delta=-1) one basket's pairs, keeping top-k lists current."""
+        for item_a in items:
+            self.item_counts[item_a] += delta
+            if self.item_counts[item_a] <= 0:
+                del self.item_counts[item_a]
+            counts = self.pair_counts[item_a]
+            top = self.top_neighbors.get(item_a, [])
+            needs_rebuild = False
+            for item_b in items:
+                if item_a == item_b:
+                    continue
+                new_count = counts.get(item_b, 0) + delta
+                if new_count > 0:
+                    counts[item_b] = new_count
+                else:
+                    counts.pop(item_b, None)
+
+                if delta > 0:
+                    if item_b not in top:
+                        top.append(item_b)
+                elif item_b in top and len(counts) > len(top) - (new_count <= 0):
+                    # A neighbor outside the top-k may now outrank this one
+                    needs_rebuild = True
+                elif new_count <= 0 and item_b in top:
+                    top.remove(item_b)
+
+            if needs_rebuild:
+                self._rebuild_top_neighbors(item_a)
+                continue
+            if not counts:
+                del self.pair_counts[item_a]
+                self.top_neighbors.pop(item_a, None)
+                self.rules.pop(item_a, None)
+                continue
+            top.sort(key=self._sort_key(item_a))
+            del top[self.top_k:]
+            self.top_neighbors[item_a] = top
+            self._refresh_rules(item_a)
+
+    def add_transaction(self, invoice_id, product_ids):
+        """Folds a purchase into the model. Items for an already known invoice are merged into it."""
+        invoice_id = str(invoice_id)
+        with self._lock:
+            existing = self.transactions.get(invoice_id)
+            items = set(product_ids) | (existing or set())
+            if existing == items:
+                return
+            if existing:
+                self._apply_basket(existing, -1)
+            self.transactions[invoice_id] = items
+            self._apply_basket(items, +1)
+            self.version += 1
+
+    def remove_transaction(self, invoice_id, product_ids=None):
+        """Removes a whole invoice from the model, or only the given products from it (e.g. a return)."""
+        invoice_id = str(invoice_id)
+        with self._lock:
+            existing = self.transactions.get(invoice_id)
+            if not existing:
+                return
+            remaining = existing - set(product_ids) if product_ids is not None else set()
+            self._apply_basket(existing, -1)
+            if remaining:
+                self.transactions[invoice_id] = remaining
+                self._apply_basket(remaining, +1)
+            else:
+                del self.transactions[invoice_id]
+            self.version += 1
+
+    def apply_purchase_rows(self, rows: list):
+        """Folds new rows of the (append-only) purchase log into the model."""
+        with self._lock:
+            for invoice_id, items in _group_purchases_by_invoice(rows).items():
+                self.add_transaction(invoice_id, items)
+            self.rows_applied += len(rows)
+            if rows:
+                self.last_row_key = [rows[-1].get('invoice_id'), rows[-1].get('product_id')]
+
+    def apply_purchase_event(self, event: dict):
+        """Folds one purchase event log entry ({'op': 'add' or 'remove', 'invoice_id', 'product_ids'}) into the model."""
+        with self._lock:
+            if event['op'] == "add":
+                self.add_transaction(event['invoice_id'], event['product_ids'])
+            else:
+                self.remove_transaction(event['invoice_id'], event.get('product_ids'))
+            self.events_applied += 1
+
+    # --- Snapshots ---
+
+    def save_snapshot(self, filename: str = FBT_SNAPSHOT_FILE):
+        """Writes the model atomically (temp file + rename) so a crash never leaves a torn snapshot."""
+        with self._lock:
+            snapshot = {
+                "format": 1,
+                "top_k": self.top_k,
+                "min_support": self.min_support,
+                "rows_applied": self.rows_applied,
+                "last_row_key": self.last_row_key,
+                "events_applied": self.events_applied,
+                "transactions": {inv: sorted(items) for inv, items in self.transactions.items()},
+                "pair_counts": self.pair_counts,
+                "item_counts": self.item_counts,
+                "top_neighbors": self.top_neighbors
+            }
+            temp_filename = f"{filename}.tmp"
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(temp_filename, filename)
+
+    @classmethod
+    def load_snapshot(cls, filename: str = FBT_SNAPSHOT_FILE, top_k: int = FBT_TOP_K, min_support: int = FBT_MIN_SUPPORT):
+        """Loads a snapshot written with the same parameters. Returns None if missing, corrupt or stale."""
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warning (recs): Could not read FBT snapshot '{filename}': {e}. Rebuilding.")
+            return None
+        if snapshot.get('format') != 1 or snapshot.get('top_k') != top_k or snapshot.get('min_support') != min_support:
+            return None
+
+        store = cls(top_k, min_support)
+        store.rows_applied = snapshot['rows_applied']
+        store.last_row_key = snapshot['last_row_key']
+        store.events_applied = snapshot.get('events_applied', 0)
+        store.transactions = {inv: set(items) for inv, items in snapshot['transactions'].items()}
+        store.pair_counts = defaultdict(dict, snapshot['pair_counts'])
+        store.item_counts = defaultdict(int, snapshot['item_counts'])
+        store.top_neighbors = snapshot['top_neighbors']
+        for product_id in store.top_neighbors:
+            store._refresh_rules(product_id)
+        return store
+
+
+class PurchaseEventLog:
+    """
+    Append-only JSON-lines log of purchases recorded and removed through the API, so they survive a
+    restart: each entry is on disk before the call returns. The FBT snapshot records how many entries
+    it covers, and start-up replays the rest.
+    """
+
+    def __init__(self, path: str = FBT_EVENTS_FILE):
+        self.path = path
+        self._file = None # opened on first append
+        self._lock = threading.Lock()
+
+    def append(self, event: dict):
+        line = json.dumps(event, separators=(',', ':')) + "\n"
+        with self._lock:
+            if self._file is None:
+                torn_tail = os.path.exists(self.path) and os.path.getsize(self.path) > 0 and not self._ends_with_newline()
+                self._file = open(self.path, 'a', encoding='utf-8')
+                if torn_tail:
+                    self._file.write("\n") # a crash mid-write left half a line; start the next entry on its own
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def read(self) -> list:
+        """Every complete entry, in order. Lines torn by a crash are skipped (and never counted)."""
+        if not os.path.exists(self.path):
+            return []
+        events = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return events
 
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
-def get_fbt_recommendations(current_list_product_ids: list, num_recommendations: int = 3) -> list:
+
+def load_or_build_fbt_store(purchases: list, snapshot_file: str = FBT_SNAPSHOT_FILE, events: list = ()) -> CoOccurrenceStore:
+    """
+    Loads the FBT model from its snapshot and folds in purchase rows appended since it was written,
+    then replays the purchase events (PurchaseEventLog.read()) it does not cover yet.
+    Falls back to a full rebuild if there is no usable snapshot or either log was rewritten.
+    """
+    store = CoOccurrenceStore.load_snapshot(snapshot_file)
+    if store is not None:
+        applied = store.rows_applied
+        log_matches = applied <= len(purchases) and store.events_applied <= len(events) and (
+            applied == 0 or [purchases[applied - 1].get('invoice_id'), purchases[applied - 1].get('product_id')] == store.last_row_key
+        )
+        if not log_matches:
+            print("DEBUG (recs): Purchase log changed since the FBT snapshot. Rebuilding.")
+            store = None
+
+    if store is None:
+        store = CoOccurrenceStore.from_transactions(_group_purchases_by_invoice(purchases))
+        store.rows_applied = len(purchases)
+        if purchases:
+            store.last_row_key = [purchases[-1].get('invoice_id'), purchases[-1].get('product_id')]
+        print(f"DEBUG (recs): Built FBT model for {len(store.rules)} products from {len(store.transactions)} transactions.")
+    elif store.rows_applied < len(purchases):
+        new_rows = len(purchases) - store.rows_applied
+        store.apply_purchase_rows(purchases[store.rows_applied:])
+        print(f"DEBUG (recs): Loaded FBT snapshot and folded in {new_rows} new purchase rows.")
+    else:
+        print(f"DEBUG (recs): Loaded FBT snapshot for {len(store.rules)} products.")
+        if store.events_applied == len(events):
+            return store
+
+    new_events = events[store.events_applied:]
+    for event in new_events:
+        store.apply_purchase_event(event)
+    if new_events:
+        print(f"DEBUG (recs): Replayed {len(new_events)} purchase events.")
+
+    try:
+        store.save_snapshot(snapshot_file)
+    except OSError as e:
+        print(f"Warning (recs): Could not write FBT snapshot '{snapshot_file}': {e}")
+    return store
+
+
+# Load the FBT model once when the module loads; FBT_RULES is its live serving view.
+PURCHASE_EVENT_LOG = PurchaseEventLog(FBT_EVENTS_FILE)
+FBT_STORE = load_or_build_fbt_store(customer_purchases_data, events=PURCHASE_EVENT_LOG.read())
+FBT_RULES = FBT_STORE.rules
+_purchase_events_lock = threading.Lock() # the log and the model see events in the same order
+_fbt_snapshot_lock = threading.Lock()
+_fbt_snapshot_events = FBT_STORE.events_applied # events covered by the last snapshot written
+
+
+def _apply_purchase_event(event: dict):
+    """Logs an event, then folds it into the model; caller holds _purchase_events_lock."""
+    PURCHASE_EVENT_LOG.append(event)
+    FBT_STORE.apply_purchase_event(event)
+
+
+def _snapshot_when_due():
+    if FBT_STORE.events_applied - _fbt_snapshot_events >= FBT_SNAPSHOT_EVERY_EVENTS and not _fbt_snapshot_lock.locked():
+        threading.Thread(target=save_fbt_snapshot, name="fbt-snapshot", daemon=True).start()
+
+
+def record_purchase(invoice_id, product_ids: list):
+    """Folds a new purchase into the FBT model without a restart; it is logged to disk first, so it survives one."""
+    with _purchase_events_lock:
+        _apply_purchase_event({"op": "add", "invoice_id": str(invoice_id), "product_ids": list(product_ids)})
+    _snapshot_when_due()
+
+
+def remove_purchase(invoice_id, product_ids: list = None) -> bool:
+    """
+    Removes a cancelled purchase (or returned items from it) from the FBT model, logged like record_purchase.
+    Returns False if the invoice is not in the model.
+    """
+    with _purchase_events_lock:
+        if str(invoice_id) not in FBT_STORE.transactions:
+            return False
+        _apply_purchase_event({"op": "remove", "invoice_id": str(invoice_id),
+                               "product_ids": list(product_ids) if product_ids is not None else None})
+    _snapshot_when_due()
+    return True
+
+
+def save_fbt_snapshot():
+    """Persists the FBT model so the next start-up loads it and replays only newer purchase events."""
+    global _fbt_snapshot_events
+    with _fbt_snapshot_lock:
+        events_applied = FBT_STORE.events_applied
+        try:
+            FBT_STORE.save_snapshot(FBT_SNAPSHOT_FILE)
+        except OSError as e:
+            print(f"Warning (recs): Could not write FBT snapshot '{FBT_SNAPSHOT_FILE}': {e}")
+            return
+        _fbt_snapshot_events = events_applied
+
+
+def _save_fbt_snapshot_at_exit():
+    if FBT_STORE.events_applied != _fbt_snapshot_events:
+        save_fbt_snapshot()
+    PURCHASE_EVENT_LOG.close()
+
+atexit.register(_save_fbt_snapshot_at_exit)
+
+
+# --- 2. Association Rules (support / confidence / lift) ---
+
+RULE_SCORING_MODES = ("count", "confidence", "lift")
+ASSOCIATION_TOP_K = 10 # Consequents kept per antecedent
+ASSOCIATION_MIN_CONFIDENCE = 0.0
+ASSOCIATION_MIN_LIFT = 1.0 # Only keep positively correlated pairs
+ASSOCIATION_RULES_REFRESH_SECONDS = 60 # Minimum age before rules are re-mined after FBT model changes
+
+
+def mine_association_rules(store: CoOccurrenceStore, score_by: str = "lift", min_support: int = FBT_MIN_SUPPORT,
+                           min_confidence: float = ASSOCIATION_MIN_CONFIDENCE, min_lift: float = ASSOCIATION_MIN_LIFT,
+                           top_k: int = ASSOCIATION_TOP_K) -> dict:
+    """
+    Mines pair rules A -> B from the FBT model's co-occurrence counts:
+        support    = count(A, B) / transactions
+        confidence = count(A, B) / count(A)
+        lift       = confidence / (count(B) / transactions)
+
+    As in FP-Growth's first pass, items below min_support are pruned before any pair is
+    considered (no pair containing them can be frequent). Each antecedent keeps only its
+    top_k rules, pre-sorted by score_by (descending, ties by product_id), so serving never sorts.
+
+    Returns:
+        dict: { antecedent_id: [{"product_id", "count", "support", "confidence", "lift", "score"}, ...] }
+    """
+    if score_by not in ("confidence", "lift"):
+        raise ValueError(f"Association rules are scored by 'confidence' or 'lift', not '{score_by}'.")
+
+    with store._lock:
+        num_transactions = len(store.transactions)
+        if not num_transactions:
+            return {}
+        item_counts = {pid: count for pid, count in store.item_counts.items() if count >= min_support}
+
+        association_rules = {}
+        for antecedent, antecedent_count in item_counts.items():
+            candidates = []
+            for consequent, pair_count in store.pair_counts.get(antecedent, {}).items():
+                consequent_count = item_counts.get(consequent)
+                if consequent_count is None or pair_count < min_support:
+                    continue
+                confidence = pair_count / antecedent_count
+                lift = confidence * num_transactions / consequent_count
+                if confidence < min_confidence or lift < min_lift:
+                    continue
+                candidates.append({
+                    "product_id": consequent,
+                    "count": pair_count,
+                    "support": pair_count / num_transactions,
+                    "confidence": confidence,
+                    "lift": lift,
+                    "score": lift if score_by == "lift" else confidence
+                })
+            if candidates:
+                association_rules[antecedent] = heapq.nsmallest(
+                    top_k, candidates, key=lambda rule: (-rule['score'], rule['product_id'])
+                )
+    return association_rules
+
+
+_association_rules_cache = {} # score_by -> (FBT model version, mined_at, rules)
+_association_rules_lock = threading.Lock()
+
+
+def get_association_rules(score_by: str = "lift") -> dict:
+    """
+    Returns the mined rules for a scoring mode, re-mining them when the FBT model changed
+    (at most once per ASSOCIATION_RULES_REFRESH_SECONDS).
+    """
+    with _association_rules_lock:
+        cached = _association_rules_cache.get(score_by)
+        now = time.monotonic()
+        if cached is not None:
+            version, mined_at, rules = cached
+            if version == FBT_STORE.version or now - mined_at < ASSOCIATION_RULES_REFRESH_SECONDS:
+                return rules
+        rules = mine_association_rules(FBT_STORE, score_by=score_by)
+        _association_rules_cache[score_by] = (FBT_STORE.version, now, rules)
+        return rules
+
+
+def _recommend_by_association_rules(current_list_product_ids: list, num_recommendations: int, score_by: str) -> list:
+    """
+    k-way merge over the basket items' pre-sorted rule lists. A candidate's score is its best
+    rule, so the first num_recommendations new products off the merge are the answer.
+    """
+    association_rules = get_association_rules(score_by)
+    in_list = set(current_list_product_ids)
+    rule_streams = [
+        [(antecedent, rule) for rule in association_rules[antecedent]]
+        for antecedent in in_list if antecedent in association_rules
+    ]
+
+    recommendations = []
+    seen = set()
+    for antecedent, rule in heapq.merge(*rule_streams, key=lambda entry: (-entry[1]['score'], entry[1]['product_id'])):
+        rec_id = rule['product_id']
+        if rec_id in seen or rec_id in in_list or rec_id not in products_by_id_recs:
+            continue
+        seen.add(rec_id)
+        antecedent_name = products_by_id_recs.get(antecedent, {}).get('product_name', antecedent)
+        recommendations.append({
+            "product_id": rec_id,
+            "product_name": products_by_id_recs[rec_id]['product_name'],
+            "reason": f"Often bought with {antecedent_name} ({rule['confidence']:.0%} of the time).",
+            "score": round(rule['score'], 4),
+            "confidence": round(rule['confidence'], 4),
+            "lift": round(rule['lift'], 4)
+        })
+        if len(recommendations) >= num_recommendations:
+            break
+    return recommendations
+
+
+# --- 3. Serving (with a result cache keyed by canonical basket) ---
+
+RECOMMENDATION_CACHE_SIZE = 4096
+RECOMMENDATION_CACHE_TTL_SECONDS = 300
+RECOMMENDATION_CACHE = LRUTTLCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL_SECONDS)
+
+
+def get_fbt_recommendations(current_list_product_ids: list, num_recommendations: int = 3, scoring: str = "count") -> list:
     """
     Provides FBT recommendations based on products already in the current shopping list.
     Prioritizes items that are not already in the list.
+
+    scoring: 'count' sums raw co-occurrence counts across the list's items; 'confidence' or
+    'lift' ranks by the best association rule from any list item (see mine_association_rules).
+
+    Results are cached per (de-duplicated, sorted basket, num_recommendations, scoring) and the
+    version of the rules used, so a rules rebuild invalidates every earlier entry.
     """
+    if scoring not in RULE_SCORING_MODES:
+        raise ValueError(f"Unknown scoring mode '{scoring}'. Expected one of {RULE_SCORING_MODES}.")
+
+    if scoring == "count":
+        rules_version = FBT_STORE.version
+    else:
+        get_association_rules(scoring)
+        rules_version = _association_rules_cache[scoring][0]
+    canonical_basket = tuple(sorted(set(current_list_product_ids)))
+    cache_key = (canonical_basket, num_recommendations, scoring, rules_version)
+
+    recommendations = RECOMMENDATION_CACHE.get(cache_key)
+    if recommendations is None:
+        recommendations = _compute_fbt_recommendations(list(canonical_basket), num_recommendations, scoring)
+        RECOMMENDATION_CACHE.set(cache_key, recommendations)
+    return list(recommendations) # Callers get their own list; the cached one stays intact
+
+
+def get_recommendation_cache_stats() -> dict:
+    """Hit/miss counters and size of the recommendation result cache."""
+    return RECOMMENDATION_CACHE.stats()
+
+
+def _compute_fbt_recommendations(current_list_product_ids: list, num_recommendations: int, scoring: str) -> list:
+    """Uncached recommendation pass behind get_fbt_recommendations."""
+    if scoring != "count":
+        recommendations = _recommend_by_association_rules(current_list_product_ids, num_recommendations, scoring)
+        print(f"DEBUG (recs): Generated {len(recommendations)} {scoring} recommendations for list {current_list_product_ids}.")
+        return recommendations
+
     if not FBT_RULES:
         print("Warning (recs): FBT rules not built. No recommendations available.")
         return []
@@ -124,5 +751,10 @@ if __name__ == "__main__":
                 print(f"- {rec['product_name']} (ID: {rec['product_id']}) - Reason: {rec['reason']}")
         else:
             print("No recommendations found for the sample list. Try adding more diverse items to customer_purchases.json or adjust min_support.")
+
+        for scoring in ("confidence", "lift"):
+            print(f"\nTop {scoring}-ranked recommendations for {sample_current_list_ids}:")
+            for rec in get_fbt_recommendations(sample_current_list_ids, num_recommendations=5, scoring=scoring):
+                print(f"- {rec['product_name']} (ID: {rec['product_id']}) - lift {rec['lift']:.2f}, confidence {rec['confidence']:.0%}")
     
     print("\n--- recommendation_engine.py independent testing complete ---")
\ No newline at end of file
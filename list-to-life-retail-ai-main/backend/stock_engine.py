@@ -1,5 +1,21 @@
 import json
 import datetime 
+import atexit
+import heapq
+import os
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from typing import NamedTuple
+
+try:
+    import numpy as np
+    VECTORIZED_STOCK_AVAILABLE = True
+except ImportError: # Optional: store-wide stock reports fall back to a pure-Python pass
+    np = None
+    VECTORIZED_STOCK_AVAILABLE = False
 
 # --- 1. Data Loading Functions ---
 def load_data(filename):
@@ -22,9 +38,147 @@ def load_data(filename):
 products_data = load_data('products.json')
 products_by_id = {p['product_id']: p for p in products_data}
 
-inventory_data = load_data('inventory.json')
+INVENTORY_FILE = 'inventory.json'
+inventory_data = load_data(INVENTORY_FILE)
 inventory_by_store_product = {(inv['store_id'], inv['product_id']): inv for inv in inventory_data}
 
+# --- Stock Movement Journal (write-ahead log) ---
+# Stock changes are appended to a journal instead of rewriting inventory.json on every sale.
+# inventory.json becomes a periodic snapshot; at startup the journal is replayed on top of it.
+STOCK_JOURNAL_FILE = 'inventory_journal.jsonl'
+STOCK_JOURNAL_COMPACTING_FILE = f"{STOCK_JOURNAL_FILE}.compacting" # journal being folded into a snapshot
+STOCK_SNAPSHOT_EVERY = int(os.getenv('STOCK_SNAPSHOT_EVERY', 5000)) # journal entries between snapshots
+
+class StockJournal:
+    """
+    Append-only JSON-lines log of stock movements with group commit: callers that need an entry
+    on disk call sync(), and everyone waiting at the same time shares a single fsync.
+    """
+
+    def __init__(self, path: str = STOCK_JOURNAL_FILE):
+        self.path = path
+        self._file = None # opened on first append
+        self._write_lock = threading.Lock()
+        self._sync_condition = threading.Condition()
+        self._syncing = False
+        self._appended = 0 # entries written so far (positions are 1-based and never reused)
+        self._durable = 0 # entries known to be on disk
+        self.fsyncs = 0
+
+    def append(self, entry: dict) -> int:
+        """Writes an entry (not yet durable) and returns its position for sync()."""
+        line = json.dumps(entry, separators=(',', ':')) + "\n"
+        with self._write_lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._appended += 1
+            return self._appended
+
+    def sync(self, position: int):
+        """Blocks until the entry at `position` is on disk."""
+        with self._sync_condition:
+            while self._durable < position:
+                if self._syncing:
+                    # Another thread is fsyncing; our entry is either in that batch or the next one
+                    self._sync_condition.wait()
+                    continue
+                self._syncing = True
+                try:
+                    self._sync_condition.release()
+                    try:
+                        with self._write_lock:
+                            self._file.flush()
+                            target = self._appended
+                            file_descriptor = self._file.fileno()
+                        os.fsync(file_descriptor)
+                    finally:
+                        self._sync_condition.acquire()
+                    self._durable = max(self._durable, target)
+                    self.fsyncs += 1
+                finally:
+                    self._syncing = False
+                    self._sync_condition.notify_all()
+
+    def rotate(self, rotated_path: str) -> int:
+        """
+        Makes everything written so far durable and moves it to rotated_path; new entries go to a fresh file.
+        Returns the position of the last rotated entry.
+        """
+        with self._sync_condition:
+            while self._syncing:
+                self._sync_condition.wait()
+            with self._write_lock:
+                if self._file is not None:
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._file.close()
+                    self._file = None
+                if os.path.exists(self.path):
+                    os.replace(self.path, rotated_path)
+                self._durable = self._appended
+                return self._appended
+
+    def close(self):
+        with self._sync_condition:
+            while self._syncing:
+                self._sync_condition.wait()
+            with self._write_lock:
+                if self._file is not None:
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._file.close()
+                    self._file = None
+                self._durable = self._appended
+
+def _replay_journal_file(path: str) -> int:
+    """Applies journal entries (absolute stock levels, so replay is idempotent). Returns entries applied."""
+    if not os.path.exists(path):
+        return 0
+    applied = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can be torn by a crash mid-write; nothing after it was acknowledged
+                print(f"Warning (stock_engine.py): Ignoring unreadable journal line {line_number} in '{path}'.")
+                break
+            record = inventory_by_store_product.get((entry['store_id'], entry['product_id']))
+            if record is not None:
+                record['current_stock'] = entry['current_stock']
+                applied += 1
+    return applied
+
+def save_inventory(records: list = None):
+    """Writes an inventory snapshot atomically (temp file, fsync, rename) so a crash never leaves a torn file."""
+    if records is None:
+        records = list(inventory_by_store_product.values())
+    temp_filename = f"{INVENTORY_FILE}.tmp"
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, INVENTORY_FILE)
+
+def recover_inventory_from_journal() -> int:
+    """
+    Replays journals left by the previous run (an interrupted compaction first, then the live journal)
+    and folds them into a fresh snapshot so the next run starts from an empty journal.
+    """
+    applied = _replay_journal_file(STOCK_JOURNAL_COMPACTING_FILE) + _replay_journal_file(STOCK_JOURNAL_FILE)
+    if applied:
+        save_inventory()
+        print(f"DEBUG (stock_engine.py): Replayed {applied} stock journal entries into '{INVENTORY_FILE}'.")
+    for path in (STOCK_JOURNAL_COMPACTING_FILE, STOCK_JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    return applied
+
+recover_inventory_from_journal()
+STOCK_JOURNAL = StockJournal(STOCK_JOURNAL_FILE)
+atexit.register(STOCK_JOURNAL.close)
+
 substitutions_data = load_data('substitutions.json')
 substitutions_by_original_id = {sub['original_product_id']: sub['substitutes'] for sub in substitutions_data}
 
@@ -66,10 +220,20 @@ def get_stock_status(product_id: str, store_id: str = DEFAULT_STORE_ID,
 
     Returns:
         dict: A dictionary containing 'status' (str), 'message' (str), 
-              'current_stock' (int/None), and 'days_left' (float/None).
+              'current_stock' (int/None, net of units held by reservations), and 'days_left' (float/None).
     """
     stock = get_product_stock(product_id, store_id)
     
+    if stock is None:
+        return _stock_status_record(None, 1, low_stock_threshold, days_supply_threshold)
+    stock = INVENTORY_SERVICE.available(product_id, store_id)
+    
+    inventory_record = inventory_by_store_product.get((store_id, product_id))
+    daily_sales_rate = inventory_record.get('daily_sales_rate', 1) # Default to 1 to avoid division by zero
+    return _stock_status_record(stock, daily_sales_rate, low_stock_threshold, days_supply_threshold)
+
+def _stock_status_record(stock, daily_sales_rate, low_stock_threshold: int, days_supply_threshold: float) -> dict:
+    """Builds the get_stock_status result for a stock level (None = not stocked) and daily sales rate."""
     if stock is None:
         return {
             "status": "Unknown", 
@@ -77,10 +241,7 @@ def get_stock_status(product_id: str, store_id: str = DEFAULT_STORE_ID,
             "current_stock": None,
             "days_left": None
         }
-    
-    inventory_record = inventory_by_store_product.get((store_id, product_id))
-    daily_sales_rate = inventory_record.get('daily_sales_rate', 1) # Default to 1 to avoid division by zero
-    
+
     days_left = stock / daily_sales_rate if daily_sales_rate > 0 else float('inf') # Infinity if no sales
 
     if stock == 0:
@@ -106,60 +267,705 @@ def get_stock_status(product_id: str, store_id: str = DEFAULT_STORE_ID,
             "days_left": days_left
         }
 
-def find_smart_substitute(original_product_id: str, store_id: str = DEFAULT_STORE_ID) -> dict | None:
+class SubstituteMatch(NamedTuple):
+    """
+    A substitute for a product. Built once per substitution at load time and shared, so lookups
+    allocate nothing; use .product for the catalog entry and .as_dict() for JSON responses.
+    """
+    product_id: str
+    original_product_id: str
+    substitution_score: float
+    substitution_reason: str
+    hops: int = 1 # 2+ for substitutes of substitutes found by the graph search
+    via: tuple = () # intermediate product IDs, original side first
+
+    @property
+    def product(self) -> dict:
+        return products_by_id[self.product_id]
+
+    def as_dict(self) -> dict:
+        """The substitute's product fields plus the substitution details (and the chain, for multi-hop matches)."""
+        substitute = dict(products_by_id[self.product_id])
+        substitute['substitution_reason'] = self.substitution_reason
+        substitute['substitution_score'] = self.substitution_score
+        substitute['original_product_id'] = self.original_product_id # For reference
+        if self.hops > 1:
+            substitute['substitution_hops'] = self.hops
+            substitute['substitution_via'] = list(self.via)
+        return substitute
+
+def _rank_substitutes(original_product_id: str, potential_substitutes: list) -> tuple:
+    """Known substitutes ordered by substitution_score, highest first (ties keep file order)."""
+    ranked = sorted(potential_substitutes, key=lambda x: x.get('substitution_score', 0), reverse=True)
+    return tuple(
+        SubstituteMatch(sub_info['substitute_product_id'], original_product_id,
+                        sub_info['substitution_score'], sub_info['reason'])
+        for sub_info in ranked if sub_info['substitute_product_id'] in products_by_id
+    )
+
+ranked_substitutes_by_original_id = {
+    original_product_id: _rank_substitutes(original_product_id, potential_substitutes)
+    for original_product_id, potential_substitutes in substitutions_by_original_id.items()
+}
+originals_by_substitute_id = {} # substitute product_id -> original product_ids that list it
+for _original_product_id, _ranked in ranked_substitutes_by_original_id.items():
+    for _match in _ranked:
+        originals_by_substitute_id.setdefault(_match.product_id, []).append(_original_product_id)
+
+# store_id -> {original_product_id: best SubstituteMatch currently in stock there}.
+# Read without a lock; rebuilt per original when a candidate's sellable units (stock minus holds) cross zero.
+best_substitute_by_store = {}
+_substitute_index_lock = threading.Lock()
+
+def _is_available(store_id: str, product_id: str) -> bool:
+    """True when get_stock_status would report In Stock or Low Stock: units left after reservation holds."""
+    return INVENTORY_SERVICE.sellable_units(product_id, store_id) > 0
+
+def _first_available_substitute(original_product_id: str, store_id: str) -> SubstituteMatch | None:
+    for match in ranked_substitutes_by_original_id.get(original_product_id, ()):
+        if _is_available(store_id, match.product_id):
+            return match
+    return None
+
+def _refresh_best_substitutes(store_id: str, original_product_ids):
+    best_by_original = best_substitute_by_store.setdefault(store_id, {})
+    for original_product_id in original_product_ids:
+        match = _first_available_substitute(original_product_id, store_id)
+        if match is None:
+            best_by_original.pop(original_product_id, None)
+        else:
+            best_by_original[original_product_id] = match
+
+def _on_stock_change_for_substitutes(store_id: str, product_id: str, old_available: int, new_available: int):
+    """Stock listener: only a change between out of stock and available can change a best substitute."""
+    if (old_available > 0) != (new_available > 0) and product_id in originals_by_substitute_id:
+        with _substitute_index_lock:
+            _refresh_best_substitutes(store_id, originals_by_substitute_id[product_id])
+        SUBSTITUTION_GRAPH.invalidate(store_id, product_id)
+
+# --- Multi-hop substitution search ---
+SUBSTITUTE_MAX_HOPS = 3 # 1 = direct substitutes only
+SUBSTITUTE_MIN_SCORE = 0.4 # chained scores (the product of each hop's score) below this are not offered
+_NO_RESULT = object()
+
+class SubstitutionGraph:
+    """
+    Treats substitutions as a directed graph and finds the best available substitute up to max_hops away,
+    scoring a chain by multiplying its hop scores. Scores are at most 1, so a chain never scores higher
+    than its prefix and best-first search can stop at the first available product it pops.
+
+    Results are memoized per (store, product, max_hops, min_score). Each result remembers which products'
+    availability it depended on (everything popped before the answer, and the answer itself);
+    invalidate() drops just those entries when one of them goes in or out of stock.
+    """
+
+    def __init__(self, ranked_substitutes: dict, is_available):
+        self.ranked_substitutes = ranked_substitutes # product_id -> SubstituteMatch tuple, best first
+        self.is_available = is_available # (store_id, product_id) -> bool
+        self._cache = {} # (store_id, product_id, max_hops, min_score) -> SubstituteMatch | None
+        self._cache_keys_by_dependency = {} # (store_id, product_id) -> cache keys that examined it
+        self._generation_by_store = {} # bumped on invalidation so in-flight searches do not cache stale answers
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def search(self, original_product_id: str, store_id: str = DEFAULT_STORE_ID, max_hops: int = SUBSTITUTE_MAX_HOPS,
+               min_score: float = SUBSTITUTE_MIN_SCORE) -> tuple:
+        """Uncached best-first search. Returns (SubstituteMatch | None, product_ids whose availability was checked)."""
+        heap = [(-match.substitution_score, 1, order, match.product_id, ())
+                for order, match in enumerate(self.ranked_substitutes.get(original_product_id, ()))
+                if match.substitution_score >= min_score]
+        heapq.heapify(heap)
+        order = len(heap)
+        # Fewest hops each product has been expanded at. A later, lower-scoring chain to the same product
+        # is still worth expanding when it is shorter, since it can reach further within max_hops.
+        settled_hops = {original_product_id: 0}
+        examined = []
+        while heap:
+            negative_score, hops, _, product_id, via = heapq.heappop(heap)
+            previous_hops = settled_hops.get(product_id)
+            if previous_hops is not None and previous_hops <= hops:
+                continue # already reached through a better and no longer chain
+            settled_hops[product_id] = hops
+            if previous_hops is None: # a revisited product is known to be unavailable
+                examined.append(product_id)
+                if self.is_available(store_id, product_id):
+                    last_hop = self._edge(via[-1] if via else original_product_id, product_id)
+                    return self._match(original_product_id, product_id, -negative_score, last_hop, hops, via), examined
+            if hops >= max_hops:
+                continue
+            for match in self.ranked_substitutes.get(product_id, ()):
+                chained_score = -negative_score * match.substitution_score
+                if chained_score >= min_score and settled_hops.get(match.product_id, max_hops + 1) > hops + 1:
+                    heapq.heappush(heap, (-chained_score, hops + 1, order, match.product_id, via + (product_id,)))
+                    order += 1
+        return None, examined
+
+    def _edge(self, from_product_id: str, to_product_id: str) -> SubstituteMatch:
+        for match in self.ranked_substitutes[from_product_id]:
+            if match.product_id == to_product_id:
+                return match
+
+    def _match(self, original_product_id, product_id, score, last_hop, hops, via) -> SubstituteMatch:
+        if hops == 1:
+            return last_hop
+        via_names = ", ".join(products_by_id.get(pid, {}).get('product_name', pid) for pid in via)
+        return SubstituteMatch(product_id, original_product_id, round(score, 4),
+                               f"{last_hop.substitution_reason} (via {via_names})", hops, via)
+
+    def find(self, original_product_id: str, store_id: str = DEFAULT_STORE_ID, max_hops: int = SUBSTITUTE_MAX_HOPS,
+             min_score: float = SUBSTITUTE_MIN_SCORE) -> SubstituteMatch | None:
+        """Memoized search."""
+        key = (store_id, original_product_id, max_hops, min_score)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            generation = self._generation_by_store.get(store_id, 0)
+
+        match, examined = self.search(original_product_id, store_id, max_hops, min_score)
+
+        with self._lock:
+            if self._generation_by_store.get(store_id, 0) == generation: # no stock crossing while searching
+                self._cache[key] = match
+                for product_id in examined:
+                    self._cache_keys_by_dependency.setdefault((store_id, product_id), set()).add(key)
+        return match
+
+    def invalidate(self, store_id: str, product_id: str):
+        """Drops cached results that depended on this product's availability at this store."""
+        with self._lock:
+            self._generation_by_store[store_id] = self._generation_by_store.get(store_id, 0) + 1
+            for key in self._cache_keys_by_dependency.pop((store_id, product_id), ()):
+                if self._cache.pop(key, _NO_RESULT) is not _NO_RESULT:
+                    self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None
+            }
+
+SUBSTITUTION_GRAPH = SubstitutionGraph(ranked_substitutes_by_original_id, _is_available)
+
+def find_smart_substitute(original_product_id: str, store_id: str = DEFAULT_STORE_ID,
+                          max_hops: int = SUBSTITUTE_MAX_HOPS) -> SubstituteMatch | None:
     """
     Finds the best available substitute for an original product at a given store.
     Prioritizes substitutes based on their 'substitution_score' and current availability.
+    When none of the direct substitutes is available, falls back to substitutes of substitutes
+    (up to max_hops away) through the cached graph search.
 
     Args:
         original_product_id (str): The ID of the product that needs a substitute.
         store_id (str): The ID of the store to check for substitute availability.
+        max_hops (int): 1 for direct substitutes only.
 
     Returns:
-        dict: A dictionary containing details of the best available substitute,
-              including its name, brand, price, reason for substitution, and score.
+        SubstituteMatch: The best substitute that is In Stock or Low Stock (immutable and shared;
+                         call .as_dict() for the product fields plus substitution reason and score).
         None: If no suitable and available substitute is found.
     """
-    potential_substitutes = substitutions_by_original_id.get(original_product_id, [])
-    
-    # Sort substitutes by substitution_score in descending order (highest score first)
-    sorted_substitutes = sorted(potential_substitutes, key=lambda x: x.get('substitution_score', 0), reverse=True)
-    
-    for sub_info in sorted_substitutes:
-        sub_product_id = sub_info['substitute_product_id']
-        
-        # Ensure the substitute product actually exists in our products data
-        if sub_product_id not in products_by_id:
-            continue # Skip if substitute product details are missing
-
-        sub_stock_status = get_stock_status(sub_product_id, store_id)
-        
-        # We only suggest substitutes that are currently "In Stock" or "Low Stock"
-        if sub_stock_status['status'] in ["In Stock", "Low Stock"]:
-            best_available_substitute = products_by_id.get(sub_product_id)
-            
-            if best_available_substitute:
-                # Add substitution-specific information to the returned product data
-                best_available_substitute['substitution_reason'] = sub_info['reason']
-                best_available_substitute['substitution_score'] = sub_info['substitution_score']
-                best_available_substitute['original_product_id'] = original_product_id # For reference
-                return best_available_substitute # Return the first (best scored) available substitute found
-                
-    return None # No suitable substitute found after checking all options
+    match = best_substitute_by_store.get(store_id, {}).get(original_product_id)
+    if match is None and max_hops > 1:
+        match = SUBSTITUTION_GRAPH.find(original_product_id, store_id, max_hops)
+    return match
 
-def update_product_stock(product_id: str, quantity: int, store_id: str = DEFAULT_STORE_ID):
-    key = (store_id, product_id)
-    if key in inventory_by_store_product:
-        inventory_by_store_product[key]['current_stock'] = max(
-            0, inventory_by_store_product[key]['current_stock'] - quantity
-        )
-        save_inventory()
+# --- 3. Columnar Inventory (bulk stock checks) ---
+NOT_STOCKED = -1 # stock value for products a store does not carry
 
+class ColumnarInventory:
+    """
+    Inventory held as parallel arrays per store (current stock, daily sales rate), indexed by a
+    product ordinal, so whole lists or the whole catalog can be classified in one pass.
+    update_product_stock keeps it in step with inventory_by_store_product.
+    """
+
+    def __init__(self, inventory_records: list, product_ids=()):
+        self.product_ids = list(product_ids)
+        self.ordinal_by_product = {product_id: ordinal for ordinal, product_id in enumerate(self.product_ids)}
+        self.stock_by_store = {}
+        self.sales_rate_by_store = {}
+        for record in inventory_records:
+            self.set_record(record)
+
+    def _ordinal(self, product_id: str) -> int:
+        ordinal = self.ordinal_by_product.get(product_id)
+        if ordinal is None:
+            ordinal = len(self.product_ids)
+            self.product_ids.append(product_id)
+            self.ordinal_by_product[product_id] = ordinal
+            for store_id in self.stock_by_store:
+                self.stock_by_store[store_id].append(NOT_STOCKED)
+                self.sales_rate_by_store[store_id].append(1.0)
+        return ordinal
+
+    def columns(self, store_id: str) -> tuple:
+        """(stock, daily sales rate) arrays for a store, created empty (nothing stocked) if needed."""
+        if store_id not in self.stock_by_store:
+            self.stock_by_store[store_id] = array('q', [NOT_STOCKED]) * len(self.product_ids)
+            self.sales_rate_by_store[store_id] = array('d', [1.0]) * len(self.product_ids)
+        return self.stock_by_store[store_id], self.sales_rate_by_store[store_id]
+
+    def set_record(self, record: dict):
+        ordinal = self._ordinal(record['product_id'])
+        stock_column, sales_rate_column = self.columns(record['store_id'])
+        stock_column[ordinal] = record['current_stock']
+        sales_rate_column[ordinal] = record.get('daily_sales_rate', 1)
+
+    def set_stock(self, store_id: str, product_id: str, stock: int):
+        ordinal = self._ordinal(product_id)
+        self.columns(store_id)[0][ordinal] = stock
+
+    def stock_report(self, store_id: str, low_stock_threshold: int = 3, days_supply_threshold: float = 1.0,
+                     limit: int = 100, method: str = "auto", held_units: dict = None) -> dict:
+        """
+        Classifies every product a store carries.
+
+        Args:
+            limit (int): How many low-stock (most urgent first) and out-of-stock product IDs to list; None for all.
+            method (str): 'numpy' (vectorized over the columns), 'python' or 'auto'.
+            held_units (dict): {product_id: units held by reservations}, taken off the stock before classifying.
+
+        Returns:
+            dict: {'store_id', 'counts': {status: n}, 'low_stock': [product_ids by fewest days left],
+                   'out_of_stock': [product_ids in catalog order]}
+        """
+        if limit is not None and limit < 0:
+            raise ValueError(f"limit must be 0 or more (got {limit}).")
+        if method == "auto":
+            method = "numpy" if VECTORIZED_STOCK_AVAILABLE else "python"
+        elif method == "numpy" and not VECTORIZED_STOCK_AVAILABLE:
+            print("Warning (stock_engine.py): NumPy not installed. Falling back to the pure-Python stock report.")
+            method = "python"
+        if store_id not in self.stock_by_store:
+            return {"store_id": store_id, "counts": {"In Stock": 0, "Low Stock": 0, "Out of Stock": 0},
+                    "low_stock": [], "out_of_stock": []}
+        stock_column, sales_rate_column = self.stock_by_store[store_id], self.sales_rate_by_store[store_id]
+        if held_units:
+            stock_column = array('q', stock_column)
+            for product_id, units in held_units.items():
+                ordinal = self.ordinal_by_product.get(product_id)
+                if ordinal is not None and stock_column[ordinal] != NOT_STOCKED:
+                    stock_column[ordinal] = max(0, stock_column[ordinal] - units)
+
+        if method == "numpy":
+            stock = np.frombuffer(stock_column, dtype=np.int64)
+            sales_rate = np.frombuffer(sales_rate_column, dtype=np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                days_left = np.where(sales_rate > 0, stock / sales_rate, np.inf)
+            stocked = stock != NOT_STOCKED
+            out_of_stock = stocked & (stock == 0)
+            low_stock = stocked & ~out_of_stock & ((stock <= low_stock_threshold) | (days_left < days_supply_threshold))
+            low_ordinals = np.flatnonzero(low_stock)
+            if limit is not None and limit < len(low_ordinals):
+                # Only the most urgent `limit` need sorting; ties on days left are taken in catalog order
+                low_days = days_left[low_ordinals]
+                cutoff = np.partition(low_days, limit - 1)[limit - 1] if limit > 0 else -np.inf
+                below = low_ordinals[low_days < cutoff]
+                low_ordinals = np.concatenate([below, low_ordinals[low_days == cutoff][:limit - len(below)]])
+                low_ordinals.sort()
+            low_ordinals = low_ordinals[np.argsort(days_left[low_ordinals], kind='stable')]
+            out_ordinals = np.flatnonzero(out_of_stock)[:limit]
+            counts = {
+                "In Stock": int(stocked.sum() - out_of_stock.sum() - low_stock.sum()),
+                "Low Stock": int(low_stock.sum()),
+                "Out of Stock": int(out_of_stock.sum())
+            }
+        else:
+            low_with_days, out_ordinals, in_stock = [], [], 0
+            for ordinal, (stock, sales_rate) in enumerate(zip(stock_column, sales_rate_column)):
+                if stock == NOT_STOCKED:
+                    continue
+                if stock == 0:
+                    out_ordinals.append(ordinal)
+                    continue
+                days_left = stock / sales_rate if sales_rate > 0 else float('inf')
+                if stock <= low_stock_threshold or days_left < days_supply_threshold:
+                    low_with_days.append((days_left, ordinal))
+                else:
+                    in_stock += 1
+            counts = {"In Stock": in_stock, "Low Stock": len(low_with_days), "Out of Stock": len(out_ordinals)}
+            if limit is not None:
+                low_ordinals = [ordinal for _, ordinal in heapq.nsmallest(limit, low_with_days)]
+                out_ordinals = out_ordinals[:limit]
+            else:
+                low_ordinals = [ordinal for _, ordinal in sorted(low_with_days)]
+
+        return {
+            "store_id": store_id,
+            "counts": counts,
+            "low_stock": [self.product_ids[ordinal] for ordinal in low_ordinals],
+            "out_of_stock": [self.product_ids[ordinal] for ordinal in out_ordinals]
+        }
+
+COLUMNAR_INVENTORY = ColumnarInventory(inventory_data, products_by_id)
+
+def get_stock_status_bulk(product_ids: list, store_id: str = DEFAULT_STORE_ID,
+                          low_stock_threshold: int = 3, days_supply_threshold: float = 1.0) -> dict:
+    """
+    get_stock_status for a whole list in one pass over the columnar inventory.
+
+    Returns:
+        dict: {product_id: the same dict get_stock_status returns}
+    """
+    held_units = INVENTORY_SERVICE.held_units(store_id)
+    stock_column = COLUMNAR_INVENTORY.stock_by_store.get(store_id, ())
+    sales_rate_column = COLUMNAR_INVENTORY.sales_rate_by_store.get(store_id, ())
+    ordinal_by_product = COLUMNAR_INVENTORY.ordinal_by_product
+    statuses = {}
+    for product_id in product_ids:
+        if product_id in statuses:
+            continue
+        ordinal = ordinal_by_product.get(product_id)
+        stock = stock_column[ordinal] if ordinal is not None and ordinal < len(stock_column) else NOT_STOCKED
+        if stock == NOT_STOCKED:
+            statuses[product_id] = _stock_status_record(None, 1, low_stock_threshold, days_supply_threshold)
+        else:
+            if held_units:
+                stock = max(0, stock - held_units.get(product_id, 0))
+            statuses[product_id] = _stock_status_record(stock, sales_rate_column[ordinal], low_stock_threshold, days_supply_threshold)
+    return statuses
+
+def get_store_stock_report(store_id: str = DEFAULT_STORE_ID, low_stock_threshold: int = 3,
+                           days_supply_threshold: float = 1.0, limit: int = 100) -> dict:
+    """Store-wide stock classification over the full catalog, net of reservation holds (see ColumnarInventory.stock_report)."""
+    return COLUMNAR_INVENTORY.stock_report(store_id, low_stock_threshold, days_supply_threshold, limit,
+                                           held_units=INVENTORY_SERVICE.held_units(store_id))
+
+# --- 4. Inventory Service (concurrent stock updates and reservations) ---
+INVENTORY_LOCK_STRIPES = 64
+RESERVATION_TTL_SECONDS = int(os.getenv('RESERVATION_TTL_SECONDS', 900)) # how long reserved units are held
+
+class InventoryService:
+    """
+    Serializes stock changes per (store_id, product_id) with a fixed set of striped locks, so
+    unrelated products never wait on each other, and holds stock for checkouts with reservations:
+    reserve() sets units aside (all or nothing), commit() turns them into a sale, release() or
+    expiry hands them back. Every stock change is journaled before the call returns.
+    """
+
+    def __init__(self, records_by_key: dict, columnar_inventory: ColumnarInventory = None,
+                 journal: StockJournal = None, num_stripes: int = INVENTORY_LOCK_STRIPES,
+                 snapshot_every: int = STOCK_SNAPSHOT_EVERY):
+        self.records_by_key = records_by_key
+        self.columnar_inventory = columnar_inventory
+        self.journal = journal # None keeps changes in memory only
+        self.snapshot_every = snapshot_every
+        self._stripes = [threading.Lock() for _ in range(num_stripes)]
+        self._reserved_by_key = {} # (store_id, product_id) -> units on hold, guarded by that key's stripe
+        self._reservations = {} # reservation_id -> {'store_id', 'items', 'deadline', 'expires_at'}
+        self._expiry_heap = [] # (deadline, reservation_id)
+        self._reservations_lock = threading.Lock() # guards the reservation table only, never held while taking a stripe
+        self._compaction_lock = threading.Lock()
+        self._snapshot_position = 0
+        self._stock_listeners = []
+        # Contention counters (approximate: updated without a lock, for monitoring only)
+        self.lock_acquires = 0
+        self.contended_acquires = 0
+
+    @contextmanager
+    def _locked(self, stripe_indexes):
+        """Holds the given stripes, always taken in ascending order so multi-key operations cannot deadlock."""
+        stripe_indexes = sorted(stripe_indexes)
+        for index in stripe_indexes:
+            stripe = self._stripes[index]
+            self.lock_acquires += 1
+            if not stripe.acquire(blocking=False):
+                self.contended_acquires += 1
+                stripe.acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(stripe_indexes):
+                self._stripes[index].release()
+
+    def _stripes_for(self, keys) -> set:
+        return {hash(key) % len(self._stripes) for key in keys}
+
+    def _available(self, key) -> int:
+        """Sellable units for a key; caller holds its stripe."""
+        record = self.records_by_key.get(key)
+        if record is None:
+            return 0
+        return max(0, record['current_stock'] - self._reserved_by_key.get(key, 0))
+
+    def sellable_units(self, product_id: str, store_id: str = DEFAULT_STORE_ID) -> int:
+        """
+        available() without taking the stripe or expiring holds: a point-in-time read for indexes and
+        stock listeners, which may run while other stripes are held.
+        """
+        return self._available((store_id, product_id))
 
+    def add_stock_listener(self, listener):
+        """
+        Registers listener(store_id, product_id, old_available, new_available), called whenever a product's
+        sellable units (stock minus reservation holds) change, while that product's stripe is held (so calls
+        for one product arrive in order). Keep it short, and take no stripes in it.
+        """
+        self._stock_listeners.append(listener)
 
-def save_inventory():
-    with open('inventory.json', 'w', encoding='utf-8') as f:
-        json.dump(list(inventory_by_store_product.values()), f, indent=2)
+    def _notify_listeners(self, key, old_available: int):
+        """Tells stock listeners about a change since old_available; caller holds the key's stripe."""
+        new_available = self._available(key)
+        if new_available != old_available:
+            for listener in self._stock_listeners:
+                listener(key[0], key[1], old_available, new_available)
+
+    def _write_stock(self, key, record: dict, new_stock: int, delta: int):
+        """
+        Applies a stock level and journals it; caller holds the key's stripe and notifies listeners.
+        Returns the journal position.
+        """
+        record['current_stock'] = new_stock
+        if self.columnar_inventory is not None:
+            self.columnar_inventory.set_stock(key[0], key[1], new_stock)
+        if self.journal is None:
+            return None
+        return self.journal.append({
+            "store_id": key[0], "product_id": key[1], "delta": delta,
+            "current_stock": new_stock, "ts": time.time()
+        })
+
+    def _after_write(self, position):
+        """Waits for the journal entry to be durable (outside any stripe) and starts compaction when due."""
+        if position is None:
+            return
+        self.journal.sync(position)
+        if position - self._snapshot_position >= self.snapshot_every and not self._compaction_lock.locked():
+            threading.Thread(target=self.compact, name="inventory-compaction", daemon=True).start()
+
+    def available(self, product_id: str, store_id: str = DEFAULT_STORE_ID) -> int:
+        """Units that can still be reserved or sold (current stock minus active holds)."""
+        self.expire_reservations()
+        key = (store_id, product_id)
+        with self._locked(self._stripes_for([key])):
+            return self._available(key)
+
+    def held_units(self, store_id: str = DEFAULT_STORE_ID) -> dict:
+        """{product_id: units on hold} at a store, for stock displays (a point-in-time copy, read without the stripes)."""
+        self.expire_reservations()
+        return {key[1]: units for key, units in dict(self._reserved_by_key).items() if key[0] == store_id}
+
+    def decrement(self, product_id: str, quantity: int, store_id: str = DEFAULT_STORE_ID) -> int | None:
+        """
+        Records a direct sale. Only units not held by reservations are sold, so the stock never goes below
+        the holds (or 0). Returns the new stock, or None if the store does not carry the product.
+        """
+        self.expire_reservations()
+        key = (store_id, product_id)
+        with self._locked(self._stripes_for([key])):
+            record = self.records_by_key.get(key)
+            if record is None:
+                return None
+            old_available = self._available(key)
+            sold = min(quantity, old_available)
+            new_stock = record['current_stock'] - sold
+            position = self._write_stock(key, record, new_stock, -sold)
+            self._notify_listeners(key, old_available)
+        self._after_write(position)
+        return new_stock
+
+    def set_stock(self, product_id: str, stock: int, store_id: str = DEFAULT_STORE_ID) -> int | None:
+        """Sets an absolute stock level (deliveries, stock counts). Returns it, or None if the store does not carry the product."""
+        if stock < 0:
+            raise ValueError("Stock cannot be negative.")
+        key = (store_id, product_id)
+        with self._locked(self._stripes_for([key])):
+            record = self.records_by_key.get(key)
+            if record is None:
+                return None
+            old_available = self._available(key)
+            position = self._write_stock(key, record, stock, stock - record['current_stock'])
+            self._notify_listeners(key, old_available)
+        self._after_write(position)
+        return stock
+
+    def reserve(self, items: dict, store_id: str = DEFAULT_STORE_ID, ttl_seconds: float = None) -> dict:
+        """
+        Holds stock for a checkout. Either every item is reserved or none is.
+
+        Args:
+            items (dict): {product_id: quantity}
+            ttl_seconds (float): How long the hold lasts before it is released automatically.
+
+        Returns:
+            dict: {'success': True, 'reservation_id', 'store_id', 'items', 'expires_at'} or
+                  {'success': False, 'shortages': [{'product_id', 'requested', 'available'}]}
+        """
+        if not items or any(quantity <= 0 for quantity in items.values()):
+            raise ValueError("Reservations need at least one item and positive quantities.")
+        ttl = RESERVATION_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or not 0 < ttl < float('inf'):
+            raise ValueError("ttl_seconds must be a positive number.")
+        # Worked out before any hold is taken, so nothing can fail between taking the holds and recording them
+        reservation = {"store_id": store_id, "items": dict(items),
+                       "deadline": time.monotonic() + ttl, "expires_at": time.time() + ttl}
+        self.expire_reservations()
+        keys = [(store_id, product_id) for product_id in items]
+        with self._locked(self._stripes_for(keys)):
+            shortages = []
+            for key in keys:
+                available = self._available(key)
+                if available < items[key[1]]:
+                    shortages.append({"product_id": key[1], "requested": items[key[1]], "available": available})
+            if shortages:
+                return {"success": False, "shortages": shortages}
+            for key in keys:
+                old_available = self._available(key)
+                self._reserved_by_key[key] = self._reserved_by_key.get(key, 0) + items[key[1]]
+                self._notify_listeners(key, old_available)
+
+        reservation_id = uuid.uuid4().hex
+        with self._reservations_lock:
+            self._reservations[reservation_id] = reservation
+            heapq.heappush(self._expiry_heap, (reservation['deadline'], reservation_id))
+        return {"success": True, "reservation_id": reservation_id, "store_id": store_id,
+                "items": dict(items), "expires_at": reservation['expires_at']}
+
+    def _take_reservation(self, reservation_id: str) -> dict | None:
+        with self._reservations_lock:
+            return self._reservations.pop(reservation_id, None)
+
+    def _drop_holds(self, keys: list, items: dict):
+        """Takes a reservation's units off the holds; caller holds the keys' stripes and notifies listeners."""
+        for key in keys:
+            remaining = self._reserved_by_key.get(key, 0) - items[key[1]]
+            if remaining > 0:
+                self._reserved_by_key[key] = remaining
+            else:
+                self._reserved_by_key.pop(key, None)
+
+    def _release_holds(self, reservation: dict):
+        keys = [(reservation['store_id'], product_id) for product_id in reservation['items']]
+        with self._locked(self._stripes_for(keys)):
+            old_available = {key: self._available(key) for key in keys}
+            self._drop_holds(keys, reservation['items'])
+            for key in keys:
+                self._notify_listeners(key, old_available[key])
+
+    def commit(self, reservation_id: str) -> dict:
+        """
+        Turns a reservation into a sale: stock is decremented and the hold removed. If a stock count
+        (set_stock) has since dropped below what the reservation holds, nothing is sold and the hold is released.
+
+        Returns:
+            dict: {'success': True, 'reservation_id', 'stock': {product_id: new_stock}} or
+                  {'success': False, 'reservation_id', 'error'} (plus 'shortages' when stock ran short)
+        """
+        reservation = self._take_reservation(reservation_id)
+        if reservation is None:
+            return {"success": False, "reservation_id": reservation_id, "error": "Reservation not found."}
+        if reservation['deadline'] <= time.monotonic():
+            self._release_holds(reservation)
+            return {"success": False, "reservation_id": reservation_id, "error": "Reservation expired."}
+
+        store_id = reservation['store_id']
+        keys = [(store_id, product_id) for product_id in reservation['items']]
+        new_stock_by_product = {}
+        position = None
+        with self._locked(self._stripes_for(keys)):
+            shortages = [{"product_id": key[1], "requested": reservation['items'][key[1]],
+                          "available": self.records_by_key[key]['current_stock']}
+                         for key in keys if self.records_by_key[key]['current_stock'] < reservation['items'][key[1]]]
+            old_available = {key: self._available(key) for key in keys}
+            self._drop_holds(keys, reservation['items'])
+            if shortages:
+                for key in keys:
+                    self._notify_listeners(key, old_available[key])
+                return {"success": False, "reservation_id": reservation_id,
+                        "error": "Not enough stock left to fill the reservation.", "shortages": shortages}
+            for key in keys:
+                quantity = reservation['items'][key[1]]
+                record = self.records_by_key[key]
+                new_stock = record['current_stock'] - quantity
+                position = self._write_stock(key, record, new_stock, -quantity)
+                self._notify_listeners(key, old_available[key]) # holds and stock fell together: usually unchanged
+                new_stock_by_product[key[1]] = new_stock
+        self._after_write(position)
+        return {"success": True, "reservation_id": reservation_id, "stock": new_stock_by_product}
+
+    def release(self, reservation_id: str) -> bool:
+        """Cancels a reservation and returns its units to sale. False if it was already committed, released or expired."""
+        reservation = self._take_reservation(reservation_id)
+        if reservation is None:
+            return False
+        self._release_holds(reservation)
+        return True
+
+    def expire_reservations(self) -> int:
+        """Releases reservations past their TTL. Returns how many were released."""
+        now = time.monotonic()
+        try:
+            if self._expiry_heap[0][0] > now: # unlocked peek; the common case takes no lock
+                return 0
+        except IndexError: # empty, possibly emptied by another thread since the check began
+            return 0
+        expired = []
+        with self._reservations_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                _, reservation_id = heapq.heappop(self._expiry_heap)
+                reservation = self._reservations.pop(reservation_id, None)
+                if reservation is not None: # not already committed or released
+                    expired.append(reservation)
+        for reservation in expired:
+            self._release_holds(reservation)
+        return len(expired)
+
+    def compact(self) -> bool:
+        """
+        Folds the journal into a new inventory.json snapshot. The journal is cut at a consistent point
+        with every stripe held, the snapshot is written atomically outside the stripes, and only then
+        is the old journal removed. Returns False if there is no journal or a compaction is already running.
+        """
+        if self.journal is None or not self._compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._locked(range(len(self._stripes))):
+                records = [dict(record) for record in self.records_by_key.values()]
+                self._snapshot_position = self.journal.rotate(STOCK_JOURNAL_COMPACTING_FILE)
+            save_inventory(records)
+            if os.path.exists(STOCK_JOURNAL_COMPACTING_FILE):
+                os.remove(STOCK_JOURNAL_COMPACTING_FILE)
+            return True
+        finally:
+            self._compaction_lock.release()
+
+    def stats(self) -> dict:
+        with self._reservations_lock:
+            active_reservations = len(self._reservations)
+        return {
+            "stripes": len(self._stripes),
+            "active_reservations": active_reservations,
+            "lock_acquires": self.lock_acquires,
+            "contended_acquires": self.contended_acquires
+        }
+
+INVENTORY_SERVICE = InventoryService(inventory_by_store_product, COLUMNAR_INVENTORY, STOCK_JOURNAL)
+INVENTORY_SERVICE.add_stock_listener(_on_stock_change_for_substitutes)
+
+# Built once the service exists, as availability is read through it
+with _substitute_index_lock:
+    for _store_id in {store_id for store_id, _ in inventory_by_store_product}:
+        _refresh_best_substitutes(_store_id, ranked_substitutes_by_original_id)
+
+def update_product_stock(product_id: str, quantity: int, store_id: str = DEFAULT_STORE_ID):
+    """
+    Decrements stock (never below 0 or into units held by reservations). The change is journaled and on disk when this returns;
+    concurrent callers share fsyncs, and inventory.json is only rewritten by periodic compaction.
+    """
+    INVENTORY_SERVICE.decrement(product_id, quantity, store_id)
+
+def compact_inventory() -> bool:
+    """Writes a fresh inventory.json snapshot and drops the journal entries it covers."""
+    return INVENTORY_SERVICE.compact()
 
 
 # --- Example Usage (for testing this module independently) ---
@@ -182,9 +988,9 @@ if __name__ == "__main__":
     if status_oos['status'] == "Out of Stock":
         substitute_oos = find_smart_substitute(oos_product_id, DEFAULT_STORE_ID)
         if substitute_oos:
-            print(f"  Suggested Substitute: {substitute_oos['product_name']} by {substitute_oos['brand']}")
-            print(f"    Reason: {substitute_oos['substitution_reason']}")
-            print(f"    Price: ${substitute_oos['price']:.2f}")
+            print(f"  Suggested Substitute: {substitute_oos.product['product_name']} by {substitute_oos.product['brand']}")
+            print(f"    Reason: {substitute_oos.substitution_reason}")
+            print(f"    Price: ${substitute_oos.product['price']:.2f}")
         else:
             print(f"  No suitable substitute found for {product_name_oos}.")
 
@@ -197,4 +1003,13 @@ if __name__ == "__main__":
     print(f"  Status: {status_is['status']} - {status_is['message']}")
     print(f"  Guidance: This item is ready for you!")
 
+    # --- Test 3: Bulk status and store-wide report from the columnar inventory ---
+    print(f"\n--- Scenario: Bulk stock check and store report ---")
+    bulk_statuses = get_stock_status_bulk([oos_product_id, in_stock_product_id], DEFAULT_STORE_ID)
+    for product_id, status in bulk_statuses.items():
+        print(f"  {product_id}: {status['status']}")
+    report = get_store_stock_report(DEFAULT_STORE_ID, limit=5)
+    print(f"  Store report: {report['counts']}")
+    print(f"  Most urgent low stock: {report['low_stock']}")
+
     print("\n--- stock_engine.py independent testing complete ---")
\ No newline at end of file
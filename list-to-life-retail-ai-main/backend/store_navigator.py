@@ -1,5 +1,15 @@
+import atexit
+import heapq
+import itertools
 import json
-from collections import deque # For Breadth-First Search (BFS)
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque # deque for Breadth-First Search (BFS)
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 # --- 1. Data Loading ---
 def load_data_local(filename):
@@ -14,14 +24,17 @@ def load_data_local(filename):
         print(f"ERROR (store_navigator.py): Could not decode JSON from '{filename}'.")
         return {} 
 
-# Load store layout data and product data. Assumes these files are in the same directory.
-store_layout_data = load_data_local('store_layout.json')
-products_data_for_navigator = load_data_local('products.json')
+STORE_LAYOUT_FILE = 'store_layout.json'
+
+def _get_file_mtime(filename):
+    """Returns the modification time of a file, or None if it does not exist."""
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
 
-# Extract store graph and product locations for easier access
-STORE_GRAPH = store_layout_data.get('layout_graph', {})
-PRODUCT_LOCATIONS_MAP = {loc['product_id']: loc['location_node'] for loc in store_layout_data.get('product_locations', [])}
-STORE_ENTRY_POINT = store_layout_data.get('entry_point', 'FRONT_DOOR')
+# Load product data. Assumes this file is in the same directory.
+products_data_for_navigator = load_data_local('products.json')
 
 # Create product_id to full product details mapping for convenience
 PRODUCTS_BY_ID_NAV = {p['product_id']: p for p in products_data_for_navigator}
@@ -52,25 +65,399 @@ def _find_shortest_path_cost(graph: dict, start_node: str, end_node: str) -> flo
     return float('inf') # No path found
 
 
-def optimize_shopping_path(shopping_list_items: list, start_from_node: str = STORE_ENTRY_POINT) -> list:
+def normalize_layout_graph(graph: dict, coordinates: dict = None) -> dict:
     """
-    Optimizes the order of items in a shopping list for efficient in-store navigation.
-    Uses a greedy nearest-neighbor approach with BFS for distances.
+    Converts a layout graph into a weighted adjacency map {node: [(neighbor, weight), ...]}.
 
-    Args:
-        shopping_list_items (list): A list of dictionaries, each with 'product_id' and 'quantity'.
-        start_from_node (str): The starting point in the store (e.g., 'FRONT_DOOR').
+    Each node's neighbors may be given as a list (["AISLE_1", ...]) or as a mapping of
+    neighbor -> walking distance ({"AISLE_1": 4.5, ...}). For list-form edges the weight is
+    the Euclidean distance between the two nodes' coordinates when both are known, else 1 hop.
+    Neighbors that are not graph keys are dropped: they have no outgoing edges and can never
+    be a path end (see _find_shortest_path_cost).
+    """
+    coordinates = coordinates or {}
+    weighted = {}
+    for node, neighbors in graph.items():
+        edges = []
+        explicit_weights = neighbors if isinstance(neighbors, dict) else {nb: None for nb in neighbors}
+        for neighbor, weight in explicit_weights.items():
+            if neighbor not in graph:
+                continue
+            if weight is None:
+                if node in coordinates and neighbor in coordinates:
+                    weight = math.dist(coordinates[node], coordinates[neighbor])
+                else:
+                    weight = 1
+            elif not isinstance(weight, (int, float)) or weight <= 0:
+                print(f"Warning (store_navigator.py): Invalid edge weight {weight!r} for {node} -> {neighbor}. Using 1.")
+                weight = 1
+            edges.append((neighbor, weight))
+        weighted[node] = edges
+    return weighted
+
+
+def build_distance_index(graph: dict, coordinates: dict = None) -> dict:
+    """
+    Precomputes the shortest walking distance between every pair of nodes in the store graph.
+    Runs one Dijkstra search per source node (plain BFS when every edge weighs 1 hop) and
+    keeps each source's shortest-path tree so full walking paths can be reconstructed.
 
     Returns:
-        list: A list of dictionaries representing the optimized order of items,
-              each with product details and their store location.
+        dict: {
+            'nodes': list of node names (position = node ordinal),
+            'node_index': {node_name: ordinal},
+            'matrix': flat row-major array('d') of walking distances; float('inf') where no path exists,
+            'hops': flat row-major array('d') of edge counts along those shortest paths,
+            'predecessors': flat row-major array('l'); row s holds the shortest-path tree rooted at s
+                            (-1 for the root and unreachable nodes)
+        }
     """
-    optimized_path_details = []
+    weighted = normalize_layout_graph(graph, coordinates)
+    nodes = list(weighted.keys())
+    node_index = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+    adjacency = [[(node_index[nb], weight) for nb, weight in weighted[node]] for node in nodes]
+    unit_weights = all(weight == 1 for edges in adjacency for _, weight in edges)
+
+    inf = float('inf')
+    matrix = array('d', [inf]) * (n * n)
+    hops = array('d', [inf]) * (n * n)
+    predecessors = array('l', [-1]) * (n * n)
+    for source in range(n):
+        row_offset = source * n
+        matrix[row_offset + source] = 0
+        hops[row_offset + source] = 0
+        if unit_weights:
+            queue = deque([source])
+            while queue:
+                current = queue.popleft()
+                next_dist = matrix[row_offset + current] + 1
+                for neighbor, _ in adjacency[current]:
+                    if matrix[row_offset + neighbor] == inf:
+                        matrix[row_offset + neighbor] = next_dist
+                        hops[row_offset + neighbor] = next_dist
+                        predecessors[row_offset + neighbor] = current
+                        queue.append(neighbor)
+        else:
+            # Dijkstra; among equally long paths prefer the one with fewer hops
+            heap = [(0, 0, source)]
+            while heap:
+                dist, hop_count, current = heapq.heappop(heap)
+                if (dist, hop_count) > (matrix[row_offset + current], hops[row_offset + current]):
+                    continue
+                for neighbor, weight in adjacency[current]:
+                    candidate = (dist + weight, hop_count + 1)
+                    if candidate < (matrix[row_offset + neighbor], hops[row_offset + neighbor]):
+                        matrix[row_offset + neighbor], hops[row_offset + neighbor] = candidate
+                        predecessors[row_offset + neighbor] = current
+                        heapq.heappush(heap, (candidate[0], candidate[1], neighbor))
+
+    return {"nodes": nodes, "node_index": node_index, "matrix": matrix, "hops": hops, "predecessors": predecessors}
+
+
+def a_star_path(graph: dict, start_node: str, end_node: str, coordinates: dict = None) -> tuple:
+    """
+    Point-to-point A* search over the (optionally weighted) layout graph, for one-off queries
+    that should not wait for a full distance index rebuild. Uses straight-line distance to the
+    goal as heuristic, scaled down so it never overestimates an edge's walking distance.
+
+    Returns:
+        tuple: (walking distance, [start_node, ..., end_node]); (float('inf'), []) if no path.
+    """
+    weighted = normalize_layout_graph(graph, coordinates)
+    if start_node not in weighted or end_node not in weighted:
+        return float('inf'), []
+    coordinates = coordinates or {}
+
+    # Largest scale for which scale * straight-line distance stays admissible on every edge
+    scale = 1.0
+    if end_node in coordinates:
+        for node, edges in weighted.items():
+            for neighbor, weight in edges:
+                if node in coordinates and neighbor in coordinates:
+                    straight_line = math.dist(coordinates[node], coordinates[neighbor])
+                    if straight_line > 0:
+                        scale = min(scale, weight / straight_line)
+                else:
+                    scale = 0.0  # Uncoordinated edge: fall back to plain Dijkstra
+
+    def heuristic(node):
+        if scale == 0.0 or node not in coordinates or end_node not in coordinates:
+            return 0.0
+        return scale * math.dist(coordinates[node], coordinates[end_node])
+
+    best = {start_node: 0}
+    came_from = {}
+    heap = [(heuristic(start_node), 0, start_node)]
+    while heap:
+        _, dist, current = heapq.heappop(heap)
+        if current == end_node:
+            path = [current]
+            while current in came_from:
+                current = came_from[current]
+                path.append(current)
+            return dist, path[::-1]
+        if dist > best.get(current, float('inf')):
+            continue
+        for neighbor, weight in weighted[current]:
+            candidate = dist + weight
+            if candidate < best.get(neighbor, float('inf')):
+                best[neighbor] = candidate
+                came_from[neighbor] = current
+                heapq.heappush(heap, (candidate + heuristic(neighbor), candidate, neighbor))
+    return float('inf'), []
+
+
+# --- Store Layout Registry ---
+# Each store's layout lives in store_layouts/<store_id>.json; store_layout.json is the default
+# store's layout and also serves its own store_id. Layouts are compiled (graph + distance index)
+# on first use, recompiled when their file changes, and evicted least-recently-used first.
+
+STORE_LAYOUTS_DIR = 'store_layouts'
+STORE_LAYOUT_CACHE_MAX_LAYOUTS = int(os.getenv('STORE_LAYOUT_CACHE_MAX_LAYOUTS', '64'))
+STORE_LAYOUT_CACHE_MAX_BYTES = int(os.getenv('STORE_LAYOUT_CACHE_MAX_MB', '256')) * 1024 * 1024
+_STORE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def compile_store_layout(filename: str) -> dict:
+    """
+    Loads a store layout file and compiles everything a route request needs from it.
+
+    Returns:
+        dict: 'store_id', 'filename', 'mtime', 'layout_graph', 'node_coordinates',
+              'product_locations' ({product_id: location_node}), 'entry_point',
+              'distance_index' (see build_distance_index) and 'size_bytes' (approximate footprint).
+    """
+    mtime = _get_file_mtime(filename)
+    layout_data = load_data_local(filename)
+    graph = layout_data.get('layout_graph', {})
+    coordinates = layout_data.get('node_coordinates', {})
+    distance_index = build_distance_index(graph, coordinates)
+    product_locations = {loc['product_id']: loc['location_node'] for loc in layout_data.get('product_locations', [])}
+
+    size_bytes = sum(
+        len(distance_index[key]) * distance_index[key].itemsize for key in ('matrix', 'hops', 'predecessors')
+    ) + 200 * (len(product_locations) + len(graph))
+    print(f"DEBUG (store_navigator.py): Compiled layout '{filename}' ({len(distance_index['nodes'])} nodes).")
+
+    return {
+        "store_id": layout_data.get('store_id'),
+        "filename": filename,
+        "mtime": mtime,
+        "layout_graph": graph,
+        "node_coordinates": coordinates,
+        "product_locations": product_locations,
+        "entry_point": layout_data.get('entry_point', 'FRONT_DOOR'),
+        "distance_index": distance_index,
+        "size_bytes": size_bytes
+    }
+
+
+class StoreLayoutRegistry:
+    """
+    Thread-safe LRU cache of compiled store layouts keyed by layout file.
+    Bounded by layout count and approximate bytes; the default layout is never evicted.
+    """
+
+    def __init__(self, layouts_dir: str = STORE_LAYOUTS_DIR, default_layout_file: str = STORE_LAYOUT_FILE,
+                 max_layouts: int = STORE_LAYOUT_CACHE_MAX_LAYOUTS, max_bytes: int = STORE_LAYOUT_CACHE_MAX_BYTES):
+        self.layouts_dir = layouts_dir
+        self.default_layout_file = default_layout_file
+        self.max_layouts = max_layouts
+        self.max_bytes = max_bytes
+        self._layouts = OrderedDict()  # filename -> compiled layout, least recently used first
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._default_store_id = None
+        self.hits = 0
+        self.compiles = 0
+        self.evictions = 0
+
+    def _resolve_filename(self, store_id: str = None) -> str | None:
+        if store_id is None:
+            return self.default_layout_file
+        if not _STORE_ID_PATTERN.match(store_id):
+            return None
+        candidate = os.path.join(self.layouts_dir, f"{store_id}.json")
+        if os.path.exists(candidate):
+            return candidate
+        if self._default_store_id is None:
+            self.get()
+        if store_id == self._default_store_id:
+            return self.default_layout_file
+        return None
+
+    def get(self, store_id: str = None) -> dict | None:
+        """
+        Returns the compiled layout for a store (the default store if store_id is None),
+        compiling it on first use or when its file changed. Returns None for unknown stores.
+        """
+        filename = self._resolve_filename(store_id)
+        if filename is None:
+            return None
+        mtime = _get_file_mtime(filename)
+
+        with self._lock:
+            layout = self._layouts.get(filename)
+            if layout is not None and layout['mtime'] == mtime:
+                self._layouts.move_to_end(filename)
+                self.hits += 1
+                return layout
+            load_lock = self._load_locks.setdefault(filename, threading.Lock())
+
+        # Compile outside the registry lock so one slow store does not block the others
+        with load_lock:
+            with self._lock:
+                layout = self._layouts.get(filename)
+                if layout is not None and layout['mtime'] == mtime:
+                    self._layouts.move_to_end(filename)
+                    self.hits += 1
+                    return layout
+
+            layout = compile_store_layout(filename)
+
+            with self._lock:
+                previous = self._layouts.pop(filename, None)
+                if previous is not None:
+                    self._total_bytes -= previous['size_bytes']
+                self._layouts[filename] = layout
+                self._total_bytes += layout['size_bytes']
+                self.compiles += 1
+                if filename == self.default_layout_file:
+                    self._default_store_id = layout['store_id']
+                self._evict_over_budget()
+        return layout
+
+    def _evict_over_budget(self):
+        """Drops least recently used layouts until within bounds. Caller holds self._lock."""
+        for filename in list(self._layouts):
+            if len(self._layouts) <= self.max_layouts and self._total_bytes <= self.max_bytes:
+                break
+            if filename == self.default_layout_file or filename == next(reversed(self._layouts)):
+                continue  # Never evict the default store or the layout just requested
+            evicted = self._layouts.pop(filename)
+            self._total_bytes -= evicted['size_bytes']
+            self.evictions += 1
+
+    def evict(self, store_id: str = None):
+        """Drops a store's compiled layout so the next request recompiles it."""
+        filename = self._resolve_filename(store_id)
+        with self._lock:
+            evicted = self._layouts.pop(filename, None)
+            if evicted is not None:
+                self._total_bytes -= evicted['size_bytes']
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "layouts_loaded": len(self._layouts),
+                "approx_bytes": self._total_bytes,
+                "hits": self.hits,
+                "compiles": self.compiles,
+                "evictions": self.evictions
+            }
+
+
+LAYOUT_REGISTRY = StoreLayoutRegistry()
+
+# The default store's layout, mirrored into module globals for callers that predate the registry.
+# Kept current by refresh_store_layout().
+_default_layout = None
+store_layout_mtime = None
+STORE_GRAPH = {}
+PRODUCT_LOCATIONS_MAP = {}
+STORE_ENTRY_POINT = 'FRONT_DOOR'
+# Optional {node: [x, y]} positions used to derive walking distances for unweighted edges
+STORE_NODE_COORDINATES = {}
+DISTANCE_INDEX = build_distance_index({})
+
+
+def refresh_store_layout(force: bool = False) -> bool:
+    """
+    Reloads store_layout.json and rebuilds the distance index if the file changed on disk.
+
+    Returns:
+        bool: True if the layout was reloaded.
+    """
+    global _default_layout, store_layout_mtime, STORE_GRAPH, PRODUCT_LOCATIONS_MAP, STORE_ENTRY_POINT, STORE_NODE_COORDINATES, DISTANCE_INDEX
+
+    if force:
+        LAYOUT_REGISTRY.evict()
+    layout = LAYOUT_REGISTRY.get()
+    if layout is _default_layout:
+        return False
+
+    _default_layout = layout
+    store_layout_mtime = layout['mtime']
+    STORE_GRAPH = layout['layout_graph']
+    PRODUCT_LOCATIONS_MAP = layout['product_locations']
+    STORE_ENTRY_POINT = layout['entry_point']
+    STORE_NODE_COORDINATES = layout['node_coordinates']
+    DISTANCE_INDEX = layout['distance_index']
+    return True
+
+
+refresh_store_layout()
+
+
+def get_store_layout(store_id: str = None) -> dict:
+    """
+    Returns the compiled layout for store_id, or the default store's layout if store_id is None.
+    Raises ValueError if no layout exists for the store.
+    """
+    if store_id is None:
+        refresh_store_layout()
+        return _default_layout
+    layout = LAYOUT_REGISTRY.get(store_id)
+    if layout is None:
+        raise ValueError(f"Unknown store_id '{store_id}': no store layout found.")
+    return layout
+
+
+def get_path_cost(start_node: str, end_node: str, distance_index: dict = None) -> float:
+    """
+    O(1) lookup of the shortest walking distance between two nodes (hops on unweighted layouts).
+    Returns float('inf') if either node is unknown or no path exists.
+    """
+    index = distance_index or DISTANCE_INDEX
+    node_index = index['node_index']
+    start = node_index.get(start_node)
+    end = node_index.get(end_node)
+    if start is None or end is None:
+        return float('inf')
+    return index['matrix'][start * len(index['nodes']) + end]
+
+
+def find_walking_path(start_node: str, end_node: str, distance_index: dict = None) -> list:
+    """
+    Reconstructs the node-by-node walking path between two nodes from the cached
+    shortest-path tree of start_node. Returns [] if no path exists.
+    """
+    index = distance_index or DISTANCE_INDEX
+    node_index = index['node_index']
+    start = node_index.get(start_node)
+    end = node_index.get(end_node)
+    if start is None or end is None:
+        return []
+    num_nodes = len(index['nodes'])
+    row_offset = start * num_nodes
+    if index['matrix'][row_offset + end] == float('inf'):
+        return []
+
+    path = [end]
+    while path[-1] != start:
+        path.append(index['predecessors'][row_offset + path[-1]])
+    return [index['nodes'][ordinal] for ordinal in reversed(path)]
+
+
+def _collect_items_to_visit(shopping_list_items: list, product_locations: dict) -> list:
+    """Resolves shopping list items to their store location and product details, skipping unlocated items."""
     items_to_visit = []
 
     # Populate items_to_visit with products that have known locations
     for item in shopping_list_items:
-        product_location_node = PRODUCT_LOCATIONS_MAP.get(item['product_id'])
+        product_location_node = product_locations.get(item['product_id'])
         if product_location_node:
             product_info = PRODUCTS_BY_ID_NAV.get(item['product_id'])
             if product_info:
@@ -82,20 +469,54 @@ def optimize_shopping_path(shopping_list_items: list, start_from_node: str = STO
                     "category": product_info['category'],
                     "price": product_info['price']
                 })
+                if 'order_id' in item:
+                    items_to_visit[-1]['order_id'] = item['order_id']
         else:
             print(f"Warning (store_navigator.py): Product ID {item['product_id']} has no defined location in store_layout.json. Skipping for pathfinding.")
+    return items_to_visit
+
+
+def optimize_shopping_path(shopping_list_items: list, start_from_node: str = None, store_id: str = None) -> list:
+    """
+    Optimizes the order of items in a shopping list for efficient in-store navigation.
+    Uses a greedy nearest-neighbor approach over the precomputed all-pairs distance index.
 
-    current_node = start_from_node
+    Args:
+        shopping_list_items (list): A list of dictionaries, each with 'product_id' and 'quantity'.
+        start_from_node (str): The starting point in the store (e.g., 'FRONT_DOOR').
+                               Defaults to the store's entry point.
+        store_id (str): The store whose layout to use. Defaults to the store in store_layout.json.
+
+    Returns:
+        list: A list of dictionaries representing the optimized order of items,
+              each with product details and their store location.
+    """
+    layout = get_store_layout(store_id)
+
+    optimized_path_details = []
+    items_to_visit = _collect_items_to_visit(shopping_list_items, layout['product_locations'])
+
+    distance_index = layout['distance_index']
+    node_index = distance_index['node_index']
+    matrix = distance_index['matrix']
+    num_nodes = len(distance_index['nodes'])
+    current_node = start_from_node or layout['entry_point']
 
     while items_to_visit:
         closest_item = None
         min_cost = float('inf')
 
-        for item in items_to_visit:
-            cost = _find_shortest_path_cost(STORE_GRAPH, current_node, item['location_node'])
-            if cost < min_cost:
-                min_cost = cost
-                closest_item = item
+        current_ordinal = node_index.get(current_node)
+        if current_ordinal is not None:
+            row_offset = current_ordinal * num_nodes
+            for item in items_to_visit:
+                item_ordinal = node_index.get(item['location_node'])
+                if item_ordinal is None:
+                    continue
+                cost = matrix[row_offset + item_ordinal]
+                if cost < min_cost:
+                    min_cost = cost
+                    closest_item = item
 
         if closest_item:
             optimized_path_details.append(closest_item)
@@ -109,6 +530,353 @@ def optimize_shopping_path(shopping_list_items: list, start_from_node: str = STO
     return optimized_path_details
 
 
+# --- 3. Route Solvers (greedy / exact / local search) ---
+
+CHECKOUT_NODE = 'CHECKOUT_AREA'
+ROUTE_SOLVERS = ("auto", "greedy", "exact", "local_search")
+# Held-Karp is O(2^n * n^2); beyond this many distinct stops 'auto' switches to local search.
+HELD_KARP_MAX_STOPS = 10
+DEFAULT_SOLVER_TIME_BUDGET_MS = 50
+
+
+def _route_cost(route: list, matrix, num_nodes: int) -> float:
+    """Total cost of walking a route given as a list of node ordinals."""
+    return sum(matrix[route[i] * num_nodes + route[i + 1]] for i in range(len(route) - 1))
+
+
+def _solve_greedy(start: int, stops: list, end, matrix, num_nodes: int) -> list:
+    """Nearest-neighbor ordering of stop ordinals, starting from `start`."""
+    remaining = list(stops)
+    order = []
+    current = start
+    while remaining:
+        row_offset = current * num_nodes
+        closest = min(remaining, key=lambda stop: matrix[row_offset + stop])
+        order.append(closest)
+        remaining.remove(closest)
+        current = closest
+    return order
+
+
+def _solve_held_karp(start: int, stops: list, end, matrix, num_nodes: int) -> list:
+    """
+    Exact open-path TSP over the stops via Held-Karp dynamic programming.
+    The path starts at `start` and, if `end` is not None, finishes at `end`.
+    """
+    n = len(stops)
+    if n == 0:
+        return []
+    full_mask = (1 << n) - 1
+    inf = float('inf')
+    # cost[mask][j]: cheapest walk from start covering `mask`, currently at stops[j]
+    cost = [[inf] * n for _ in range(1 << n)]
+    parent = [[-1] * n for _ in range(1 << n)]
+    start_offset = start * num_nodes
+    for j, stop in enumerate(stops):
+        cost[1 << j][j] = matrix[start_offset + stop]
+
+    for mask in range(1, full_mask + 1):
+        row = cost[mask]
+        for j in range(n):
+            base = row[j]
+            if base == inf or not (mask >> j) & 1:
+                continue
+            from_offset = stops[j] * num_nodes
+            for k in range(n):
+                if (mask >> k) & 1:
+                    continue
+                next_mask = mask | (1 << k)
+                candidate = base + matrix[from_offset + stops[k]]
+                if candidate < cost[next_mask][k]:
+                    cost[next_mask][k] = candidate
+                    parent[next_mask][k] = j
+
+    last_row = cost[full_mask]
+    if end is None:
+        best_last = min(range(n), key=lambda j: last_row[j])
+    else:
+        best_last = min(range(n), key=lambda j: last_row[j] + matrix[stops[j] * num_nodes + end])
+
+    order = []
+    mask, j = full_mask, best_last
+    while j != -1:
+        order.append(stops[j])
+        mask, j = mask & ~(1 << j), parent[mask][j]
+    order.reverse()
+    return order
+
+
+def _solve_local_search(start: int, stops: list, end, matrix, num_nodes: int, time_budget_ms: float) -> list:
+    """
+    Improves a greedy ordering with 2-opt segment reversals and Or-opt segment moves
+    (segments of 1-3 stops) until no move helps or the time budget runs out.
+    """
+    deadline = time.perf_counter() + time_budget_ms / 1000.0
+    order = _solve_greedy(start, stops, end, matrix, num_nodes)
+    # Route with fixed endpoints; only positions 1..last_movable may change.
+    route = [start] + order + ([end] if end is not None else [])
+    last_movable = len(order)
+
+    def dist(a, b):
+        return matrix[a * num_nodes + b]
+
+    # An open path has no successor after the last stop, so moves there cost nothing extra.
+    def dist_to_next(route, position, node):
+        return dist(node, route[position]) if position < len(route) else 0
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # 2-opt: reverse route[i..k]. Prefix sums make the (possibly asymmetric) inner cost O(1).
+        forward_prefix = [0.0]
+        backward_prefix = [0.0]
+        for t in range(len(route) - 1):
+            forward_prefix.append(forward_prefix[-1] + dist(route[t], route[t + 1]))
+            backward_prefix.append(backward_prefix[-1] + dist(route[t + 1], route[t]))
+        for i in range(1, last_movable):
+            for k in range(i + 1, last_movable + 1):
+                before = dist(route[i - 1], route[i]) + (forward_prefix[k] - forward_prefix[i]) + dist_to_next(route, k + 1, route[k])
+                after = dist(route[i - 1], route[k]) + (backward_prefix[k] - backward_prefix[i]) + dist_to_next(route, k + 1, route[i])
+                if after < before - 1e-9:
+                    route[i:k + 1] = reversed(route[i:k + 1])
+                    improved = True
+                    break
+            if improved or time.perf_counter() >= deadline:
+                break
+        if improved:
+            continue
+
+        # Or-opt: move route[i..i+length-1] to sit between route[p-1] and route[p].
+        for length in (1, 2, 3):
+            for i in range(1, last_movable - length + 2):
+                j = i + length - 1
+                removal_gain = (dist(route[i - 1], route[i]) + dist_to_next(route, j + 1, route[j])
+                                - dist_to_next(route, j + 1, route[i - 1]))
+                for p in range(1, last_movable + 2):
+                    if i <= p <= j + 1:
+                        continue
+                    insertion_cost = (dist(route[p - 1], route[i]) + dist_to_next(route, p, route[j])
+                                      - dist_to_next(route, p, route[p - 1]))
+                    if insertion_cost < removal_gain - 1e-9:
+                        segment = route[i:j + 1]
+                        del route[i:j + 1]
+                        insert_at = p if p < i else p - length
+                        route[insert_at:insert_at] = segment
+                        improved = True
+                        break
+                if improved or time.perf_counter() >= deadline:
+                    break
+            if improved or time.perf_counter() >= deadline:
+                break
+
+    return route[1:last_movable + 1]
+
+
+def solve_shopping_route(shopping_list_items: list, start_from_node: str = None, solver: str = "auto",
+                         end_at_checkout: bool = False, time_budget_ms: float = DEFAULT_SOLVER_TIME_BUDGET_MS,
+                         store_id: str = None) -> dict:
+    """
+    Orders a shopping list into a walking route, grouping items that share a location_node
+    into a single stop.
+
+    Args:
+        shopping_list_items (list): A list of dictionaries, each with 'product_id' and 'quantity'.
+        start_from_node (str): The starting point in the store. Defaults to the layout's entry point.
+        solver (str): 'greedy', 'exact' (Held-Karp), 'local_search' (2-opt/Or-opt), or 'auto'
+                      (exact up to HELD_KARP_MAX_STOPS stops, local search above that).
+        end_at_checkout (bool): If True, the route must finish at CHECKOUT_AREA.
+        time_budget_ms (float): Time budget for the local search solver.
+        store_id (str): The store whose layout to use. Defaults to the store in store_layout.json.
+
+    Returns:
+        dict: 'optimized_path' (items in visiting order), 'stops', 'total_distance' (walking
+              distance the solver minimized), 'total_hops' (edges walked), 'solver' (the solver
+              actually used), and 'solver_time_ms'.
+    """
+    if solver not in ROUTE_SOLVERS:
+        raise ValueError(f"Unknown route solver '{solver}'. Expected one of {ROUTE_SOLVERS}.")
+
+    layout = get_store_layout(store_id)
+    distance_index = layout['distance_index']
+    node_index = distance_index['node_index']
+    matrix = distance_index['matrix']
+    num_nodes = len(distance_index['nodes'])
+    start_node = start_from_node or layout['entry_point']
+
+    solver_start = time.perf_counter()
+
+    # Group items by location node, keeping first-seen order for deterministic ties
+    items_by_node = {}
+    for item in _collect_items_to_visit(shopping_list_items, layout['product_locations']):
+        items_by_node.setdefault(item['location_node'], []).append(item)
+
+    start = node_index.get(start_node)
+    end = node_index.get(CHECKOUT_NODE) if end_at_checkout else None
+    stops = []
+    for node in items_by_node:
+        ordinal = node_index.get(node)
+        if start is None or ordinal is None or matrix[start * num_nodes + ordinal] == float('inf'):
+            print(f"Warning (store_navigator.py): No path found from {start_node} to {node}. Skipping its items.")
+            continue
+        stops.append(ordinal)
+    if end_at_checkout and end is None:
+        print(f"Warning (store_navigator.py): {CHECKOUT_NODE} is not in the layout graph. Route will not end at checkout.")
+
+    used_solver = solver
+    if solver == "auto":
+        used_solver = "exact" if len(stops) <= HELD_KARP_MAX_STOPS else "local_search"
+
+    if not stops:
+        order = []
+    elif used_solver == "exact":
+        order = _solve_held_karp(start, stops, end, matrix, num_nodes)
+    elif used_solver == "local_search":
+        order = _solve_local_search(start, stops, end, matrix, num_nodes, time_budget_ms)
+    else:
+        order = _solve_greedy(start, stops, end, matrix, num_nodes)
+
+    route = ([start] if start is not None else []) + order + ([end] if end is not None and order else [])
+    total_distance = _route_cost(route, matrix, num_nodes)
+    total_hops = _route_cost(route, distance_index['hops'], num_nodes)
+    solver_time_ms = (time.perf_counter() - solver_start) * 1000
+
+    nodes = distance_index['nodes']
+    optimized_path = []
+    route_stops = []
+    for ordinal in order:
+        node = nodes[ordinal]
+        optimized_path.extend(items_by_node[node])
+        route_stops.append({"location_node": node, "product_ids": [item['product_id'] for item in items_by_node[node]]})
+
+    return {
+        "optimized_path": optimized_path,
+        "stops": route_stops,
+        "end_node": nodes[end] if end is not None and order else None,
+        "total_distance": total_distance,
+        "total_hops": total_hops,
+        "solver": used_solver,
+        "solver_time_ms": round(solver_time_ms, 3),
+        "store_id": layout['store_id']
+    }
+
+
+# --- 4. Batch Route Optimization (fulfillment pick waves) ---
+
+# Batches smaller than this are solved inline; process start-up and IPC would dominate.
+BATCH_MIN_ORDERS_FOR_POOL = 8
+# Size of the shared worker pool, fixed for the life of the process. Requests asking for fewer
+# workers are throttled by keeping fewer chunks in flight, not by resizing the pool.
+BATCH_POOL_WORKERS = max(1, int(os.getenv('BATCH_POOL_WORKERS', '0')) or os.cpu_count() or 1)
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def _shutdown_batch_pool():
+    if _batch_pool is not None:
+        _batch_pool.shutdown(wait=False)
+
+
+def _get_batch_pool() -> ProcessPoolExecutor:
+    """
+    Returns a long-lived process pool. Workers keep their own LAYOUT_REGISTRY, so each store's
+    layout is compiled at most once per worker and reused by every later batch.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_POOL_WORKERS)
+            atexit.register(_shutdown_batch_pool)
+        return _batch_pool
+
+
+def _map_chunks_bounded(pool: ProcessPoolExecutor, chunks: list, in_flight: int) -> list:
+    """Runs _solve_order_chunk over chunks with at most in_flight submitted at once, keeping input order."""
+    results = [None] * len(chunks)
+    pending_chunks = iter(enumerate(chunks))
+    pending = {pool.submit(_solve_order_chunk, chunk): index for index, chunk in itertools.islice(pending_chunks, in_flight)}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[pending.pop(future)] = future.result()
+            for index, chunk in itertools.islice(pending_chunks, 1):
+                pending[pool.submit(_solve_order_chunk, chunk)] = index
+    return results
+
+
+def _solve_order_chunk(chunk: tuple) -> list:
+    """Worker entry point: solves a chunk of orders against one store layout."""
+    orders, store_id, solver, end_at_checkout, time_budget_ms = chunk
+    routes = []
+    for order in orders:
+        route = solve_shopping_route(order['shopping_list'], solver=solver, end_at_checkout=end_at_checkout,
+                                     time_budget_ms=time_budget_ms, store_id=store_id)
+        route['order_id'] = order['order_id']
+        routes.append(route)
+    return routes
+
+
+def optimize_shopping_paths_batch(orders: list, store_id: str = None, solver: str = "auto",
+                                  end_at_checkout: bool = False, time_budget_ms: float = DEFAULT_SOLVER_TIME_BUDGET_MS,
+                                  max_workers: int = None, merge_wave: bool = False) -> dict:
+    """
+    Optimizes routes for many orders at once, spreading them over a process pool.
+
+    Args:
+        orders (list): A list of dictionaries, each with 'order_id' and 'shopping_list'
+                       (a list of {'product_id', 'quantity'}).
+        store_id (str): The store whose layout to use. Defaults to the store in store_layout.json.
+        solver, end_at_checkout, time_budget_ms: As for solve_shopping_route.
+        max_workers (int): Most worker processes this batch may occupy at once. Defaults to, and is
+                           capped at, BATCH_POOL_WORKERS.
+        merge_wave (bool): If True, also build one combined pick route for all orders,
+                           with every item tagged by its 'order_id'.
+
+    Returns:
+        dict: 'routes' (one solve_shopping_route result per order, in input order, each with
+              its 'order_id'), 'wave' (the merged route or None), 'workers', 'elapsed_ms'
+              and 'routes_per_sec'.
+    """
+    if solver not in ROUTE_SOLVERS:
+        raise ValueError(f"Unknown route solver '{solver}'. Expected one of {ROUTE_SOLVERS}.")
+    get_store_layout(store_id)  # Fail fast on unknown stores, before any work is shipped to workers
+
+    batch_start = time.perf_counter()
+    max_workers = min(max(1, max_workers or BATCH_POOL_WORKERS), BATCH_POOL_WORKERS)
+    workers = min(max_workers, len(orders))
+
+    if workers <= 1 or len(orders) < BATCH_MIN_ORDERS_FOR_POOL:
+        workers = 1
+        routes = _solve_order_chunk((orders, store_id, solver, end_at_checkout, time_budget_ms))
+    else:
+        # A few chunks per worker balances uneven order sizes without per-order IPC
+        chunk_size = math.ceil(len(orders) / (workers * 4))
+        chunks = [
+            (orders[i:i + chunk_size], store_id, solver, end_at_checkout, time_budget_ms)
+            for i in range(0, len(orders), chunk_size)
+        ]
+        routes = [route for chunk_routes in _map_chunks_bounded(_get_batch_pool(), chunks, workers)
+                  for route in chunk_routes]
+
+    wave = None
+    if merge_wave:
+        wave_items = [
+            dict(item, order_id=order['order_id'])
+            for order in orders for item in order['shopping_list']
+        ]
+        wave = solve_shopping_route(wave_items, solver=solver, end_at_checkout=end_at_checkout,
+                                    time_budget_ms=time_budget_ms, store_id=store_id)
+
+    elapsed_ms = (time.perf_counter() - batch_start) * 1000
+    return {
+        "routes": routes,
+        "wave": wave,
+        "workers": workers,
+        "elapsed_ms": round(elapsed_ms, 3),
+        "routes_per_sec": round(len(routes) / (elapsed_ms / 1000), 1) if elapsed_ms > 0 else None
+    }
+
+
 # --- Example Usage (for testing this module independently) ---
 if __name__ == "__main__":
     print("--- Running store_navigator.py for independent testing ---")
@@ -133,17 +901,32 @@ if __name__ == "__main__":
             current_stop = STORE_ENTRY_POINT
             print(f"Path starts at: {current_stop}")
             for item in optimized_list:
-                cost_to_next = _find_shortest_path_cost(STORE_GRAPH, current_stop, item['location_node'])
-                print(f"  -> Go to {item['location_node']} (Cost: {cost_to_next} hops) to pick up {item['product_name']}")
+                cost_to_next = get_path_cost(current_stop, item['location_node'])
+                print(f"  -> Go to {item['location_node']} (Cost: {cost_to_next:g}) to pick up {item['product_name']}")
                 current_stop = item['location_node']
 
             # Optionally, add path to checkout
-            cost_to_checkout = _find_shortest_path_cost(STORE_GRAPH, current_stop, 'CHECKOUT_AREA')
+            cost_to_checkout = get_path_cost(current_stop, 'CHECKOUT_AREA')
             if cost_to_checkout != float('inf'):
-                print(f"  -> Proceed to CHECKOUT_AREA (Cost: {cost_to_checkout} hops)")
+                print(f"  -> Proceed to CHECKOUT_AREA (Cost: {cost_to_checkout:g})")
             else:
                 print("  -> No path found to CHECKOUT_AREA from last item.")
         else:
             print("Could not optimize path. Check if products have locations or if layout graph is valid.")
 
+        print("\nComparing route solvers (ending at checkout):")
+        for solver_name in ("greedy", "exact", "local_search"):
+            route = solve_shopping_route(sample_shopping_list, STORE_ENTRY_POINT, solver=solver_name, end_at_checkout=True)
+            stops = " -> ".join(stop['location_node'] for stop in route['stops'])
+            print(f"  {solver_name:>12}: distance {route['total_distance']:g}, {route['total_hops']:g} hops in {route['solver_time_ms']:.3f} ms ({stops})")
+
+    print(f"\nLayout registry: {LAYOUT_REGISTRY.stats()}")
+
+    # Weighted layouts: explicit edge weights and node coordinates
+    sample_graph = {"A": {"B": 1, "C": 10}, "B": ["C"], "C": ["A"]}
+    sample_coordinates = {"B": [0, 0], "C": [3, 4]}
+    sample_index = build_distance_index(sample_graph, sample_coordinates)
+    print(f"\nWeighted sample: A -> C costs {get_path_cost('A', 'C', sample_index):g} via {find_walking_path('A', 'C', sample_index)}")
+    print(f"A* agrees: {a_star_path(sample_graph, 'A', 'C', sample_coordinates)}")
+
     print("\n--- store_navigator.py independent testing complete ---")
\ No newline at end of file
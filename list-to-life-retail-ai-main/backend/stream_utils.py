@@ -0,0 +1,89 @@
+import json
+
+
+def sse_event(event: str, data) -> str:
+    """Formats one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ListItemStreamParser:
+    """
+    Pulls complete objects out of a top-level "list_items" array while a JSON response is still arriving,
+    so each item can be processed as soon as its closing brace is received. Feed text chunks in order;
+    .text holds everything received so far for the final json.loads.
+    """
+
+    def __init__(self, array_key: str = "list_items"):
+        self.array_key = array_key
+        self._chunks = []
+        self._buffer = "" # text from the start of the item being read (or the next one)
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None # last complete string at the top level (a key, once ':' follows)
+        self._current_key = None
+        self._in_array = False
+        self._item_start = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> list:
+        """Consumes the next piece of text and returns the list items it completed (possibly none)."""
+        self._chunks.append(chunk)
+        offset = len(self._buffer)
+        self._buffer += chunk
+        items = []
+        for index in range(offset, len(self._buffer)):
+            char = self._buffer[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = self._buffer[self._string_start + 1:index]
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+            elif char == ':' and self._depth == 1:
+                self._current_key = self._last_string
+            elif char == ',' and self._depth == 1:
+                self._current_key = None
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._depth == 2 and self._current_key == self.array_key:
+                    self._in_array = True
+                elif char == '{' and self._in_array and self._depth == 3:
+                    self._item_start = index
+            elif char in '}]':
+                if char == '}' and self._in_array and self._depth == 3 and self._item_start is not None:
+                    try:
+                        item = json.loads(self._buffer[self._item_start:index + 1])
+                    except json.JSONDecodeError:
+                        item = None
+                    if isinstance(item, dict):
+                        items.append(item)
+                    self._item_start = None
+                self._depth -= 1
+                if self._in_array and self._depth < 2:
+                    self._in_array = False
+
+        # Only an unfinished item or string needs to stay buffered
+        keep_from = len(self._buffer)
+        if self._item_start is not None:
+            keep_from = self._item_start
+        if self._in_string:
+            keep_from = min(keep_from, self._string_start)
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._in_string:
+            self._string_start -= keep_from
+        self._buffer = self._buffer[keep_from:]
+        return items
@@ -0,0 +1,151 @@
+"""
+Properties of the integer-cents deal pricing in apply_deals_to_list (behind /api/shopping-list-details).
+
+Run from the backend directory (the engines load their JSON data relative to it):
+
+    python -m unittest test_deal_pricing
+"""
+import contextlib
+import io
+import multiprocessing
+import random
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
+
+import deal_optimizer as deals_module
+
+NUM_CARTS = 200
+SEED = 42
+
+
+def _random_carts(rng: random.Random, num_carts: int) -> list:
+    product_ids = sorted(deals_module.products_by_id_local)
+    return [
+        [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 12)} for _ in range(rng.randint(1, 40))]
+        for _ in range(num_carts)
+    ]
+
+
+def _quietly(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def _price_cart_worker(cart: list) -> tuple:
+    """Prices one cart in a separate process; the integer fields are what must match across processes."""
+    result = _quietly(deals_module.apply_deals_to_list, cart)
+    return (result['total_before_discount_cents'], result['total_discount_cents'],
+            tuple(item['line_discount_cents'] for item in result['processed_items']), tuple(result['applied_deals_summary']))
+
+
+def _float_reference_discount(cart: list) -> float:
+    """Stacked deal discount for a cart worked out in float dollars, straight from each deal's definition."""
+    deals_module.refresh_deal_index()
+    deal_index = deals_module.DEAL_INDEX
+    items = [deals_module.build_processing_item(item['product_id'], item['quantity']) for item in cart]
+    total_discount = 0.0
+    for ordinal, matched_items in deals_module.match_deals_to_items(items, deal_index).items():
+        deal = deal_index['deals'][ordinal]
+        if deal['type'] in ("PERCENTAGE_CATEGORY", "PERCENTAGE_ITEM"):
+            total_discount += sum(item['original_price'] * item['quantity'] * deal['discount_percentage'] / 100 for item in matched_items)
+        elif deal['type'] == "FIXED_AMOUNT_ITEM":
+            total_discount += sum(deal['discount_value'] * item['quantity'] for item in matched_items)
+        elif deal['type'] == "BOGO":
+            total_discount += sum(item['original_price'] * free_units
+                                  for item, free_units in deals_module.allocate_bogo_free_units(deal, matched_items))
+        elif deal['type'] == "BUNDLE_THRESHOLD":
+            total_discount += (sum(item['quantity'] for item in matched_items) // deal['min_quantity_for_deal']) * deal['discount_value']
+    return total_discount
+
+
+class MoneyHelperTests(unittest.TestCase):
+    def test_percentage_of_cents_rounds_half_up_like_decimal(self):
+        rng = random.Random(SEED)
+        for _ in range(2000):
+            amount_cents, percentage = rng.randint(0, 10 ** 7), rng.choice([5, 10, 12.5, 15, 20, 33.33, 50])
+            expected = (Decimal(amount_cents) * Decimal(str(percentage)) / 100).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+            self.assertEqual(deals_module._percentage_of_cents(amount_cents, deals_module._basis_points(percentage)), int(expected))
+
+    def test_spread_cents_sums_exactly_and_stays_proportional(self):
+        rng = random.Random(SEED)
+        for _ in range(2000):
+            amount_cents = rng.randint(0, 10 ** 7)
+            weights = [rng.randint(0, 5000) for _ in range(rng.randint(1, 12))]
+            shares = deals_module._spread_cents(amount_cents, weights)
+            if not sum(weights):
+                self.assertEqual(shares, [0] * len(weights))
+                continue
+            self.assertEqual(sum(shares), amount_cents)
+            for share, weight in zip(shares, weights):
+                self.assertLess(abs(share - amount_cents * weight / sum(weights)), 1)
+
+
+class CartPricingTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.carts = _random_carts(random.Random(SEED), NUM_CARTS)
+
+    def test_lines_add_up_to_totals(self):
+        for cart in self.carts:
+            result = _quietly(deals_module.apply_deals_to_list, cart)
+            items = result['processed_items']
+            self.assertEqual(sum(item['line_total_cents'] for item in items), result['total_before_discount_cents'])
+            self.assertEqual(sum(item['line_discount_cents'] for item in items), result['total_discount_cents'])
+            self.assertEqual(result['total_after_discount_cents'], result['total_before_discount_cents'] - result['total_discount_cents'])
+            self.assertEqual(result['total_after_discount'], result['total_after_discount_cents'] / 100)
+
+    def test_totals_do_not_depend_on_line_order(self):
+        rng = random.Random(SEED)
+        for cart in self.carts:
+            shuffled = cart[:]
+            rng.shuffle(shuffled)
+            self.assertEqual(_quietly(deals_module.apply_deals_to_list, shuffled)['total_discount_cents'],
+                             _quietly(deals_module.apply_deals_to_list, cart)['total_discount_cents'])
+
+    def test_within_half_a_cent_per_line_of_float_reference(self):
+        for cart in self.carts:
+            result = _quietly(deals_module.apply_deals_to_list, cart)
+            reference = _quietly(_float_reference_discount, cart)
+            self.assertLessEqual(abs(result['total_discount'] - reference), 0.005 * len(cart) + 1e-6)
+
+    def test_identical_in_fresh_interpreters(self):
+        # Spawned workers get their own hash seeds, so set/dict iteration order differs from this process
+        carts = self.carts[:50]
+        in_process = [_price_cart_worker(cart) for cart in carts]
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) as pool:
+            self.assertEqual(list(pool.map(_price_cart_worker, carts, chunksize=8)), in_process)
+
+    def test_exclusive_mode_ledger(self):
+        for cart in self.carts[:50]:
+            result = _quietly(deals_module.apply_deals_to_list, cart, mode="exclusive")
+            items = result['processed_items']
+            self.assertEqual(sum(item['line_discount_cents'] for item in items), result['total_discount_cents'])
+            self.assertEqual(sum(allocation['savings_cents'] for allocation in result['deal_allocations']), result['total_discount_cents'])
+            self.assertTrue(all(0 <= item['line_discount_cents'] <= item['line_total_cents'] for item in items))
+
+    def test_session_matches_full_pricing(self):
+        rng = random.Random(SEED)
+        product_ids = sorted(deals_module.products_by_id_local)
+        for cart in self.carts[:20]:
+            session = _quietly(deals_module.CartPricingSession, cart)
+            for _ in range(10):
+                op = rng.choice(deals_module.CART_CHANGE_OPS)
+                change = {"op": op, "product_id": rng.choice(list(session.lines) or product_ids)}
+                if op != "remove":
+                    change["quantity"] = rng.randint(0, 6)
+                priced = _quietly(session.apply_changes, [change])
+                full = _quietly(deals_module.apply_deals_to_list,
+                                [{"product_id": line['product_id'], "quantity": line['quantity']} for line in session.lines.values()])
+                for field in ("total_before_discount_cents", "total_discount_cents", "total_after_discount_cents"):
+                    self.assertEqual(priced[field], full[field])
+
+    def test_session_rejects_bad_quantities(self):
+        product_id = sorted(deals_module.products_by_id_local)[0]
+        for quantity in ("3", -1, 2.5, None):
+            with self.assertRaises(ValueError):
+                _quietly(deals_module.CartPricingSession, [{"product_id": product_id, "quantity": quantity}])
+
+
+if __name__ == "__main__":
+    unittest.main()